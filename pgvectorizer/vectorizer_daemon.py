@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import json
+import os
+import select
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import click
+import numpy as np
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv, find_dotenv
+from pgvector.psycopg2 import register_vector
+from timescale_vector import client, pgvectorizer
+
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.vectorstores.timescalevector import TimescaleVector
+
+# the chunker is shared with the other examples, in shared/ at the root of the repo
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from shared.token_chunker import chunk_texts
+
+
+# This script keeps the blog_embedding table in sync with the blog table as a
+# long-running service, rather than running vectorizer.process() by hand or on a
+# schedule as in vectorize.ipynb.
+#
+# Changes to blog are queued in blog_embedding_work_queue by the trigger that
+# PgVectorizer registers. We add a second trigger on the queue that sends a
+# NOTIFY, so the workers sleep until there is work rather than polling for it.
+# Each of the --workers threads has its own database connection and embedding
+# client, and repeatedly:
+#   - claims a batch of queued blog ids, skipping ids claimed by other workers
+#     (FOR UPDATE SKIP LOCKED), and removes them from the queue in a short
+#     transaction that is committed straight away, as PgVectorizer does. no locks
+#     are held while the blogs are embedded
+#   - chunks and embeds the claimed blogs in one request, outside any transaction
+#   - deletes their old embeddings and inserts the new ones in a second short
+#     transaction. if embedding or writing fails, the ids are queued again
+#
+# Every --report-interval seconds it prints the queue depth, the age of the
+# oldest queued change (the lag before an edit becomes searchable), and the
+# throughput since the last report.
+#
+#   ./vectorizer_daemon.py --workers 4
+
+
+_ = load_dotenv(find_dotenv(), override=True)
+TIMESCALE_SERVICE_URL = os.environ["TIMESCALE_SERVICE_URL"]
+
+TABLE_NAME = "blog_embedding"
+WORK_QUEUE = "blog_embedding_work_queue"
+CHANNEL = "blog_embedding_work"
+# the blogs are cut into chunks of at most this many tokens (see shared/token_chunker.py)
+CHUNK_SIZE = 256
+CHUNK_OVERLAP = 50
+
+
+def setup(vectorizer: pgvectorizer.Vectorize) -> None:
+    # create the embedding table the same way the notebook's TimescaleVector store does
+    TimescaleVector(
+        collection_name=TABLE_NAME,
+        service_url=TIMESCALE_SERVICE_URL,
+        embedding=OpenAIEmbeddings(),
+        time_partition_interval=timedelta(days=30),
+    )
+    # create the work queue and the trigger on blog that fills it
+    vectorizer.register()
+    with psycopg2.connect(TIMESCALE_SERVICE_URL) as conn:
+        with conn.cursor() as cursor:
+            # record when each change was queued, to report the lag. the trigger
+            # inserts the id alone, so the new column takes its default
+            cursor.execute(f"ALTER TABLE {WORK_QUEUE} ADD COLUMN IF NOT EXISTS queued_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+            # wake up the workers once per statement that queues changes
+            cursor.execute(f"""
+                CREATE OR REPLACE FUNCTION {WORK_QUEUE}_notify() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+                BEGIN
+                    PERFORM pg_notify('{CHANNEL}', '');
+                    RETURN NULL;
+                END;
+                $$;
+
+                DROP TRIGGER IF EXISTS notify_workers ON {WORK_QUEUE};
+                CREATE TRIGGER notify_workers
+                AFTER INSERT ON {WORK_QUEUE}
+                FOR EACH STATEMENT EXECUTE PROCEDURE {WORK_QUEUE}_notify();
+            """)
+
+
+def claim_query(vectorizer: pgvectorizer.Vectorize, table_oid: int, batch_size: int) -> str:
+    # the same claim as PgVectorizer's process(). it is committed on its own, so
+    # the queue's rows aren't locked while the claimed blogs are embedded. the
+    # advisory locks are taken for the session rather than the transaction: an id
+    # queued again meanwhile is skipped by the other workers until this one has
+    # written its embeddings (see unlock_query), so an older version of a blog
+    # can't overwrite a newer one. the other queue entries of the claimed ids are
+    # deleted too, skipping those another worker's claim has locked rather than
+    # waiting for them, so two claims can't deadlock. a skipped entry is claimed
+    # later, and the blog is embedded again
+    return f"""
+        WITH selected_rows AS (
+            SELECT id
+            FROM {vectorizer.schema_name}.{vectorizer.work_queue_table_name}
+            LIMIT {int(batch_size)}
+            FOR UPDATE SKIP LOCKED
+        ),
+        locked_items AS (
+            SELECT id, pg_try_advisory_lock({int(table_oid)}, id) AS locked
+            FROM (SELECT DISTINCT id FROM selected_rows ORDER BY id) as ids
+        ),
+        deleted_rows AS (
+            DELETE FROM {vectorizer.schema_name}.{vectorizer.work_queue_table_name}
+            WHERE ctid IN (
+                SELECT ctid
+                FROM {vectorizer.schema_name}.{vectorizer.work_queue_table_name}
+                WHERE id IN (SELECT id FROM locked_items WHERE locked = true)
+                FOR UPDATE SKIP LOCKED
+            )
+        )
+        SELECT locked_items.id as locked_id, {vectorizer.table_name}.*
+        FROM locked_items
+        LEFT JOIN {vectorizer.schema_name}.{vectorizer.table_name} ON {vectorizer.table_name}.{vectorizer.id_column_name} = locked_items.id
+        WHERE locked = true
+        ORDER BY locked_items.id
+    """
+
+
+def unlock_query(table_oid: int) -> str:
+    return f"SELECT pg_advisory_unlock({int(table_oid)}, id) FROM unnest(%s::int[]) AS id"
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blogs = 0
+        self.chunks = 0
+        self.batches = 0
+        self.errors = 0
+
+    def add(self, blogs: int, chunks: int):
+        with self.lock:
+            self.blogs += blogs
+            self.chunks += chunks
+            self.batches += 1
+
+    def fail(self):
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self) -> tuple[int, int, int, int]:
+        with self.lock:
+            return self.blogs, self.chunks, self.batches, self.errors
+
+
+class Daemon:
+    def __init__(self, workers=4, batch_size=10, poll_interval=30.0):
+        self.vectorizer = pgvectorizer.Vectorize(TIMESCALE_SERVICE_URL, 'blog')
+        self.workers = workers
+        self.batch_size = batch_size
+        # without notifications the workers still look for work this often
+        self.poll_interval = poll_interval
+        self.stats = Stats()
+        self.stop = threading.Event()
+        # counts notifications, so a worker that finds the queue empty only sleeps
+        # if nothing was queued since it looked
+        self.wakeups = 0
+        self.condition = threading.Condition()
+
+    def wake(self):
+        with self.condition:
+            self.wakeups += 1
+            self.condition.notify_all()
+
+    def listen(self):
+        conn = psycopg2.connect(TIMESCALE_SERVICE_URL)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while not self.stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    self.wake()
+        finally:
+            conn.close()
+
+    def work(self):
+        # one connection and embedding client per worker, reused for every batch
+        conn = psycopg2.connect(TIMESCALE_SERVICE_URL)
+        register_vector(conn)
+        embeddings = OpenAIEmbeddings()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)::oid", (f"{self.vectorizer.schema_name}.{self.vectorizer.work_queue_table_name}",))
+                table_oid = cursor.fetchone()[0]
+            conn.commit()
+            query = claim_query(self.vectorizer, table_oid, self.batch_size)
+            unlock = unlock_query(table_oid)
+            while not self.stop.is_set():
+                with self.condition:
+                    seen = self.wakeups
+                try:
+                    processed = self.process_batch(conn, query, unlock, embeddings)
+                except Exception as e:
+                    conn.rollback()
+                    self.stats.fail()
+                    click.echo(f"batch failed, its changes are queued again: {e}", err=True)
+                    self.stop.wait(5.0)
+                    continue
+                if processed == 0:
+                    with self.condition:
+                        if self.wakeups == seen and not self.stop.is_set():
+                            self.condition.wait(timeout=self.poll_interval)
+        finally:
+            conn.close()
+
+    def process_batch(self, conn, query: str, unlock: str, embeddings: OpenAIEmbeddings) -> int:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(query)
+            blogs = cursor.fetchall()
+        conn.commit()
+        if not blogs:
+            return 0
+        ids = [blog['locked_id'] for blog in blogs]
+        try:
+            rows = self.write_embeddings(conn, blogs, embeddings)
+        except Exception:
+            conn.rollback()
+            self.requeue(conn, ids)
+            raise
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute(unlock, (ids,))
+            conn.commit()
+        self.stats.add(len(blogs), rows)
+        return len(blogs)
+
+    def write_embeddings(self, conn, blogs, embeddings: OpenAIEmbeddings) -> int:
+        # skip blogs that are deleted (title will be None because of left join)
+        texts, metadatas = [], []
+        existing = [blog for blog in blogs if blog['title'] is not None]
+        chunks = chunk_texts((blog['content'] for blog in existing), CHUNK_SIZE, CHUNK_OVERLAP)
+        for blog, blog_chunks in zip(existing, chunks):
+            for chunk, _ in blog_chunks:
+                texts.append(f"Title: {blog['title']}, contents:{chunk}")
+                metadatas.append({"blog_id": blog['id'], "title": blog['title'], "url": blog['url']})
+        # no transaction is open during the request, which can take seconds
+        vectors = embeddings.embed_documents(texts) if texts else []
+        rows = []
+        for text, metadata, vector in zip(texts, metadatas, vectors):
+            id_ = str(client.uuid_from_time(datetime.now()))
+            rows.append((id_, json.dumps({"id": id_, **metadata}), text, np.asarray(vector, dtype=np.float32)))
+        with conn.cursor() as cursor:
+            # delete old embeddings for all ids in the batch, then insert the new ones
+            deleted = [json.dumps({"blog_id": blog['locked_id']}) for blog in blogs]
+            cursor.execute(
+                f"DELETE FROM {TABLE_NAME} WHERE " + " OR ".join(["metadata @> %s::jsonb"] * len(deleted)),
+                deleted)
+            psycopg2.extras.execute_values(
+                cursor,
+                f"INSERT INTO {TABLE_NAME} (id, metadata, contents, embedding) VALUES %s",
+                rows)
+        conn.commit()
+        return len(rows)
+
+    def requeue(self, conn, ids: list[int]) -> None:
+        # put the claimed ids back in the queue, so they are processed again
+        try:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, f"INSERT INTO {WORK_QUEUE} (id) VALUES %s", [(id_,) for id_ in ids])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            click.echo(f"could not queue blogs {ids} again, they need to be re-vectorized: {e}", err=True)
+
+    def queue_state(self, cursor) -> tuple[int, float]:
+        cursor.execute(f"SELECT count(*), coalesce(extract(epoch FROM now() - min(queued_at)), 0) FROM {WORK_QUEUE}")
+        depth, lag = cursor.fetchone()
+        return depth, float(lag)
+
+    def run(self, report_interval=10.0):
+        setup(self.vectorizer)
+        threads = [threading.Thread(target=self.listen, daemon=True)]
+        threads += [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        click.echo(f"listening on {CHANNEL} with {self.workers} workers")
+        conn = psycopg2.connect(TIMESCALE_SERVICE_URL)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        last, last_time = self.stats.snapshot(), time.perf_counter()
+        try:
+            while True:
+                time.sleep(report_interval)
+                with conn.cursor() as cursor:
+                    depth, lag = self.queue_state(cursor)
+                now, now_time = self.stats.snapshot(), time.perf_counter()
+                seconds = now_time - last_time
+                click.echo(
+                    f"queue {depth} blogs, oldest {lag:.1f}s | "
+                    f"{(now[0] - last[0]) / seconds:.1f} blogs/s, {(now[1] - last[1]) / seconds:.1f} chunks/s | "
+                    f"{now[0]} blogs, {now[1]} chunks in {now[2]} batches, {now[3]} failed batches")
+                last, last_time = now, now_time
+        except KeyboardInterrupt:
+            click.echo("stopping...")
+        finally:
+            self.stop.set()
+            self.wake()
+            for thread in threads:
+                thread.join(timeout=30)
+            conn.close()
+
+
+@click.command()
+@click.option("--workers", default=4, help="number of worker threads claiming batches from the queue")
+@click.option("--batch-size", default=10, help="number of blogs each worker claims at a time")
+@click.option("--poll-interval", default=30.0, help="seconds an idle worker waits for a notification before looking anyway")
+@click.option("--report-interval", default=10.0, help="seconds between progress reports")
+def main(workers: int, batch_size: int, poll_interval: float, report_interval: float):
+    Daemon(workers, batch_size, poll_interval).run(report_interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# Code shared by the examples in this repo. The scripts, apps and notebooks add
+# the root of the repo to sys.path and import it as the shared package:
+#
+#   sys.path.append(str(Path(__file__).resolve().parent.parent))
+#   from shared.token_chunker import chunk_texts
+#
+# - token_chunker.py cuts texts into chunks of at most a number of tokens
+# - token_budget.py packs retrieved texts into a token budget for a prompt
@@ -0,0 +1,75 @@
+import pytest
+import tiktoken
+from shared import token_chunker
+from shared.token_chunker import chunk_text, chunk_texts, num_tokens
+
+
+# The encoding has one token per byte, so chunks can be checked by hand and a
+# multi-byte character is split across tokens.
+
+
+def byte_encoding() -> tiktoken.Encoding:
+    return tiktoken.Encoding(
+        "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    encoding = byte_encoding()
+    monkeypatch.setattr(token_chunker, "get_encoding", lambda encoding_name=token_chunker.ENCODING: encoding)
+
+
+TEXTS = [
+    "",
+    "short",
+    "exactly 16 bytes",
+    "the quick brown fox jumps over the lazy dog " * 5,
+    "naïve café déjà vu, 日本語のテキスト " * 3,
+]
+
+
+def test_short_texts_are_one_chunk():
+    assert chunk_text("short", chunk_size=16) == [("short", 5)]
+    assert chunk_text("exactly 16 bytes", chunk_size=16) == [("exactly 16 bytes", 16)]
+    assert chunk_text("", chunk_size=16) == []
+
+
+def test_chunks_without_overlap_round_trip():
+    for text in TEXTS:
+        chunks = chunk_text(text, chunk_size=16)
+        assert "".join(chunk for chunk, _ in chunks) == text
+        assert sum(tokens for _, tokens in chunks) == num_tokens(text)
+        assert all(tokens <= 16 for _, tokens in chunks)
+
+
+def test_chunks_with_overlap_cover_the_text():
+    text = "the quick brown fox jumps over the lazy dog " * 5
+    chunks = chunk_text(text, chunk_size=16, overlap=4)
+    assert all(tokens == 16 for _, tokens in chunks[:-1])
+    # each chunk starts 12 bytes after the previous one
+    for i, (chunk, _) in enumerate(chunks):
+        assert text[12 * i:].startswith(chunk)
+    assert text.endswith(chunks[-1][0])
+
+
+def test_chunks_fit_the_chunk_size():
+    # a chunk cut partway through a character doesn't grow past the chunk size
+    for text in TEXTS:
+        for chunk, tokens in chunk_text(text, chunk_size=7, overlap=2):
+            assert num_tokens(chunk) <= tokens <= 7
+
+
+def test_chunk_texts_matches_chunk_text():
+    texts = TEXTS * 3
+    assert list(chunk_texts(texts, chunk_size=16, overlap=3, batch_size=4)) == [
+        chunk_text(text, chunk_size=16, overlap=3) for text in texts
+    ]
+
+
+def test_missing_texts_have_no_chunks():
+    assert list(chunk_texts(["a", None, float("nan")], chunk_size=16)) == [[("a", 1)], [], []]
+
+
+def test_overlap_must_be_smaller_than_chunk_size():
+    with pytest.raises(ValueError):
+        list(chunk_texts(["a"], chunk_size=4, overlap=4))
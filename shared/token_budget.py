@@ -0,0 +1,73 @@
+import hashlib
+from functools import lru_cache
+import tiktoken
+
+
+# Packs texts retrieved for a RAG prompt, most relevant first, into a budget of
+# tokens. Used by up_and_running/context_packer.py and
+# tsv_timemachine/context_packer.py.
+#
+# Tokens are counted with the chat model's tokenizer, which is loaded only once.
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    # loading an encoding is expensive, so only ever do it once per model
+    return tiktoken.encoding_for_model(model)
+
+
+def duplicate_key(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+
+class TokenBudget:
+    # packs texts, most relevant first, into a budget of tokens:
+    #   - a text that is the same as one already packed, apart from case and
+    #     whitespace, is a duplicate and is skipped
+    #   - a text longer than max_tokens is truncated
+    #   - packing stops at the first text that would go over the budget, so a less
+    #     relevant text never takes the place of a more relevant one
+    def __init__(self, budget: int, max_tokens: int, model: str, separator_tokens: int = 0):
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.model = model
+        # tokens added between consecutive texts
+        self.separator_tokens = separator_tokens
+        # what happened to the texts of the last pack_texts()
+        self.packed = 0
+        self.duplicates = 0
+        self.over_budget = 0
+        self.tokens = 0
+
+    def truncate(self, text: str) -> tuple[str, int]:
+        tokens = get_encoding(self.model).encode(text, disallowed_special=())
+        if len(tokens) <= self.max_tokens:
+            return text, len(tokens)
+        return get_encoding(self.model).decode(tokens[:self.max_tokens]) + " ...", self.max_tokens + 1
+
+    def pack_texts(self, items: list[tuple[str, str]]) -> list[tuple[int, str]]:
+        # items are (the text compared for duplicates, the text to pack). returns
+        # the index and the packed, possibly truncated, text of each packed item
+        self.packed = self.duplicates = self.over_budget = self.tokens = 0
+        seen = set()
+        packed = []
+        for i, (compared, text) in enumerate(items):
+            key = duplicate_key(compared)
+            if key in seen:
+                self.duplicates += 1
+                continue
+            text, tokens = self.truncate(text)
+            tokens += self.separator_tokens
+            if self.tokens + tokens > self.budget:
+                # this and every less relevant item are left out
+                self.over_budget = len(items) - i
+                break
+            seen.add(key)
+            packed.append((i, text))
+            self.tokens += tokens
+            self.packed += 1
+        return packed
@@ -0,0 +1,98 @@
+import itertools
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple
+
+import tiktoken
+
+# Splits text into chunks of at most a given number of tokens, for embedding.
+# Used by tsv_timemachine, pgvectorizer and openai_pgvector_helloworld.
+#
+# - encoders are cached: tiktoken.get_encoding() is slow to call for every text
+# - each text is encoded once. the chunks are cut at exact token offsets in the
+#   original text, rather than guessing how many words fit in a number of tokens
+#   and encoding each guess again
+# - texts are encoded a batch at a time with encode_batch, which encodes on
+#   several threads (tiktoken releases the GIL while encoding)
+# - chunks are yielded as each batch is encoded, so a large corpus is never held
+#   in memory all at once
+
+ENCODING = "cl100k_base"
+BATCH_SIZE = 256
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = ENCODING) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
+def num_tokens(text: str, encoding_name: str = ENCODING) -> int:
+    if not text:
+        return 0
+    # special tokens such as <|endoftext|> in the text are counted as plain text
+    return len(get_encoding(encoding_name).encode(text, disallowed_special=()))
+
+
+def split_tokens(text: str, tokens: List[int], chunk_size: int, overlap: int, encoding_name: str = ENCODING) -> List[Tuple[str, int]]:
+    # cuts the encoded text into (chunk, number of tokens) pairs. consecutive
+    # chunks share `overlap` tokens
+    if not tokens:
+        return []
+    if len(tokens) <= chunk_size:
+        return [(text, len(tokens))]
+    # the offset of the first character of each token in the decoded text. a
+    # token can end partway through a character, so the chunks are cut from the
+    # decoded text at character boundaries, rather than decoding each chunk's tokens
+    encoding = get_encoding(encoding_name)
+    decoded, offsets = encoding.decode_with_offsets(tokens)
+
+    def boundary(i: int, lowest: int, default: int) -> int:
+        # the last token at or before i, and after lowest, that starts a character.
+        # cutting at a token that continues a character would put the whole
+        # character in both chunks
+        j = i
+        while j > lowest and 0x80 <= encoding.decode_single_token_bytes(tokens[j])[0] < 0xC0:
+            j -= 1
+        return j if j > lowest else default
+
+    chunks = []
+    start = 0
+    while True:
+        end = min(start + chunk_size, len(tokens))
+        if end == len(tokens):
+            chunks.append((decoded[offsets[start]:], end - start))
+            return chunks
+        # a chunk smaller than a character is cut partway through it
+        end = boundary(end, start, end)
+        chunks.append((decoded[offsets[start]:offsets[end]], end - start))
+        # the next chunk starts overlap tokens before this one ends, or right at
+        # its end if that would be no later than this one started
+        start = boundary(end - overlap, start, end)
+
+
+def chunk_text(text: str, chunk_size: int = 512, overlap: int = 0, encoding_name: str = ENCODING) -> List[Tuple[str, int]]:
+    # the chunks of a single text, with their number of tokens
+    if not text:
+        return []
+    tokens = get_encoding(encoding_name).encode(text, disallowed_special=())
+    return split_tokens(text, tokens, chunk_size, overlap, encoding_name)
+
+
+def chunk_texts(
+    texts: Iterable[str],
+    chunk_size: int = 512,
+    overlap: int = 0,
+    encoding_name: str = ENCODING,
+    batch_size: int = BATCH_SIZE,
+    num_threads: int = 8,
+) -> Iterator[List[Tuple[str, int]]]:
+    # yields the chunks of each text, in order, encoding the texts a batch at a time
+    if overlap >= chunk_size:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_size ({chunk_size})")
+    encoding = get_encoding(encoding_name)
+    texts = iter(texts)
+    while batch := list(itertools.islice(texts, batch_size)):
+        # missing texts, e.g. NaN in a pandas column, have no chunks
+        batch = [text if isinstance(text, str) else "" for text in batch]
+        encoded = encoding.encode_batch(batch, num_threads=num_threads, disallowed_special=())
+        for text, tokens in zip(batch, encoded):
+            yield split_tokens(text, tokens, chunk_size, overlap, encoding_name)
@@ -0,0 +1,126 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from datetime import timedelta
+from typing import List, Optional
+
+import streamlit as st
+
+from db import connection
+
+# Answers are cached in the answer_cache table with the embedding of their
+# question. A question is answered from the cache when a cached question's
+# embedding is within MAX_DISTANCE, it was asked with the same filters against
+# the same version of the repo's table, and less than TTL ago. Loading a repo
+# bumps the version of its table, so answers about the old history aren't used.
+MAX_DISTANCE = 0.05
+TTL = timedelta(days=7)
+
+def create_answer_cache(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS answer_cache_corpus (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            corpus_version BIGINT NOT NULL,
+            filters JSONB NOT NULL,
+            question TEXT NOT NULL,
+            embedding VECTOR(1536) NOT NULL,
+            answer TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            hits BIGINT NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS answer_cache_lookup_idx ON answer_cache (table_name, corpus_version, created_at);
+    """)
+
+def bump_corpus_version(cursor, table_name):
+    create_answer_cache(cursor)
+    cursor.execute("""
+        INSERT INTO answer_cache_corpus (table_name, version) VALUES (%s, 1)
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = answer_cache_corpus.version + 1, updated_at = now();
+    """, (table_name,))
+    cursor.execute("""
+        DELETE FROM answer_cache c
+        USING answer_cache_corpus v
+        WHERE c.table_name = v.table_name AND c.corpus_version < v.version AND v.table_name = %s;
+    """, (table_name,))
+
+# The tables only need creating once per server
+@st.cache_resource
+def ensure_answer_cache():
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            create_answer_cache(cursor)
+    return True
+
+# Process-wide hit/miss counters, shared by every session on this server
+@st.cache_resource
+def answer_cache_stats():
+    return {"hits": 0, "misses": 0}
+
+def cached_answer(table_name: str, filters: dict, embedding: List[float]) -> Optional[str]:
+    stats = answer_cache_stats()
+    ensure_answer_cache()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            # the few answers for this version and these filters are compared exactly
+            cursor.execute("""
+                WITH candidates AS MATERIALIZED (
+                    SELECT id, answer, embedding
+                    FROM answer_cache
+                    WHERE table_name = %(table_name)s
+                    AND corpus_version = coalesce((SELECT version FROM answer_cache_corpus WHERE table_name = %(table_name)s), 0)
+                    AND created_at > now() - %(ttl)s
+                    AND filters = %(filters)s::jsonb
+                )
+                SELECT id, answer, embedding <=> %(embedding)s::vector AS distance
+                FROM candidates
+                ORDER BY distance
+                LIMIT 1;
+            """, {"table_name": table_name, "ttl": TTL, "filters": json.dumps(filters, sort_keys=True), "embedding": str(list(embedding))})
+            row = cursor.fetchone()
+            if row is None or row[2] > MAX_DISTANCE:
+                stats["misses"] += 1
+                return None
+            cursor.execute("UPDATE answer_cache SET hits = hits + 1 WHERE id = %s", (row[0],))
+            stats["hits"] += 1
+            return row[1]
+
+def store_answer(table_name: str, filters: dict, question: str, embedding: List[float], answer: str):
+    ensure_answer_cache()
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            params = {"table_name": table_name, "ttl": TTL, "filters": json.dumps(filters, sort_keys=True),
+                      "question": question, "embedding": str(list(embedding)), "answer": answer}
+            cursor.execute("""
+                INSERT INTO answer_cache (table_name, corpus_version, filters, question, embedding, answer)
+                VALUES (
+                    %(table_name)s,
+                    coalesce((SELECT version FROM answer_cache_corpus WHERE table_name = %(table_name)s), 0),
+                    %(filters)s::jsonb, %(question)s, %(embedding)s::vector, %(answer)s);
+            """, params)
+            # expired answers are never used again
+            cursor.execute("DELETE FROM answer_cache WHERE table_name = %(table_name)s AND created_at <= now() - %(ttl)s", params)
+
+def answer_cache_info() -> str:
+    stats = answer_cache_stats()
+    total = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / total if total else 0.0
+    return f"Answer cache: {stats['hits']} hits, {stats['misses']} misses ({rate:.0%} hit rate)"
@@ -0,0 +1,119 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmark of building the nodes for a git history, with no embedding or
+# database involved:
+# - dataframe: how 0_LoadData.py used to do it. The commits are put in a pandas
+#   DataFrame, each row gets its own splitter, and the nodes are flattened into
+#   one list and split into work with np.array_split
+# - per commit: each commit gets its own splitter, as it is read
+# - batched: node_builder.py, which cuts the commits into chunks of tokens with
+#   shared/token_chunker.py rather than by sentences, so long commits can be
+#   split at different places
+#
+#   python bench_node_builder.py --commits 100000
+
+import argparse
+import random
+import string
+import time
+from datetime import datetime, timedelta, timezone
+from multiprocessing import cpu_count
+
+import numpy as np
+import pandas as pd
+
+from llama_index.schema import TextNode
+from llama_index.text_splitter import SentenceSplitter
+
+from node_builder import CHUNK_SIZE, create_uuid, node_batches
+# node_builder put the root of the repo on sys.path
+from shared.token_chunker import num_tokens
+
+def synthetic_commits(n, seed=0):
+    # commit messages are mostly short, with a few long ones that need splitting
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(5000)]
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for i in range(n):
+        body_words = rng.choice([0, 20, 60, 150, 400, 1500])
+        body = ". ".join(" ".join(rng.choices(words, k=12)) for _ in range(body_words // 12))
+        yield {
+            "Commit Hash": f"{i:040x}",
+            "Author": rng.choice(words).title() + " " + rng.choice(words).title(),
+            "Date": (start + timedelta(minutes=17 * i)).isoformat(),
+            "Subject": " ".join(rng.choices(words, k=8)),
+            "Body": body,
+        }
+
+def create_nodes(record):
+    # the per commit path: a new splitter for every commit
+    text_splitter = SentenceSplitter(chunk_size=1024)
+    record_content = (
+        "Date: "+ str(record["Date"])
+        + " "
+        + "Author: "+ record['Author']
+        + " "
+        + str(record["Subject"])
+        + " "
+        + str(record["Body"])
+    )
+    text_chunks = text_splitter.split_text(record_content)
+    return [TextNode(
+        id_=create_uuid(record["Date"]),
+        text=chunk,
+        metadata={
+            "commit_hash": record["Commit Hash"],
+            "author": record['Author'],
+            "date": record["Date"],
+        },
+    ) for chunk in text_chunks]
+
+def dataframe_path(commits):
+    df = pd.DataFrame(commits).astype(str)
+    nodes_combined = [item for sublist in [create_nodes(row.to_dict()) for _, row in df.iterrows()] for item in sublist]
+    num_splits = int(max(cpu_count(), len(df.index) / 1000))
+    return [node for split in np.array_split(nodes_combined, num_splits) for node in split]
+
+def per_commit_path(commits):
+    return [node for commit in commits for node in create_nodes(commit)]
+
+def batched_path(commits):
+    return [node for _, nodes in node_batches(commits, 20) for node in nodes]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commits", type=int, default=20000)
+    args = parser.parse_args()
+    commits = list(synthetic_commits(args.commits))
+
+    results = {}
+    for name, path in [("dataframe", dataframe_path), ("per commit", per_commit_path), ("batched", batched_path)]:
+        start = time.perf_counter()
+        nodes = path(commits)
+        duration = time.perf_counter() - start
+        results[name] = nodes
+        print(f"{name:>12}: {len(nodes):,} nodes in {duration:.2f}s ({len(commits) / duration:,.0f} commits/s)")
+
+    # every commit should get nodes, no node should be longer than the chunk size,
+    # and every node needs its own id or the vector store drops it
+    batched = results["batched"]
+    commits_covered = len({node.metadata["commit_hash"] for node in batched}) == len(commits)
+    within_size = all(num_tokens(node.text) <= CHUNK_SIZE for node in batched)
+    unique_ids = len({node.id_ for node in batched}) == len(batched)
+    print(f"batched nodes cover every commit: {commits_covered}, within {CHUNK_SIZE} tokens: {within_size}, unique ids: {unique_ids}")
+    assert commits_covered and within_size and unique_ids
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import psycopg2
+import streamlit as st
+
+from db import connection
+
+# The repos in time_machine_catalog, shared by every session. The LoadData page
+# clears it whenever it writes the catalog, and otherwise it's re-read every few
+# minutes in case another server loaded a repo
+@st.cache_data(ttl=300, show_spinner=False)
+def get_repos():
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute("SELECT repo_url, table_name FROM time_machine_catalog;")
+            except psycopg2.errors.UndefinedTable:
+                conn.rollback()
+                return {}
+            return {repo_url: table_name for repo_url, table_name in cursor.fetchall()}
+
+def invalidate_catalog():
+    get_repos.clear()
@@ -0,0 +1,75 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+import streamlit as st
+
+from llama_index.bridge.pydantic import Field
+from llama_index.indices.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+
+# the packing is shared with up_and_running, in shared/ at the root of the repo
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from shared.token_budget import TokenBudget
+
+
+# Process-wide counters, shared by every session on this server
+@st.cache_resource
+def context_packing_stats():
+    return {"nodes": 0, "packed": 0, "duplicates": 0, "over_budget": 0, "tokens": 0}
+
+class TokenBudgetPostprocessor(BaseNodePostprocessor):
+    """Packs the retrieved commits, most relevant first, into a token budget.
+
+    Duplicate commits are skipped and long commits are truncated, so that
+    retrieving many commits can't blow up the prompt.
+    """
+
+    budget: int = Field(default=4000, description="The most tokens of commits to pass to the LLM.")
+    max_node_tokens: int = Field(default=400, description="Longer commits are truncated to this many tokens.")
+    model: str = Field(default="gpt-4", description="The model whose tokenizer counts the tokens.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenBudgetPostprocessor"
+
+    def postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        nodes = sorted(nodes, key=lambda n: n.score or 0.0, reverse=True)
+        # the same commit message, e.g. of a backported change, apart from its date
+        items = [
+            (node.node.get_content().replace(str(node.node.metadata.get("date", "")), ""), node.node.get_content())
+            for node in nodes
+        ]
+        budget = TokenBudget(self.budget, self.max_node_tokens, self.model)
+        packed = []
+        for i, text in budget.pack_texts(items):
+            nodes[i].node.text = text
+            packed.append(nodes[i])
+        stats = context_packing_stats()
+        stats["nodes"] += len(nodes)
+        stats["packed"] += budget.packed
+        stats["duplicates"] += budget.duplicates
+        stats["over_budget"] += budget.over_budget
+        stats["tokens"] += budget.tokens
+        return packed
+
+def context_packing_info() -> str:
+    stats = context_packing_stats()
+    return (f"Context packing: {stats['packed']} of {stats['nodes']} commits kept, "
+            f"{stats['duplicates']} duplicates, {stats['over_budget']} over budget, {stats['tokens']:,} tokens")
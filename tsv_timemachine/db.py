@@ -0,0 +1,72 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from contextlib import contextmanager
+
+import streamlit as st
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+MAX_CONNECTIONS = 10
+# how long a session waits for a free connection before giving up
+CONNECTION_TIMEOUT = 30.0
+
+class BlockingPool:
+    """A ThreadedConnectionPool that waits for a free connection.
+
+    ThreadedConnectionPool raises PoolError as soon as every connection is in
+    use. Here the extra sessions wait, up to timeout seconds, for one to be
+    returned instead.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, **kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError(f"no database connection was free for {self.timeout:g}s")
+        try:
+            return self.pool.getconn()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close: bool = False):
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+# One pool of connections for the whole server, shared by every session and
+# rerun, so a query doesn't pay for opening a new connection each time
+@st.cache_resource
+def get_pool():
+    return BlockingPool(1, MAX_CONNECTIONS, CONNECTION_TIMEOUT, dsn=st.secrets["TIMESCALE_SERVICE_URL"])
+
+@contextmanager
+def connection():
+    """Borrows a pooled connection, committing on success and rolling back on error."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        # the connection is returned on every path. connections the server closed,
+        # or whose state is unknown after an error, are dropped from the pool
+        broken = bool(conn.closed) or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN
+        pool.putconn(conn, close=broken)
@@ -0,0 +1,231 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import random
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+# Loads batches of nodes into the database as a pipeline of three stages:
+#
+#   read (1 thread) --queue--> embed (embed_workers threads) --queue--> insert (db_workers threads)
+#
+# The batches are small and every worker takes the next batch from a shared
+# queue as soon as it is free, so a slow batch never leaves the other workers
+# idle, and embedding overlaps with the inserts. The two pools are sized
+# independently: the embedding API and the database have different limits.
+#
+# How many embedding requests are in flight adapts to the API (AIMD): it grows by
+# about one for every round of requests that succeed, and halves whenever the
+# API pushes back. llama_index's OpenAIEmbedding retries rate limited requests
+# itself, with a backoff, so we rarely see the 429s: a request that takes much
+# longer than usual is counted as rate limited too. A batch that fails with a
+# rate limit anyway is retried after a backoff.
+#
+# The queues, the stop event and the failure handling are those of
+# up_and_running/pipeline.py, which this app doesn't import (each app in the repo
+# is self-contained). They differ in two ways: the progress is reported from the
+# thread that calls run(), on a timer, since Streamlit elements can only be
+# updated from the script's thread (Pipeline reports from a monitor thread and
+# yields its output to the caller); and the embed stage retries under the
+# adaptive limit rather than applying a plain function.
+
+_DONE = object()
+
+# a request slower than this many times the recent average is counted as rate limited
+SLOW_FACTOR = 3.0
+
+def is_rate_limit(error: BaseException) -> bool:
+    # OpenAI's client raises RateLimitError; llama_index may wrap it in tenacity's RetryError
+    last_attempt = getattr(error, "last_attempt", None)
+    if last_attempt is not None and last_attempt.exception() is not None:
+        error = last_attempt.exception()
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    return "RateLimit" in type(error).__name__ or status == 429
+
+class AdaptiveLimit:
+    """Caps the number of requests in flight, adapting the cap with AIMD."""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 32):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.rate_limits = 0
+        # moving average of the latency of the requests that weren't slowed down
+        self.latency: Optional[float] = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, rate_limited: bool = False, latency: Optional[float] = None):
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None and not rate_limited:
+                # the client's own retries show up as a much slower request
+                if self.latency is not None and latency > SLOW_FACTOR * self.latency:
+                    rate_limited = True
+                else:
+                    self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if rate_limited:
+                self.rate_limits += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, items: int):
+        with self.lock:
+            self.items += items
+
+    def rate(self) -> float:
+        return self.items / max(time.perf_counter() - self.start, 1e-9)
+
+class LoadScheduler:
+    def __init__(
+        self,
+        embed: Callable[[list], None],
+        insert: Callable[[list], None],
+        embed_workers: int = 8,
+        db_workers: int = 4,
+        queue_size: int = 16,
+        max_retries: int = 8,
+    ):
+        self.embed = embed
+        self.insert = insert
+        self.embed_workers = embed_workers
+        self.db_workers = db_workers
+        self.max_retries = max_retries
+        self.limit = AdaptiveLimit(initial=max(1, embed_workers // 2), maximum=embed_workers)
+        self.embed_queue = queue.Queue(maxsize=queue_size)
+        self.db_queue = queue.Queue(maxsize=queue_size)
+        self.stats = {name: StageStats(name) for name in ("read", "embed", "insert")}
+        self.commits = 0
+        self.error: Optional[BaseException] = None
+        self.stop = threading.Event()
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        # blocks while the queue is full, unless another stage failed
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def _read(self, batches: Iterable[Tuple[int, list]]):
+        try:
+            for num_commits, nodes in batches:
+                self.commits += num_commits
+                self.stats["read"].add(len(nodes))
+                if not self._put(self.embed_queue, nodes):
+                    return
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.embed_workers):
+                self._put(self.embed_queue, _DONE)
+
+    def _embed_batch(self, nodes: list):
+        for attempt in range(self.max_retries + 1):
+            self.limit.acquire()
+            start = time.perf_counter()
+            try:
+                self.embed(nodes)
+            except Exception as e:
+                rate_limited = is_rate_limit(e)
+                self.limit.release(rate_limited)
+                if not rate_limited or attempt == self.max_retries:
+                    raise
+                time.sleep(min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+                continue
+            self.limit.release(latency=time.perf_counter() - start)
+            return
+
+    def _embed_worker(self):
+        try:
+            while (nodes := self._get(self.embed_queue)) is not _DONE:
+                self._embed_batch(nodes)
+                self.stats["embed"].add(len(nodes))
+                if not self._put(self.db_queue, nodes):
+                    return
+        except BaseException as e:
+            self._fail(e)
+
+    def _insert_worker(self):
+        try:
+            while (nodes := self._get(self.db_queue)) is not _DONE:
+                self.insert(nodes)
+                self.stats["insert"].add(len(nodes))
+        except BaseException as e:
+            self._fail(e)
+
+    def describe(self) -> str:
+        read, embed, insert = (self.stats[name] for name in ("read", "embed", "insert"))
+        return (
+            f"{self.commits} commits read. "
+            f"Embedding {embed.rate():,.0f} nodes/s ({self.limit.in_flight} in flight, limit {self.limit.limit:.1f}, "
+            f"{self.limit.rate_limits} rate limited). "
+            f"Inserting {insert.rate():,.0f} nodes/s ({insert.items} of {read.items} nodes done)")
+
+    def run(self, batches: Iterable[Tuple[int, list]], report: Callable[["LoadScheduler"], None], interval: float = 0.5):
+        # runs the pipeline, calling report from this thread every interval seconds
+        reader = threading.Thread(target=self._read, args=(batches,), daemon=True)
+        embedders = [threading.Thread(target=self._embed_worker, daemon=True) for _ in range(self.embed_workers)]
+        for thread in [reader] + embedders:
+            thread.start()
+        inserters = [threading.Thread(target=self._insert_worker, daemon=True) for _ in range(self.db_workers)]
+        for thread in inserters:
+            thread.start()
+
+        def wait(threads: List[threading.Thread]):
+            while any(thread.is_alive() for thread in threads):
+                report(self)
+                for thread in threads:
+                    thread.join(timeout=interval / len(threads))
+
+        wait([reader] + embedders)
+        # every embedded batch is queued. tell the inserters to finish
+        for _ in range(self.db_workers):
+            self._put(self.db_queue, _DONE)
+        wait(inserters)
+        report(self)
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,66 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from llama_index.schema import TextNode
+from timescale_vector import client
+
+# the chunker is shared with the other examples, in shared/ at the root of the repo
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from shared.token_chunker import chunk_texts
+
+# Builds the nodes for a stream of commits, a batch of commits at a time:
+# - each field is gathered for the whole batch, and the texts are built in one pass
+# - the batch's texts are tokenized together and cut into chunks of at most
+#   CHUNK_SIZE tokens by shared/token_chunker.py. most commits fit in one
+#   chunk. every text is tokenized, however short, as the chunk size is in tokens
+# - batches are built lazily, as the commits are read
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 200
+
+def create_uuid(date_string: str):
+    datetime_obj = datetime.fromisoformat(date_string)
+    uuid = client.uuid_from_time(datetime_obj)
+    return str(uuid)
+
+def create_batch_nodes(commits: List[Dict[str, str]], chunk_size: int = CHUNK_SIZE) -> List[TextNode]:
+    hashes = [c["Commit Hash"] for c in commits]
+    authors = [c["Author"] for c in commits]
+    dates = [c["Date"] for c in commits]
+    texts = [
+        f"Date: {date} Author: {author} {c['Subject']} {c['Body']}"
+        for date, author, c in zip(dates, authors, commits)
+    ]
+    nodes = []
+    chunks = chunk_texts(texts, chunk_size, CHUNK_OVERLAP)
+    for commit_hash, author, date, text_chunks in zip(hashes, authors, dates, chunks):
+        metadata = {"commit_hash": commit_hash, "author": author, "date": date}
+        # every chunk needs its own id: the vector store skips rows whose id it
+        # already has. the uuids are random apart from the commit's time
+        nodes.extend(
+            TextNode(id_=create_uuid(date), text=chunk, metadata=dict(metadata))
+            for chunk, _ in text_chunks
+        )
+    return nodes
+
+def node_batches(commits: Iterable[Dict[str, str]], commits_per_batch: int) -> Iterator[Tuple[int, List[TextNode]]]:
+    # yields (number of commits, their nodes) a batch at a time
+    commits = iter(commits)
+    while batch := list(itertools.islice(commits, commits_per_batch)):
+        yield len(batch), create_batch_nodes(batch)
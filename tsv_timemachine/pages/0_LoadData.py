@@ -12,15 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import cpu_count
 import time
 import subprocess
 import shutil
+import tempfile
 import psycopg2
 
-import numpy as np
-
 import streamlit as st
 from streamlit.hello.utils import show_code
 
@@ -28,51 +25,17 @@ from llama_index.vector_stores import TimescaleVectorStore
 from llama_index import StorageContext
 from llama_index.indices.vector_store import VectorStoreIndex
 
-import pandas as pd
 from pathlib import Path
-from datetime import datetime, timedelta
-from timescale_vector import client
+from datetime import date, timedelta
 
 from typing import List, Tuple
 
-from llama_index.schema import TextNode
 from llama_index.embeddings import OpenAIEmbedding
-from git import Repo
-
-from llama_index.text_splitter import SentenceSplitter
-
-def create_uuid(date_string: str):
-    datetime_obj = datetime.fromisoformat(date_string)
-    uuid = client.uuid_from_time(datetime_obj)
-    return str(uuid)
-
-# Create a Node object from a single row of data
-def create_nodes(row):
-    text_splitter = SentenceSplitter(chunk_size=1024)
-
-    record = row.to_dict()
-    record_content = (
-        "Date: "+ str(record["Date"])
-        + " "
-        + "Author: "+ record['Author']
-        + " "
-        + str(record["Subject"])
-        + " "
-        + str(record["Body"])
-    )
-
-    text_chunks = text_splitter.split_text(record_content)
-    nodes = [TextNode(
-        id_=create_uuid(record["Date"]),
-        text=chunk,
-        metadata={
-            "commit_hash": record["Commit Hash"],
-            "author": record['Author'],
-            "date": record["Date"],
-        },
-    ) for chunk in text_chunks]
 
-    return nodes
+from answer_cache import bump_corpus_version
+from load_scheduler import LoadScheduler
+from node_builder import node_batches
+from catalog import invalidate_catalog
 
 def github_url_to_table_name(github_url):
     repository_path = github_url.replace("https://github.com/", "")
@@ -80,6 +43,7 @@ def github_url_to_table_name(github_url):
     return table_name
 
 def record_catalog_info(repo):
+    # Returns the repo's table and the newest commit loaded into it, if any
     with psycopg2.connect(dsn=st.secrets["TIMESCALE_SERVICE_URL"]) as connection:
         # Create a cursor within the context manager
         with connection.cursor() as cursor:
@@ -87,25 +51,46 @@ def record_catalog_info(repo):
             create_table_sql = """
             CREATE TABLE IF NOT EXISTS time_machine_catalog (
                 repo_url TEXT PRIMARY KEY,
-                table_name TEXT
+                table_name TEXT,
+                last_commit_hash TEXT,
+                last_commit_date TIMESTAMPTZ
             );
+            ALTER TABLE time_machine_catalog
+                ADD COLUMN IF NOT EXISTS last_commit_hash TEXT,
+                ADD COLUMN IF NOT EXISTS last_commit_date TIMESTAMPTZ;
             """
             cursor.execute(create_table_sql)
 
-            delete_sql = "DELETE FROM time_machine_catalog WHERE repo_url = %s"
-            cursor.execute(delete_sql, (repo,))
-
             insert_data_sql = """
             INSERT INTO time_machine_catalog (repo_url, table_name)
-            VALUES (%s, %s);
+            VALUES (%s, %s)
+            ON CONFLICT (repo_url) DO UPDATE SET table_name = excluded.table_name
+            RETURNING last_commit_hash, to_regclass(table_name) IS NOT NULL;
             """
             
             table_name = github_url_to_table_name(repo)
             cursor.execute(insert_data_sql, (repo, table_name))
-            return table_name
+            last_commit_hash, table_exists = cursor.fetchone()
+    # the Time Machine page re-reads the catalog on its next run
+    invalidate_catalog()
+    return table_name, last_commit_hash if table_exists else None
+
+def record_last_commit(repo, commit_hash, date):
+    with psycopg2.connect(dsn=st.secrets["TIMESCALE_SERVICE_URL"]) as connection:
+        with connection.cursor() as cursor:
+            update_sql = """
+            UPDATE time_machine_catalog
+            SET last_commit_hash = %s, last_commit_date = %s
+            WHERE repo_url = %s;
+            """
+            cursor.execute(update_sql, (commit_hash, date, repo))
 
 
-def load_into_db(table_name, df_combined):
+COMMITS_PER_SPLIT = 20
+EMBED_WORKERS = 8
+DB_WORKERS = 4
+
+def load_into_db(table_name, commits, limit=0, incremental=False):
     embedding_model = OpenAIEmbedding()
     embedding_model.api_key = st.secrets["OPENAI_API_KEY"]
 
@@ -115,136 +100,182 @@ def load_into_db(table_name, df_combined):
         time_partition_interval=timedelta(days=365),
     )
 
-    ts_vector_store._sync_client.drop_table()
-    ts_vector_store._sync_client.create_tables()
-
-    cpus = cpu_count()
-    min_splits = len(df_combined.index) / 1000 #no more than 1000 rows/split
-    num_splits = int(max(cpus, min_splits))
-
+    if not incremental:
+        ts_vector_store._sync_client.drop_table()
+        ts_vector_store._sync_client.create_tables()
 
     st.spinner("Processing...")
-    progress = st.progress(0, f"Processing, with {num_splits} splits")
+    progress = st.progress(0, "Processing")
     start = time.time()
 
-    nodes_combined = [item for sublist in [create_nodes(row) for _, row in df_combined.iterrows()] for item in sublist]
-    node_tasks = np.array_split(nodes_combined, num_splits)
-    
-    def worker(nodes): 
-        start = time.time()
+    def embed(nodes):
         texts = [n.get_content(metadata_mode="all") for n in nodes] 
         embeddings = embedding_model.get_text_embedding_batch(texts)
         for i, node in enumerate(nodes):
             node.embedding = embeddings[i]
-        duration_embedding = time.time()-start
-        start = time.time()
-        ts_vector_store.add(nodes)
-        duration_db = time.time()-start
-        return (duration_embedding, duration_db)
-
-    embedding_durations = []
-    db_durations = []
-    with ThreadPoolExecutor() as executor:
-        times = executor.map(worker, node_tasks)
-
-        for index, worker_times in enumerate(times):
-            duration_embedding, duration_db = worker_times
-            embedding_durations.append(duration_embedding)
-            db_durations.append(duration_db)
-            progress.progress((index+1)/num_splits, f"Processing, with {num_splits} splits")
-
-
-    progress.progress(100, f"Processing embeddings took {sum(embedding_durations)}s. Db took {sum(db_durations)}s. Using {num_splits} splits")
-    
-    st.spinner("Creating the index...")
-    progress = st.progress(0, "Creating the index")
-    start = time.time()
-    ts_vector_store.create_index()
+
+    def report(scheduler):
+        fraction = min(scheduler.commits / limit, 1.0) if limit > 0 else 0
+        progress.progress(fraction, scheduler.describe())
+
+    # embedding and inserting run in separate pools, a small batch at a time
+    scheduler = LoadScheduler(embed, ts_vector_store.add, embed_workers=EMBED_WORKERS, db_workers=DB_WORKERS)
+    # the commits are turned into nodes a batch at a time, as git reads them
+    try:
+        scheduler.run(node_batches(commits, COMMITS_PER_SPLIT), report)
+    except RuntimeError as e:
+        # e.g. git failed while the commits were being read
+        st.error(str(e))
+        raise
+    num_commits = scheduler.commits
     duration = time.time()-start
-    progress.progress(100, f"Creating the index took {duration} seconds")
-    st.success("Done")
+    progress.progress(1.0, f"Loading {num_commits} commits took {duration:.1f}s. {scheduler.describe()}")
+    if num_commits == 0:
+        st.success("Already up to date")
+        return
+
+    # an existing index is kept up to date as the new commits are inserted
+    if not incremental:
+        st.spinner("Creating the index...")
+        progress = st.progress(0, "Creating the index")
+        start = time.time()
+        ts_vector_store.create_index()
+        duration = time.time()-start
+        progress.progress(100, f"Creating the index took {duration} seconds")
 
-def get_history(repo, branch, limit): 
-    st.spinner("Fetching git history...")
-    start = time.time()
-    progress = st.progress(0, "Fetching git history")
-    # Clean up any existing "tmprepo" directory
-    shutil.rmtree("tmprepo", ignore_errors=True)
+    # answers cached for the old history of this repo are no longer used
+    with psycopg2.connect(dsn=st.secrets["TIMESCALE_SERVICE_URL"]) as connection:
+        with connection.cursor() as cursor:
+            bump_corpus_version(cursor, table_name)
+    st.success(f"Loaded {num_commits} commits")
+
+GIT_LOG_FORMAT = "%H%x1f%an%x1f%cI%x1f%B%x1e"   # fields separated by \x1f, commits by \x1e
+
+def clone_path(repo):
+    # each repo keeps its own clone, so loading it again only fetches what's new
+    return Path("tmprepo") / github_url_to_table_name(repo)
+
+def run_git(args, cwd="."):
+    res = subprocess.run(["git"] + args, capture_output=True, text=True, cwd=cwd)
+    if res.returncode != 0:
+        st.error("Error running Git \n\n"+str(res.stderr))
+        raise ValueError(f"Git failed: {res.returncode}")
 
-    # Clone the Git repository with the specified branch
-    res = subprocess.run(
-        [
-            "git",
+def has_commit(path, commit):
+    res = subprocess.run(["git", "cat-file", "-e", commit + "^{commit}"], capture_output=True, cwd=path)
+    return res.returncode == 0
+
+def update_clone(repo, branch):
+    # Fetch the branch into an existing clone, or clone it. Only the commits are
+    # downloaded (no file contents), since we only read the history
+    path = clone_path(repo)
+    if (path / ".git").exists():
+        run_git(["fetch", "--filter=blob:none", "origin", f"+refs/heads/{branch}:refs/remotes/origin/{branch}"], cwd=path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        run_git([
             "clone",
             "--filter=blob:none",
             "--no-checkout",
             "--single-branch",
             "--branch=" + branch,
             repo + ".git",
-            "tmprepo",
-        ],
-        capture_output=True,
-        text=True,
-        cwd=".",  # Set the working directory here
-    )
-
-    if res.returncode != 0:
-        st.error("Error running Git \n\n"+str(res.stderr))
-        raise ValueError(f"Git failed: {res.returncode}")
-
-    repo = Repo('tmprepo')
-
-    # Create lists to store data
-    commit_hashes = []
-    authors = []
-    dates = []
-    subjects = []
-    bodies = []
-
-    # Iterate through commits and collect data
-    for commit in repo.iter_commits():
-        commit_hash = commit.hexsha
-        author = commit.author.name
-        date = commit.committed_datetime.isoformat()
-        message_lines = commit.message.splitlines()
-        subject = message_lines[0]
-        body = "\n".join(message_lines[1:]) if len(message_lines) > 1 else ""
-
-        commit_hashes.append(commit_hash)
-        authors.append(author)
-        dates.append(date)
-        subjects.append(subject)
-        bodies.append(body)
-
-    # Create a DataFrame from the collected data
-    data = {
-        "Commit Hash": commit_hashes,
-        "Author": authors,
-        "Date": dates,
-        "Subject": subjects,
-        "Body": bodies
+            str(path),
+        ])
+    return path
+
+def parse_commit(entry):
+    commit_hash, author, date, message = entry.lstrip("\n").split("\x1f", 3)
+    subject, _, body = message.rstrip("\n").partition("\n")
+    return {
+        "Commit Hash": commit_hash,
+        "Author": author,
+        "Date": date,
+        "Subject": subject,
+        "Body": body,
     }
 
-    df = pd.DataFrame(data)
-
-    # Light data cleaning on DataFrame
-    df = df.astype(str)
+def iter_history(path, branch, limit=0, since_date=None, since_commit=None):
+    # Stream the commits, newest first, from a single `git log`. The limit and the
+    # since filters are applied by git as it walks the history, so it stops as
+    # soon as it has found them rather than reading the whole history
+    args = ["git", "log", "--format=" + GIT_LOG_FORMAT]
     if limit > 0:
-        df = df[:limit]
-
+        args.append(f"--max-count={limit}")
+    if since_date is not None:
+        args.append(f"--since={since_date}")
+    rev = f"origin/{branch}"
+    args.append(f"{since_commit}..{rev}" if since_commit else rev)
+    # git's messages go to a temporary file rather than a pipe: nothing reads a
+    # pipe until git exits, and git would block once it filled up
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(args, cwd=path, stdout=subprocess.PIPE, stderr=stderr,
+                                text=True, encoding="utf-8", errors="replace")
+        try:
+            buffer = ""
+            while chunk := proc.stdout.read(1 << 16):
+                buffer += chunk
+                *entries, buffer = buffer.split("\x1e")
+                for entry in entries:
+                    yield parse_commit(entry)
+            if proc.wait() != 0:
+                # this runs in the load scheduler's reader thread, which can't
+                # write to the page. the error is raised from scheduler.run()
+                stderr.seek(0)
+                message = stderr.read().decode("utf-8", errors="replace")
+                raise RuntimeError(f"Git failed with exit code {proc.returncode}\n\n{message}")
+        finally:
+            # the consumer may stop early; don't leave git blocked writing to the pipe
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+def get_history(repo, branch, limit, since_date=None, since_commit=None):
+    st.spinner("Fetching git history...")
+    start = time.time()
+    progress = st.progress(0, "Fetching git history")
+    path = update_clone(repo, branch)
+    if since_commit is not None and not has_commit(path, since_commit):
+        # e.g. the history was rewritten. there is nothing to start from
+        st.error(f"The last loaded commit {since_commit} is no longer in the repo. Please reload the whole history.")
+        raise ValueError(f"Commit {since_commit} is not in the repo")
     duration = time.time()-start
     progress.progress(100, f"Fetching git history took {duration} seconds")
-    return df
+    return iter_history(path, branch, limit, since_date, since_commit)
+
+def track_newest(commits, newest):
+    # git log lists the newest commit first
+    for commit in commits:
+        if not newest:
+            newest.update(commit)
+        yield commit
 
 
 def load_git_history():
     repo = st.text_input("Repo", "https://github.com/postgres/postgres")
     branch = st.text_input("Branch", "master")
     limit = int(st.text_input("Limit number commits (0 for no limit)", "1000"))
+    since_date = None
+    if st.checkbox("Only load commits made since a date"):
+        since_date = st.date_input("Since", date.today() - timedelta(days=365))
+    reload = st.checkbox("Reload the whole history (otherwise only commits newer than the last load are added)")
     if st.button("Load data into the database"):
-        df = get_history(repo, branch, limit)
-        table_name = record_catalog_info(repo)
-        load_into_db(table_name, df)
+        table_name, last_commit = record_catalog_info(repo)
+        incremental = last_commit is not None and not reload
+        if incremental:
+            # the limit and the date apply to the first load. a refresh adds every
+            # new commit, so none are skipped
+            commits = get_history(repo, branch, 0, since_commit=last_commit)
+        else:
+            commits = get_history(repo, branch, limit, since_date=since_date)
+            # until the load completes there's no commit to refresh from
+            record_last_commit(repo, None, None)
+        newest = {}
+        load_into_db(table_name, track_newest(commits, newest), 0 if incremental else limit, incremental)
+        if newest:
+            record_last_commit(repo, newest["Commit Hash"], newest["Date"])
 
 st.set_page_config(page_title="Load git history", page_icon="💿")
 st.markdown("# Load git history for analysis")
@@ -22,7 +22,7 @@ from streamlit.hello.utils import show_code
 from llama_index.vector_stores import TimescaleVectorStore
 from llama_index import ServiceContext, StorageContext
 from llama_index.indices.vector_store import VectorStoreIndex
-from llama_index.llms import OpenAI
+from llama_index.llms import OpenAI, ChatMessage, MessageRole
 from llama_index import set_global_service_context
 
 import pandas as pd
@@ -34,28 +34,34 @@ from typing import List, Tuple
 
 from llama_index.schema import TextNode
 from llama_index.embeddings import OpenAIEmbedding
-import psycopg2
 
-def get_repos():
-    with psycopg2.connect(dsn=st.secrets["TIMESCALE_SERVICE_URL"]) as connection:
-        # Create a cursor within the context manager
-        with connection.cursor() as cursor:
-            try:
-                select_data_sql = "SELECT * FROM time_machine_catalog;"
-                cursor.execute(select_data_sql)
-            except psycopg2.errors.UndefinedTable as e:
-                return {}
+from query_cache import CachedOpenAIEmbedding, query_embedding_cache_info
+from context_packer import TokenBudgetPostprocessor, context_packing_info
+from answer_cache import cached_answer, store_answer, answer_cache_info
+from catalog import get_repos
 
-            catalog_entries = cursor.fetchall()
+# The vector store, service context and index are shared by every session on the
+# server, so reruns and new sessions don't rebuild them
+@st.cache_resource
+def get_vector_store(table_name):
+    return TimescaleVectorStore.from_params(
+        service_url=st.secrets["TIMESCALE_SERVICE_URL"],
+        table_name=table_name,
+        time_partition_interval=timedelta(days=7),
+    )
 
-            catalog_dict = {}
-            for entry in catalog_entries:
-                repo_url, table_name = entry
-                catalog_dict[repo_url] = table_name
+@st.cache_resource
+def get_service_context():
+    # query embeddings are cached, so repeated questions skip the OpenAI round trip
+    service_context = ServiceContext.from_defaults(llm=OpenAI(model="gpt-4", temperature=0.1), embed_model=CachedOpenAIEmbedding())
+    set_global_service_context(service_context)
+    return service_context
 
-            return catalog_dict
+@st.cache_resource
+def get_index(table_name):
+    return VectorStoreIndex.from_vector_store(vector_store=get_vector_store(table_name), service_context=get_service_context())
 
-def get_auto_retriever(index, retriever_args):
+def get_auto_retriever(index, retriever_args, node_postprocessors=None, chat_history=None):
     from llama_index.vector_stores.types import MetadataInfo, VectorStoreInfo
     vector_store_info = VectorStoreInfo(
         content_info="Description of the commits to PostgreSQL. Describes changes made to Postgres",
@@ -93,7 +99,8 @@ def get_auto_retriever(index, retriever_args):
     # build query engine
     from llama_index.query_engine.retriever_query_engine import RetrieverQueryEngine
     query_engine = RetrieverQueryEngine.from_args(
-        retriever=retriever, service_context=index.service_context
+        retriever=retriever, service_context=index.service_context,
+        node_postprocessors=node_postprocessors,
     )
 
     from llama_index.tools.query_engine import QueryEngineTool
@@ -104,22 +111,30 @@ def get_auto_retriever(index, retriever_args):
     chat_engine = OpenAIAgent.from_tools(
         tools=[query_engine_tool],
         llm=index.service_context.llm,
+        chat_history=chat_history,
         verbose=True
         #service_context=index.service_context
     )
     return chat_engine
 
+def remember_exchange(chat_engine, question, answer):
+    # adds a question answered without the chat engine, e.g. from the answer cache,
+    # to its history, so that follow up questions are asked in its context
+    messages = [ChatMessage(role=MessageRole.USER, content=question),
+                ChatMessage(role=MessageRole.ASSISTANT, content=answer)]
+    if hasattr(chat_engine, "memory"):
+        for message in messages:
+            chat_engine.memory.put(message)
+    else:
+        chat_engine.chat_history.extend(messages)
+
 def tm_demo():
     repos = get_repos()
 
     months = st.sidebar.slider('How many months back to search (0=no limit)?', 0, 130, 0)
-
-    if "config_months" not in st.session_state.keys() or months != st.session_state.config_months:
-        st.session_state.clear()
-
     topk = st.sidebar.slider('How many commits to retrieve', 1, 150, 20)
-    if "config_topk" not in st.session_state.keys() or topk != st.session_state.config_topk:
-        st.session_state.clear()
+    # the retrieved commits are packed into this many tokens of the prompt
+    budget = st.sidebar.slider('Token budget for retrieved commits', 1000, 16000, 4000, step=500)
         
     if len(repos) > 0:
         repo = st.sidebar.selectbox("Choose a repo", repos.keys())
@@ -127,11 +142,9 @@ def tm_demo():
         st.error("No repositiories found, please [load some data first](/LoadData)")
         return
     
+    # a different repo starts a new conversation
     if "config_repo" not in st.session_state.keys() or repo != st.session_state.config_repo:
         st.session_state.clear()
-    
-    st.session_state.config_months = months
-    st.session_state.config_topk = topk
     st.session_state.config_repo = repo
 
 
@@ -140,25 +153,22 @@ def tm_demo():
             {"role": "assistant", "content": "Please choose a repo and time filter on the sidebar and then ask me a question about the git history"}
         ]
 
-    vector_store = TimescaleVectorStore.from_params(
-        service_url=st.secrets["TIMESCALE_SERVICE_URL"],
-        table_name=repos[repo],
-        time_partition_interval=timedelta(days=7),
-    );
-
-    service_context = ServiceContext.from_defaults(llm=OpenAI(model="gpt-4", temperature=0.1))
-    set_global_service_context(service_context)
-    index = VectorStoreIndex.from_vector_store(vector_store=vector_store, service_context=service_context)
-    
+    service_context = get_service_context()
+    index = get_index(repos[repo])
         
-    #chat engine goes into the session to retain history
-    if "chat_engine" not in st.session_state.keys(): # Initialize the chat engine
+    #chat engine goes into the session to retain history. when the retriever
+    #settings change only the chat engine is rebuilt, keeping the conversation
+    config = (months, topk, budget)
+    if "chat_engine" not in st.session_state.keys() or config != st.session_state.config: # Initialize the chat engine
         retriever_args = {"similarity_top_k" : int(topk)}
         if months > 0:
             end_dt = datetime.now()
             start_dt = end_dt - timedelta(weeks=4*months)
             retriever_args["vector_store_kwargs"] = ({"start_date": start_dt, "end_date":end_dt})
-        st.session_state.chat_engine = get_auto_retriever(index, retriever_args)
+        postprocessor = TokenBudgetPostprocessor(budget=budget)
+        chat_history = st.session_state.chat_engine.chat_history if "chat_engine" in st.session_state.keys() else None
+        st.session_state.chat_engine = get_auto_retriever(index, retriever_args, [postprocessor], chat_history)
+        st.session_state.config = config
         #st.session_state.chat_engine = index.as_chat_engine(chat_mode="best", similarity_top_k=20, verbose=True)
 
     if prompt := st.chat_input("Your question"): # Prompt for user input and save to chat history
@@ -172,11 +182,28 @@ def tm_demo():
     if st.session_state.messages[-1]["role"] != "assistant":
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
-                response = st.session_state.chat_engine.chat(prompt, function_call="query_engine_tool")
-                st.write(response.response)
-                message = {"role": "assistant", "content": response.response}
+                # only the first question of a chat is answered from the cache, since
+                # later answers depend on the rest of the conversation
+                first_question = len(st.session_state.messages) == 2
+                answer = None
+                if first_question:
+                    filters = {"months": months, "topk": topk, "budget": budget, "model": "gpt-4"}
+                    embedding = service_context.embed_model.get_query_embedding(prompt)
+                    answer = cached_answer(repos[repo], filters, embedding)
+                if answer is None:
+                    answer = st.session_state.chat_engine.chat(prompt, function_call="query_engine_tool").response
+                    if first_question:
+                        store_answer(repos[repo], filters, prompt, embedding, answer)
+                else:
+                    remember_exchange(st.session_state.chat_engine, prompt, answer)
+                st.write(answer)
+                message = {"role": "assistant", "content": answer}
                 st.session_state.messages.append(message) # Add response to message history
 
+    st.sidebar.caption(query_embedding_cache_info())
+    st.sidebar.caption(context_packing_info())
+    st.sidebar.caption(answer_cache_info())
+
 st.set_page_config(page_title="Time machine demo", page_icon="🧑‍💼")
 st.markdown("# Time Machine")
 st.sidebar.header("Welcome to the Time Machine")
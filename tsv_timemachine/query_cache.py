@@ -0,0 +1,51 @@
+# Copyright (c) Timescale, Inc. (2023)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+
+import streamlit as st
+
+from llama_index.embeddings import OpenAIEmbedding
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+# Process-wide hit/miss counters, shared by every session on this server
+@st.cache_resource
+def query_embedding_stats():
+    return {"calls": 0, "misses": 0}
+
+# Query embeddings keyed by (model, normalized text). Streamlit keeps them in
+# memory and, with persist="disk", on disk so they survive restarts. The body
+# only runs on a cache miss, and embeds the query as it was asked: arguments
+# starting with an underscore aren't part of the key.
+@st.cache_data(persist="disk", max_entries=10000, show_spinner=False)
+def cached_query_embedding(model_name: str, key: str, _query: str, _embed_model: OpenAIEmbedding) -> List[float]:
+    query_embedding_stats()["misses"] += 1
+    return OpenAIEmbedding._get_query_embedding(_embed_model, _query)
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """OpenAIEmbedding that caches query embeddings across reruns and sessions."""
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        query_embedding_stats()["calls"] += 1
+        return cached_query_embedding(self.model_name, normalize(query), query, self)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+def query_embedding_cache_info() -> str:
+    stats = query_embedding_stats()
+    return f"Query embedding cache: {stats['calls'] - stats['misses']} hits, {stats['misses']} misses"
@@ -3,10 +3,22 @@ import os
 import csv
 import json
 from pathlib import Path
+from typing import Iterable, Iterator
 from dotenv import load_dotenv, find_dotenv
 import openai
 import psycopg2
 import click
+import numpy as np
+from embedder import Embedder
+from bulk_load import copy_records, Throughput
+from embedded_cache import CacheWriter, cache_exists, read_embedded_cache, write_embedded_cache
+from incremental import changed_records, create_hash_table, table_exists, upsert_records
+from pipeline import Pipeline
+from answer_cache import bump_corpus_version
+from quantized import MODES, add_quantized_column
+from text_search import CONFIG, create_text_search_index
+from filter_columns import add_filter_columns
+from chunk_search import STATS_TABLE, create_stats_table, update_chunk_stats
 
 
 # In the this script, we will generate embeddings for the git commits using 
@@ -29,29 +41,42 @@ import click
 # │   379 │ Mats Kindahl         │ 2023-01-16 08:24:32 │ 8f4fa8e4cca73f11d3…  │ Add build matrix t…  │ Build matrix is missing from the ignore workflows for the Windows and Linux builds, so this commit adds them.   │
 # └───────┴──────────────────────┴─────────────────────┴──────────────────────┴──────────────────────┴─────────────────────────────────────────────────────────────────────────────────────────────────────────────────┘
 #
-# We will use OpenAI to generate embeddings for each CSV record.
+# We will use OpenAI to generate embeddings for each CSV record. Records are sent
+# to OpenAI in batches, with several batches in flight at once (see embedder.py).
 #
 # Then, we will load this data into a postgres table, convert it to a hypertable,
-# and build a vector index on the embeddings.
+# and build a vector index on the embeddings. The rows are streamed into the table
+# with a binary COPY rather than one INSERT per row (see bulk_load.py).
 #
 # The table will look like this:
 #
 #                       Table "public.commit_history"
-# ┌───────────┬──────────────────────────┬───────────┬──────────┬─────────┐
-# │  Column   │           Type           │ Collation │ Nullable │ Default │
-# ├───────────┼──────────────────────────┼───────────┼──────────┼─────────┤
-# │ id        │ integer                  │           │          │         │
-# │ date      │ timestamp with time zone │           │ not null │         │
-# │ metadata  │ jsonb                    │           │          │         │
-# │ content   │ text                     │           │          │         │
-# │ embedding │ vector(1536)             │           │          │         │
-# └───────────┴──────────────────────────┴───────────┴──────────┴─────────┘
+# ┌───────────┬──────────────────────────┬───────────┬──────────┬──────────────────────────────────────────────────────────┐
+# │  Column   │           Type           │ Collation │ Nullable │                         Default                          │
+# ├───────────┼──────────────────────────┼───────────┼──────────┼──────────────────────────────────────────────────────────┤
+# │ id        │ integer                  │           │          │                                                          │
+# │ date      │ timestamp with time zone │           │ not null │                                                          │
+# │ metadata  │ jsonb                    │           │          │                                                          │
+# │ content   │ text                     │           │          │                                                          │
+# │ embedding │ vector(1536)             │           │          │                                                          │
+# │ author    │ text                     │           │          │ generated always as (metadata ->> 'author'::text) stored │
+# │ commit    │ text                     │           │          │ generated always as (metadata ->> 'commit'::text) stored │
+# │ content_… │ tsvector                 │           │          │ generated always as (to_tsvector('english'::regconfig, … │
+# └───────────┴──────────────────────────┴───────────┴──────────┴──────────────────────────────────────────────────────────┘
 # Indexes:
+#     "commit_history_author_date_idx" btree (author, date DESC)
+#     "commit_history_commit_idx" btree (commit)
+#     "commit_history_content_tsv_idx" gin (content_tsv)
 #     "commit_history_date_idx" btree (date DESC)
 #     "commit_history_embedding_idx" tsv (embedding)
+#     "commit_history_id_idx" btree (id)
 # Triggers:
 #     ts_insert_blocker BEFORE INSERT ON commit_history FOR EACH ROW EXECUTE FUNCTION _timescaledb_functions.insert_blocker()
 # Number of child tables: 94 (Use \d+ to list them.)
+#
+# With --quantize, a compact copy of the embeddings is added as another generated
+# column with its own index (see quantized.py). The incremental refresh keeps it up
+# to date, since the database computes it from the embedding.
 
 
 _ = load_dotenv(find_dotenv())
@@ -61,10 +86,8 @@ openai.api_key  = os.environ['OPENAI_API_KEY']
 client = openai.OpenAI()
 
 
-def read_csv(path="commit_history.csv"):
-    records: list[dict] = []
+def iter_csv(path="commit_history.csv") -> Iterator[dict]:
     with open(path) as f:
-        r = csv.reader(f)
         r = csv.DictReader(f, fieldnames=["id", "author", "date", "commit", "summary", "details"])
         for row in r:
             # we'll have a jsonb column in the database containing objects with these keys
@@ -77,41 +100,41 @@ def read_csv(path="commit_history.csv"):
             })
             # concatenate multiple fields to be our content
             content = " ".join([row["author"], row["date"], row["commit"], row["summary"], row["details"]])
-            records.append({
+            yield {
                 "id": row["id"],
                 "date": row["date"],
                 "metadata": metadata,
                 "content": content,
-            })
-    return records
+            }
 
 
-def embed(records: list[dict]):
-    with click.progressbar(records, label="embedding...", show_eta=False, show_pos=True) as bar:
-        for record in bar:
-            content = record["content"]
-            content = content.replace("\n", " ")
-            # ask openai for a vector representation of the content
-            embedding = client.embeddings.create(input = [content], model="text-embedding-3-small").data[0].embedding
-            record["embedding"] = embedding
+def read_csv(path="commit_history.csv") -> list[dict]:
+    return list(iter_csv(path))
 
 
-def write_embedded_csv(records: list[dict], path="commit_history_embedded.csv"):
-    with open(path, mode="w") as f:
-        w = csv.DictWriter(f,fieldnames=["id", "date", "metadata", "content", "embedding"])
-        w.writerows(records)
+def embed(records: list[dict]):
+    # ask openai for vector representations of the content. the embedder packs
+    # many records into each request and keeps several requests in flight
+    embedder = Embedder(client)
+    pairs = embedder.embed_items(records, lambda record: record["content"])
+    with click.progressbar(pairs, length=len(records), label="embedding...", show_eta=False, show_pos=True) as bar:
+        for record, embedding in bar:
+            record["embedding"] = embedding
 
 
 def read_embedded_csv(path="commit_history_embedded.csv") -> list[dict]:
+    # older versions of this script cached the embeddings in a csv file. we only
+    # read it to convert it to the new cache format
     records: list[dict] = []
     with open(path) as f:
         r = csv.DictReader(f, fieldnames=["id", "date", "metadata", "content", "embedding"])
         for row in r:
+            row["embedding"] = json.loads(row["embedding"])
             records.append(row)
     return records
 
 
-def load_db(records: list[dict]) -> None:
+def load_db(records: Iterable[dict], batch_size=10_000, defer_index=True, analyze=True, progress=True, quantize: str | None = None) -> None:
     with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
         with con.cursor() as cur:
             # create the extensions
@@ -121,43 +144,159 @@ def load_db(records: list[dict]) -> None:
             # create the hypertable
             print("creating hypertable...")
             cur.execute("drop table if exists commit_history")
-            cur.execute("""
+            cur.execute(f"""
                 create table commit_history
                 ( id int
                 , "date" timestamptz
                 , metadata jsonb
                 , content text             -- the content that was embedded
                 , embedding vector(1536)   -- vector type from pgvector extension stores the embedding
+                -- the metadata keys we filter on most, promoted to typed columns so they can be indexed
+                , author text generated always as (metadata->>'author') stored
+                , "commit" text generated always as (metadata->>'commit') stored
+                -- the content parsed for full-text search, used by the hybrid search (see text_search.py)
+                , content_tsv tsvector generated always as (to_tsvector('{CONFIG}', coalesce(content, ''))) stored
                 )
                 """)
             # transform the plain table into a hypertable. this functionality is from the timescaledb extension
             cur.execute("select create_hypertable('commit_history', by_range('date', interval '1 month'))")
-            # insert the records into the hypertable
-            with click.progressbar(records, label="inserting...", show_eta=False, show_pos=True) as bar:
-                for record in bar:
-                    cur.execute("""
-                        insert into commit_history (id, date, metadata, content, embedding)
-                        values (%(id)s, %(date)s, %(metadata)s, %(content)s, %(embedding)s)
-                        """, record)
+            if not defer_index:
+                # maintaining the index while loading is much slower than building it once afterwards
+                print("creating vector index...")
+                cur.execute("create index on commit_history using tsv (embedding)")
             con.commit()
-            print("creating vector index...")
-            # create a tsv index on our vector data. this index type is from the timescale_vector extension
-            cur.execute("create index on commit_history using tsv (embedding)")
+        # stream the records into the hypertable using binary COPY, committing every batch_size rows
+        throughput = Throughput()
+        if progress:
+            length = len(records) if hasattr(records, "__len__") else None
+            with click.progressbar(length=length, label="inserting...", show_eta=False, show_pos=True) as bar:
+                def update(rows: int):
+                    throughput.update(rows)
+                    bar.update(rows)
+                copy_records(con, records, batch_size=batch_size, progress=update)
+        else:
+            copy_records(con, records, batch_size=batch_size, progress=throughput.update)
+        print(f"inserted {throughput}")
+        with con.cursor() as cur:
+            if defer_index:
+                print("creating vector index...")
+                # create a tsv index on our vector data. this index type is from the timescale_vector extension
+                cur.execute("create index on commit_history using tsv (embedding)")
+            # index the metadata filters used by the search scripts
+            cur.execute('create index on commit_history (author, "date" desc)')
+            cur.execute('create index on commit_history ("commit")')
+            # and the full-text search column
+            create_text_search_index(cur)
+            # index the ids and record a hash of each row's content for incremental refreshes
+            cur.execute("create index on commit_history (id)")
+            if quantize is not None:
+                # a compact copy of the embeddings with its own index (see quantized.py)
+                print(f"creating {quantize} column and index...")
+                add_quantized_column(cur, quantize)
+            create_hash_table(cur)
+            # the statistics of each chunk used by chunk_search.py. those of the old chunks no longer apply
+            print("computing chunk statistics...")
+            create_stats_table(cur)
+            cur.execute(f"truncate {STATS_TABLE}")
+            update_chunk_stats(cur)
+            # answers cached by 4_rag.py were built from the old commits
+            bump_corpus_version(cur)
             con.commit()
+            if analyze:
+                # refresh the planner's statistics now that the table is populated
+                cur.execute("analyze commit_history")
+                con.commit()
 
 
-if __name__ == "__main__":
+def embed_and_load(path="commit_history.csv", concurrency=8, queue_size=8, quantize: str | None = None) -> None:
+    # read and embed the records as a pipeline of concurrent stages joined by
+    # bounded queues, writing them to the embedded cache as they come. only a few
+    # batches of records are ever held in memory at once:
+    #
+    #   read + batch ──queue──▶ embed (concurrency threads) ──queue──▶ cache
+    #
+    # the database is only touched once every record is embedded and cached. an
+    # OpenAI error or Ctrl-C partway through leaves both the table and the old
+    # cache as they were
+    embedder = Embedder(client, concurrency=concurrency)
+
+    def embed_batch(batch: list[tuple[dict, str]]) -> list[dict]:
+        embeddings = embedder.embed_batch([content for _, content in batch])
+        for (record, _), embedding in zip(batch, embeddings):
+            # float32 arrays take 6 KB per embedding rather than ~50 KB of python floats
+            record["embedding"] = np.asarray(embedding, dtype=np.float32)
+        return [record for record, _ in batch]
+
+    pipeline = (
+        Pipeline(embedder.batches(iter_csv(path), lambda record: record["content"]), "read", queue_size)
+        .stage("embed", embed_batch, workers=concurrency)
+        .sink("cache"))
+    pipeline.monitor(click.echo)
+    with CacheWriter() as cache:
+        for batch in pipeline:
+            for record in batch:
+                cache.write(record)
+    click.echo(pipeline.report())
+    # the vectors are memory-mapped from the cache and streamed to the database
+    load_db(read_embedded_cache(), quantize=quantize)
+
+
+def refresh_db(records: list[dict], batch_size=1000) -> None:
+    # embed and load only the records that are new or changed since the last load
+    with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
+        with con.cursor() as cur:
+            # a table loaded before author and commit had their own columns gets them now
+            add_filter_columns(cur)
+        con.commit()
+        changed = list(changed_records(con, records))
+        print(f"{len(changed)} of {len(records)} commits are new or changed")
+        embed(changed)
+        throughput = Throughput()
+        with click.progressbar(length=len(changed), label="upserting...", show_eta=False, show_pos=True) as bar:
+            def progress(rows: int):
+                throughput.update(rows)
+                bar.update(rows)
+            upsert_records(con, changed, batch_size=batch_size, progress=progress)
+        print(f"upserted {throughput}")
+        with con.cursor() as cur:
+            # the statistics of the chunks that changed, for chunk_search.py
+            if changed:
+                create_stats_table(cur)
+                update_chunk_stats(cur, min(r["date"] for r in changed), max(r["date"] for r in changed))
+            # and the answers cached by 4_rag.py may be out of date
+            bump_corpus_version(cur)
+        con.commit()
+
+
+@click.command()
+@click.option("--incremental", is_flag=True, help="Only embed and load commits that are new or changed.")
+@click.option("--quantize", type=click.Choice(list(MODES)), default=None, help="Also store a compact copy of the embeddings and index it (see quantized.py).")
+def main(incremental: bool, quantize: str | None):
+    if incremental:
+        with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
+            incremental = table_exists(con)
+        if not incremental:
+            print("commit_history has not been loaded yet. doing a full load")
+    if incremental:
+        print("reading commit_history.csv")
+        refresh_db(read_csv())
+        print("done")
+        return
+    if not cache_exists() and Path("commit_history_embedded.csv").exists():
+        print("converting commit_history_embedded.csv")
+        write_embedded_cache(read_embedded_csv())
     gen_embeddings = True
-    if Path("commit_history_embedded.csv").exists():
+    if cache_exists():
         gen_embeddings = click.confirm("regenerate embeddings?")
     if gen_embeddings:
-        print("reading commit_history.csv")
-        records = read_csv()
-        embed(records)
-        write_embedded_csv(records)
+        print("embedding commit_history.csv and loading database...")
+        embed_and_load(quantize=quantize)
     else:
-        records = read_embedded_csv()
-    print("loading database...")
-    load_db(records)
+        # the vectors are memory-mapped from the cache and streamed to the database
+        print("loading database...")
+        load_db(read_embedded_cache(), quantize=quantize)
     print("done")
 
+
+if __name__ == "__main__":
+    main()
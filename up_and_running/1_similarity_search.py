@@ -3,9 +3,8 @@ import os
 from dotenv import load_dotenv, find_dotenv
 from datetime import datetime
 import openai
-import psycopg2
-from psycopg2.extras import DictCursor
 import click
+from search import CommitSearch
 from rich.console import Console
 from rich.table import Table
 
@@ -17,6 +16,9 @@ from rich.table import Table
 # using OpenAI, and then uses a single SQL query to find the 5 git commits most
 # semantically relevant to the user's question.
 #
+# The query runs on a connection from a pool that is shared by all searches, so
+# only the first question pays for connecting to the database (see search.py).
+#
 # If you need a good question to ask, try this:
 # > describe how changes to decompression have improved performance
 
@@ -27,30 +29,21 @@ TIMESCALE_SERVICE_URL = os.environ["TIMESCALE_SERVICE_URL"]
 
 openai.api_key  = os.environ['OPENAI_API_KEY']
 client = openai.OpenAI()
+search = CommitSearch(TIMESCALE_SERVICE_URL, client)
 
 
 def similarity_search(question: str, k=5) -> list[dict]:
     # turn the question into an embedding/vector using the openai client
-    embedding = client.embeddings.create(input = [question], model="text-embedding-3-small").data[0].embedding
-    matches = []
-    # connect to the database and search for relevant commits
-    with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
-        with con.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(f"""
-                select
-                  "date"
-                , metadata->>'author' as author
-                , metadata->>'commit' as "commit"
-                , metadata->>'summary' as summary
-                , metadata->>'details' as details
-                , content
-                from commit_history 
-                order by embedding <=> %s::vector   -- order by semantic similarity
-                limit %s                            -- only return the k most similar
-                """, (embedding, k))
-            for row in cur.fetchall():
-                matches.append({k:v for k, v in row.items()})
-    return matches
+    embedding = search.embed(question)
+    # search for relevant commits using a pooled database connection. the query
+    # (in search.py) orders the commits by semantic similarity and returns the k
+    # most similar:
+    #
+    #   select "date", author, "commit", ..., content
+    #   from commit_history
+    #   order by embedding <=> $1   -- order by semantic similarity
+    #   limit $2                    -- only return the k most similar
+    return search.search(embedding, k)
 
 
 def print_results(matches: list[dict]) -> None:
@@ -81,4 +74,5 @@ if __name__ == "__main__":
         click.echo("\n\n")
         if not click.confirm('Do you want to continue?'):
             break
+    click.echo(search.cache)
 
@@ -3,9 +3,8 @@ import os
 from datetime import datetime
 from dotenv import load_dotenv, find_dotenv
 import openai
-import psycopg2
-from psycopg2.extras import DictCursor
 import click
+from search import CommitSearch
 from rich.console import Console
 from rich.table import Table
 
@@ -24,32 +23,25 @@ TIMESCALE_SERVICE_URL = os.environ["TIMESCALE_SERVICE_URL"]
 
 openai.api_key  = os.environ['OPENAI_API_KEY']
 client = openai.OpenAI()
+search = CommitSearch(TIMESCALE_SERVICE_URL, client)
 
 
 def similarity_search(question: str, since: datetime, author: str, k=5) -> list[dict]:
     # turn the question into an embedding/vector using the openai client
-    embedding = client.embeddings.create(input = [question], model="text-embedding-3-small").data[0].embedding
-    matches = []
-    # connect to the database and search for relevant commits while filtering on time and author
-    with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
-        with con.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(f"""
-                select 
-                  "date"
-                , metadata->>'author' as author
-                , metadata->>'commit' as "commit"
-                , metadata->>'summary' as summary
-                , metadata->>'details' as details
-                , content
-                from commit_history 
-                where "date" >= %s::timestamptz                   -- time based filtering
-                and metadata @> jsonb_build_object('author', %s)  -- metadata filtering
-                order by embedding <=> %s::vector                 -- order by semantic similarity
-                limit %s                                          -- only return the k most similar
-                """, (since, author, embedding, k))
-            for row in cur.fetchall():
-                matches.append({k:v for k, v in row.items()})
-    return matches
+    embedding = search.embed(question)
+    # search for relevant commits while filtering on time and author. the author
+    # is a typed, indexed column generated from the metadata:
+    #
+    #   select "date", author, "commit", ..., content
+    #   from commit_history
+    #   where "date" >= $1::timestamptz   -- time based filtering
+    #   and author = $2                   -- metadata filtering
+    #   order by embedding <=> $3         -- order by semantic similarity
+    #   limit $4                          -- only return the k most similar
+    #
+    # depending on how many commits the author has, search.py either searches
+    # their commits exactly or filters the results of the vector index
+    return search.search(embedding, k, since=since, author=author)
 
 
 def print_results(matches: list[dict]) -> None:
@@ -83,4 +75,5 @@ if __name__ == "__main__":
         click.echo("\n\n")
         if not click.confirm('Do you want to continue?'):
             break
+    click.echo(search.cache)
 
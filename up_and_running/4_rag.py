@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 from dotenv import load_dotenv, find_dotenv
 import openai
-import psycopg2
 import click
+from psycopg_pool import PoolTimeout
+from search import AUTO, QUANTIZATION_CHOICES, CommitSearch
+from context_packer import ContextPacker
+from answer_cache import AnswerCache
 
 
 # This script uses the prior work to demonstrate retrieval-augmented generation. 
@@ -13,6 +18,28 @@ import click
 # context -- the relevant commits' information. This prompt is presented to an 
 # LLM which generates a text response that we display to the user.
 #
+# The response is streamed: tokens are printed as they arrive, so the wait users
+# notice is the time to the first token rather than the time to the whole answer.
+# As soon as the question is entered it starts being embedded in the background,
+# while we wait for the connection pool to be ready. That only saves time on the
+# first question: the pool is ready by the time later questions are asked, and a
+# question can't be embedded before it is typed. After each answer the time
+# spent in each phase is printed. Use --no-stream to wait for the whole answer.
+#
+# The matching commits are packed into the prompt by context_packer.py, which
+# skips duplicate commits, truncates long commit messages and stops adding
+# commits at a token budget, so retrieving more commits (-k) can't overflow the
+# prompt.
+#
+# Answers are cached in the database by answer_cache.py. When a question means
+# the same as one answered before with the same settings, against the same
+# version of commit_history, the stored answer is returned without asking the
+# LLM again.
+#
+# With --hybrid, commits are also matched by the words of the question (see
+# search.py), so questions naming a function, a setting or a commit hash find
+# the commits that mention it at a small k.
+#
 # If you need a good question to ask, try this:
 # > describe how changes to decompression have improved performance
 
@@ -23,29 +50,14 @@ TIMESCALE_SERVICE_URL = os.environ["TIMESCALE_SERVICE_URL"]
 
 openai.api_key  = os.environ['OPENAI_API_KEY']
 client = openai.OpenAI()
+search = CommitSearch(TIMESCALE_SERVICE_URL, client)
+packer = ContextPacker()
+answers = AnswerCache(search.pool)
 
 
-def similarity_search(question: str, k=5) -> list[str]:
-    # turn the question into an embedding/vector using the openai client
-    embedding = client.embeddings.create(input = [question], model="text-embedding-3-small").data[0].embedding
-    matches = []
-    # connect to the database and search for relevant commits while filtering on time and author
-    with psycopg2.connect(TIMESCALE_SERVICE_URL) as con:
-        with con.cursor() as cur:
-            cur.execute("""
-                select content
-                from commit_history
-                order by embedding <=> %s::vector   -- order by semantic similarity
-                limit %s                            -- only return the k most similar
-                """, (embedding, k))
-            for row in cur.fetchall():
-                matches.append(row[0])
-    return matches
-
-
-def generate_response(question: str, matches: list[str]) -> str:
-    # construct a prompt
-    matches = "\n* ".join(matches)
+def build_messages(question: str, matches: list[dict]) -> list[dict]:
+    # construct a prompt, fitting as many of the matches as the token budget allows
+    matches = "\n* ".join(packer.pack(matches))
     prompt = f"""
     Use the git commit records from the timescaledb git repository to answer the subseqent question.
     Do not describe the commits individually. Provide an overall summary to address the question.
@@ -55,15 +67,19 @@ def generate_response(question: str, matches: list[str]) -> str:
 
     Question: {question}
     """
+    return [
+        {
+            'role': 'system', 
+            'content': 'You answer questions about the git commit history for the timescaledb repository.'
+        },
+        {'role': 'user', 'content': prompt},
+    ]
+
+
+def generate_response(question: str, matches: list[dict]) -> str:
     # ask the GPT to respond to the prompt
     response = client.chat.completions.create(
-        messages=[
-            {
-                'role': 'system', 
-                'content': 'You answer questions about the git commit history for the timescaledb repository.'
-            },
-            {'role': 'user', 'content': prompt},
-        ],
+        messages=build_messages(question, matches),
         model="gpt-3.5-turbo",
         temperature=0,
     )
@@ -71,21 +87,130 @@ def generate_response(question: str, matches: list[str]) -> str:
     return response.choices[0].message.content
 
 
+def stream_response(messages: list[dict]) -> Iterator[str]:
+    # ask the GPT to respond to the prompt, yielding the response's tokens as they arrive
+    stream = client.chat.completions.create(
+        messages=messages,
+        model="gpt-3.5-turbo",
+        temperature=0,
+        stream=True,
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def answer_settings(k: int, hybrid: bool) -> dict:
+    # everything besides the question that changes the answer, for the answer cache
+    return {"k": k, "hybrid": hybrid, "budget": packer.budget, "model": "gpt-3.5-turbo"}
+
+
+def find_matches(question: str, embedding, k: int, hybrid: bool) -> list[dict]:
+    # search for relevant commits using a pooled database connection (see search.py)
+    if hybrid:
+        return search.hybrid_search(question, embedding, k)
+    return search.search(embedding, k)
+
+
+def similarity_search(question: str, k=5, hybrid=False) -> list[dict]:
+    # turn the question into an embedding/vector using the openai client (or the
+    # embedding cache), then search for the k most relevant commits
+    return find_matches(question, search.embed(question), k, hybrid)
+
+
+def answer(question: str, executor: ThreadPoolExecutor, k=5, hybrid=False) -> dict[str, float]:
+    # answer the question, streaming the response. returns the seconds spent in each phase
+    start = time.perf_counter()
+    timings = {}
+
+    def embed() -> list[float]:
+        embedding = search.embed(question)
+        timings["embed"] = time.perf_counter() - start
+        return embedding
+
+    # start embedding the question right away, and meanwhile wait for the pool's connections
+    embedding = executor.submit(embed)
+    try:
+        search.pool.wait(timeout=search.timeout)
+    except PoolTimeout:
+        pass   # the search falls back to the local embeddings
+    timings["pool"] = time.perf_counter() - start
+    embedding = embedding.result()
+    mark = time.perf_counter()
+    cached = answers.get(embedding, answer_settings(k, hybrid))
+    timings["answer cache"] = time.perf_counter() - mark
+    if cached is not None:
+        click.echo("Found a cached answer.\n")
+        click.echo(cached)
+        timings["last token"] = time.perf_counter() - start
+        return timings
+    mark = time.perf_counter()
+    matches = find_matches(question, embedding, k, hybrid)
+    timings["search"] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    messages = build_messages(question, matches)
+    timings["prompt"] = time.perf_counter() - mark
+    click.echo(f"Found {len(matches)} matches. {packer}\n")
+    tokens = []
+    for token in stream_response(messages):
+        if "first token" not in timings:
+            timings["first token"] = time.perf_counter() - start
+        click.echo(token, nl=False)
+        tokens.append(token)
+    timings["last token"] = time.perf_counter() - start
+    click.echo()
+    answers.put(question, embedding, answer_settings(k, hybrid), "".join(tokens))
+    return timings
+
+
+def format_timings(timings: dict[str, float]) -> str:
+    # pool, embed, first token and last token are measured from when the question was entered
+    return ", ".join(f"{phase} {seconds * 1000:,.0f} ms" for phase, seconds in timings.items())
+
+
+@click.command()
+@click.option("--stream/--no-stream", default=True, help="print the response as it is generated")
+@click.option("-k", default=5, help="number of commits to retrieve")
+@click.option("--budget", default=3000, help="the most tokens of commits to put in the prompt")
+@click.option("--hybrid", is_flag=True, help="also match the words of the question against the commits")
+@click.option("--quantize", type=click.Choice(QUANTIZATION_CHOICES), default=AUTO, help="the compact embeddings to search with, see quantized.py (default: the first one added, if any)")
+def main(stream: bool, k: int, budget: int, hybrid: bool, quantize: str):
+    packer.budget = budget
+    search.quantization = quantize
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            # 1. get the user's question
+            question = click.prompt("Enter your question", type=str)
+            if stream:
+                # 2-4. search, then stream the response to the user as it is generated
+                click.echo("Searching...")
+                timings = answer(question, executor, k, hybrid)
+                click.echo("\n")
+                click.echo(format_timings(timings))
+            else:
+                # 2. do a similarity search for git commits relevant to the question, unless it was answered before
+                click.echo("Searching...")
+                # turn the question into an embedding/vector using the openai client
+                embedding = search.embed(question)
+                response = answers.get(embedding, answer_settings(k, hybrid))
+                if response is None:
+                    matches = similarity_search(question, k, hybrid)
+                    click.echo(f"Found {len(matches)} matches.")
+                    # 3. provide the relevant commits in a prompt and ask the GPT for a response
+                    click.echo("Generating response...")
+                    response = generate_response(question, matches)
+                    click.echo(packer)
+                    answers.put(question, embedding, answer_settings(k, hybrid), response)
+                # 4. display the response to the user
+                click.echo("\n\n")
+                click.echo(response)
+            click.echo("\n\n")
+            # 5. profit!
+            if not click.confirm('Do you want to continue?'):
+                break
+    click.echo(search.cache)
+    click.echo(answers)
+
+
 if __name__ == "__main__":
-    while True:
-        # 1. get the user's question
-        question = click.prompt("Enter your question", type=str)
-        # 2. do a similarity search for git commits relevant to the question
-        click.echo("Searching...")
-        matches = similarity_search(question)
-        click.echo(f"Found {len(matches)} matches.")
-        # 3. provide the relevant commits in a prompt and ask the GPT for a response
-        click.echo("Generating response...")
-        response = generate_response(question, matches)
-        # 4. display the response to the user
-        click.echo("\n\n")
-        click.echo(response)
-        click.echo("\n\n")
-        # 5. profit!
-        if not click.confirm('Do you want to continue?'):
-            break
+    main()
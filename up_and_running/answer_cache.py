@@ -0,0 +1,158 @@
+import json
+from datetime import timedelta
+import numpy as np
+import psycopg
+from psycopg_pool import PoolTimeout
+
+
+# This module caches the answers 4_rag.py gets from the LLM, so asking the same
+# question again, or one that means the same, returns the stored answer without
+# generating it again.
+#
+# Answers are stored in the answer_cache table with the embedding of their
+# question. A question is answered from the cache when the embedding of a
+# cached question is within max_distance of its own, and that question was asked:
+#   - with the same filters (and other settings that change the answer)
+#   - against the same version of the corpus
+#   - less than ttl ago
+#
+# The corpus version of each table is kept in answer_cache_corpus. 0_embed.py
+# bumps it whenever commit_history is loaded or refreshed, so answers built from
+# the old commits are no longer used. (The Time Machine's pages do the same for
+# their tables.)
+#
+# Only the few answers cached for the current corpus version and filters are
+# candidates, so they are found with a btree index and compared exactly, rather
+# than asking a vector index for the nearest questions and filtering afterwards,
+# which could miss a match.
+#
+# The cache counts hits and misses, here and on each entry, so its hit rate is
+# visible. If the database can't be reached, every question is a miss.
+
+
+def create_answer_cache(cur) -> None:
+    cur.execute("""
+        create table if not exists answer_cache_corpus
+        ( table_name text primary key
+        , version bigint not null
+        , updated_at timestamptz not null default now()
+        )
+        """)
+    cur.execute("""
+        create table if not exists answer_cache
+        ( id bigint generated always as identity primary key
+        , table_name text not null
+        , corpus_version bigint not null
+        , filters jsonb not null
+        , question text not null
+        , embedding vector(1536) not null
+        , answer text not null
+        , created_at timestamptz not null default now()
+        , hits bigint not null default 0
+        )
+        """)
+    cur.execute("create index if not exists answer_cache_lookup_idx on answer_cache (table_name, corpus_version, created_at)")
+
+
+def bump_corpus_version(cur, table="commit_history") -> None:
+    # called whenever the table is reloaded, so the answers cached for it are no longer used
+    create_answer_cache(cur)
+    cur.execute("""
+        insert into answer_cache_corpus (table_name, version) values (%s, 1)
+        on conflict (table_name) do update
+        set version = answer_cache_corpus.version + 1, updated_at = now()
+        """, (table,))
+    cur.execute("""
+        delete from answer_cache c
+        using answer_cache_corpus v
+        where c.table_name = v.table_name and c.corpus_version < v.version and v.table_name = %s
+        """, (table,))
+
+
+class AnswerCache:
+    def __init__(self, pool, table="commit_history", max_distance=0.05, ttl=timedelta(days=7), timeout=5.0):
+        self.pool = pool
+        self.table = table
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.timeout = timeout
+        self.created = False
+        self.hits = 0
+        self.misses = 0
+
+    def connection(self):
+        return self.pool.connection(timeout=self.timeout)
+
+    def create(self, con) -> None:
+        # the tables are created the first time the cache is used
+        if not self.created:
+            create_answer_cache(con)
+            self.created = True
+
+    def _params(self, embedding, filters: dict) -> dict:
+        return {
+            "table": self.table,
+            "filters": json.dumps(filters, sort_keys=True, default=str),
+            "embedding": np.asarray(embedding, dtype=np.float32),
+            "ttl": self.ttl,
+        }
+
+    def get(self, embedding, filters: dict) -> str | None:
+        try:
+            row = self._get(embedding, filters)
+        except (psycopg.OperationalError, PoolTimeout):
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row["answer"]
+
+    def _get(self, embedding, filters: dict) -> dict | None:
+        with self.connection() as con:
+            self.create(con)
+            row = con.execute("""
+                with candidates as materialized
+                (
+                    select id, answer, embedding
+                    from answer_cache
+                    where table_name = %(table)s
+                    and corpus_version = coalesce((select version from answer_cache_corpus where table_name = %(table)s), 0)
+                    and created_at > now() - %(ttl)s
+                    and filters = %(filters)s::jsonb
+                )
+                select id, answer, embedding <=> %(embedding)b as distance
+                from candidates
+                order by embedding <=> %(embedding)b
+                limit 1
+                """, self._params(embedding, filters)).fetchone()
+            if row is None or row["distance"] > self.max_distance:
+                return None
+            con.execute("update answer_cache set hits = hits + 1 where id = %s", (row["id"],))
+            return row
+
+    def put(self, question: str, embedding, filters: dict, answer: str) -> None:
+        params = {**self._params(embedding, filters), "question": question, "answer": answer}
+        try:
+            self._put(params)
+        except (psycopg.OperationalError, PoolTimeout):
+            pass   # the answer just isn't cached
+
+    def _put(self, params: dict) -> None:
+        with self.connection() as con:
+            self.create(con)
+            with con.transaction():
+                con.execute("""
+                    insert into answer_cache (table_name, corpus_version, filters, question, embedding, answer)
+                    values (
+                        %(table)s,
+                        coalesce((select version from answer_cache_corpus where table_name = %(table)s), 0),
+                        %(filters)s::jsonb, %(question)s, %(embedding)b, %(answer)s)
+                    """, params)
+                # expired answers are never used again
+                con.execute("delete from answer_cache where table_name = %(table)s and created_at <= now() - %(ttl)s", params)
+
+    def __str__(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"answer cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import os
+import time
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Generic, TypeVar
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import openai
+import click
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from pgvector.psycopg import register_vector_async
+from embedding_cache import EmbeddingCache
+from search import MODEL, QUERY_CACHE_PATH, knn_query
+
+
+# This module is an asyncio version of the similarity search in search.py, for
+# answering many questions concurrently from one process, e.g. behind a web
+# service.
+#
+# Two things make it scale beyond a thread per request:
+#   - questions that arrive at about the same time are embedded together, in a
+#     single request to the OpenAI embeddings API
+#   - kNN queries that arrive at about the same time are sent together on one
+#     connection using psycopg's pipeline mode, so they cost one network round
+#     trip rather than one each
+#
+# Both are done by a MicroBatcher: callers await a result for their own item,
+# and behind the scenes items are collected for up to max_wait seconds (or until
+# max_batch items are waiting) and then processed as one batch.
+#
+# The embedding cache reads and writes a sqlite file, so it is used from a
+# worker thread (asyncio.to_thread) rather than blocking the event loop and every
+# question in flight with it.
+#
+# Running this file directly answers a file of questions concurrently and
+# reports the throughput:
+#
+#   ./async_search.py questions.txt --concurrency 64
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    def __init__(self, fn: Callable[[list[T]], Awaitable[list[R]]], max_batch=256, max_wait=0.005):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending: list[tuple[T, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: T) -> R:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            # hold on to the task so it isn't garbage collected while running
+            task = asyncio.create_task(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch: list[tuple[T, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"expected {len(batch)} results, got {len(results)}")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        except BaseException:
+            # cancelled, e.g. the loop is shutting down, or interrupted. the callers
+            # would otherwise wait forever for their results
+            for _, future in batch:
+                future.cancel()
+            raise
+
+
+class AsyncCommitSearch:
+    def __init__(
+        self,
+        service_url: str,
+        client: openai.AsyncOpenAI | None = None,
+        cache: EmbeddingCache | None = None,
+        min_size=1,
+        max_size=4,
+        max_wait=0.005,
+    ):
+        self.client = client or openai.AsyncOpenAI()
+        self.cache = cache if cache is not None else EmbeddingCache(path=QUERY_CACHE_PATH)
+        self.pool = AsyncConnectionPool(
+            service_url,
+            min_size=min_size,
+            max_size=max_size,
+            kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+            configure=register_vector_async,
+            open=False,
+        )
+        self.embedder = MicroBatcher(self._embed_batch, max_batch=256, max_wait=max_wait)
+        self.searcher = MicroBatcher(self._search_batch, max_batch=64, max_wait=max_wait)
+
+    async def __aenter__(self) -> "AsyncCommitSearch":
+        await self.pool.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.pool.close()
+
+    async def _embed_batch(self, questions: list[str]) -> list[np.ndarray]:
+        # the same question may be asked several times in one batch. embed it once
+        unique = list(dict.fromkeys(questions))
+        response = await self.client.embeddings.create(input=unique, model=MODEL)
+        items = [(unique[d.index], d.embedding) for d in response.data]
+        stored = await asyncio.to_thread(self.cache.put_many, MODEL, items)
+        embeddings = {question: embedding for (question, _), embedding in zip(items, stored)}
+        return [embeddings[q] for q in questions]
+
+    async def _search_batch(self, queries: list[tuple[str, dict]]) -> list[list[dict]]:
+        # send all the queries before waiting for any of their results
+        async with self.pool.connection() as con:
+            async with con.pipeline():
+                cursors = [await con.execute(query, params) for query, params in queries]
+                return [await cur.fetchall() for cur in cursors]
+
+    async def embed(self, question: str) -> np.ndarray:
+        embedding = await asyncio.to_thread(self.cache.get, MODEL, question)
+        if embedding is None:
+            embedding = await self.embedder.submit(question)
+        return embedding
+
+    async def search(self, embedding: np.ndarray, k=5, since: datetime | None = None, author: str | None = None) -> list[dict]:
+        params = {"embedding": np.asarray(embedding, dtype=np.float32), "k": k, "since": since, "author": author}
+        return await self.searcher.submit((knn_query(since is not None, author is not None), params))
+
+    async def similarity_search(self, question: str, k=5, since: datetime | None = None, author: str | None = None) -> list[dict]:
+        return await self.search(await self.embed(question), k, since, author)
+
+
+async def answer_all(service_url: str, questions: list[str], concurrency: int, k: int) -> None:
+    if not questions:
+        click.echo("no questions to answer")
+        return
+    async with AsyncCommitSearch(service_url, max_size=max(1, concurrency // 16)) as search:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def answer(question: str) -> list[dict]:
+            async with semaphore:
+                start = time.perf_counter()
+                matches = await search.similarity_search(question, k)
+                latencies.append(time.perf_counter() - start)
+                return matches
+
+        start = time.perf_counter()
+        await asyncio.gather(*(answer(q) for q in questions))
+        duration = time.perf_counter() - start
+    latencies.sort()
+    click.echo(f"answered {len(questions)} questions in {duration:.2f}s ({len(questions) / duration:,.1f} questions/s)")
+    click.echo(f"latency p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms")
+    click.echo(f"{search.embedder.items} embeddings in {search.embedder.batches} requests, "
+               f"{search.searcher.items} queries in {search.searcher.batches} round trips")
+    click.echo(search.cache)
+
+
+@click.command()
+@click.argument("questions", type=click.File())
+@click.option("--concurrency", default=64, help="number of questions in flight at once")
+@click.option("-k", default=5, help="number of matches per question")
+def main(questions, concurrency, k):
+    _ = load_dotenv(find_dotenv())
+    questions = [q.strip() for q in questions if q.strip()]
+    asyncio.run(answer_all(os.environ["TIMESCALE_SERVICE_URL"], questions, concurrency, k))
+
+
+if __name__ == "__main__":
+    main()
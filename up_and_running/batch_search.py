@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import itertools
+from datetime import datetime
+from typing import Iterator
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import openai
+import psycopg
+import click
+from psycopg.rows import dict_row
+from pgvector.psycopg import register_vector
+from embedder import Embedder
+from search import ANN_OVERSAMPLE, AUTO, QUANTIZATION_CHOICES, knn_query, quantized_query, resolve_quantization
+
+
+# This script runs the similarity search from 2_similarity_search_with_time.py
+# (and 3_similarity_search_with_time_and_author.py) over a whole file of
+# questions, for offline evaluation jobs.
+#
+# The questions file has one json object per line. `since` (YYYY-MM-DD) and
+# `author` are optional:
+#
+#   {"question": "describe how changes to decompression have improved performance", "since": "2023-01-01"}
+#   {"question": "what did this author work on?", "author": "Sven Klemm"}
+#
+# A line that isn't json is taken to be a question with no filters.
+#
+# Rather than handling the questions one at a time, the questions are embedded in
+# large batches with several requests in flight (see embedder.py), and the kNN
+# queries are sent to the database in groups using psycopg's pipeline mode: a
+# whole group of queries is sent on one connection before waiting for any of
+# the results. Results are written as json lines, in the same order as the
+# questions, as soon as each group completes:
+#
+#   ./batch_search.py questions.jsonl -o results.jsonl
+#
+# Like 4_rag.py, it searches the quantized embeddings when quantized.py has
+# added them (see --quantize).
+
+
+_ = load_dotenv(find_dotenv())
+
+TIMESCALE_SERVICE_URL = os.environ["TIMESCALE_SERVICE_URL"]
+
+openai.api_key  = os.environ['OPENAI_API_KEY']
+client = openai.OpenAI()
+
+
+def read_questions(f) -> Iterator[dict]:
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            question = json.loads(line)
+        except json.JSONDecodeError:
+            question = {"question": line}
+        if question.get("since"):
+            question["since"] = datetime.strptime(question["since"], "%Y-%m-%d")
+        yield question
+
+
+def search_group(con, group: list[tuple[dict, list[float]]], k: int, mode: str | None = None) -> list[list[dict]]:
+    # send every query in the group before waiting for any of the results. with a
+    # quantization mode, the questions without an author filter search the
+    # compact embeddings and re-rank the candidates, as CommitSearch does
+    with con.pipeline():
+        cursors = []
+        for question, embedding in group:
+            since, author = question.get("since"), question.get("author")
+            params = {"embedding": np.asarray(embedding, dtype=np.float32), "k": k, "since": since, "author": author}
+            if mode is not None and author is None:
+                query = quantized_query(mode, since is not None)
+                params["candidates"] = k * ANN_OVERSAMPLE
+            else:
+                query = knn_query(since is not None, author is not None)
+            cursors.append(con.execute(query, params))
+        return [cur.fetchall() for cur in cursors]
+
+
+@click.command()
+@click.argument("questions", type=click.File())
+@click.option("-o", "--output", type=click.File("w"), default="-", help="where to write the results (default stdout)")
+@click.option("-k", default=5, help="number of matches per question")
+@click.option("--group-size", default=100, help="number of queries sent to the database at once")
+@click.option("--concurrency", default=8, help="number of embedding requests in flight")
+@click.option("--quantize", type=click.Choice(QUANTIZATION_CHOICES), default=AUTO, help="the compact embeddings to search with, see quantized.py (default: the first one added, if any)")
+def main(questions, output, k, group_size, concurrency, quantize):
+    embedder = Embedder(client, concurrency=concurrency)
+    embedded = embedder.embed_items(read_questions(questions), lambda q: q["question"])
+    count = 0
+    start = time.perf_counter()
+    with psycopg.connect(TIMESCALE_SERVICE_URL, autocommit=True, prepare_threshold=0, row_factory=dict_row) as con:
+        register_vector(con)
+        mode = resolve_quantization(con, quantize)
+        while group := list(itertools.islice(embedded, group_size)):
+            for (question, _), matches in zip(group, search_group(con, group, k, mode)):
+                if question.get("since"):
+                    question["since"] = question["since"].strftime("%Y-%m-%d")
+                output.write(json.dumps({**question, "matches": matches}, default=str) + "\n")
+            output.flush()
+            count += len(group)
+    duration = time.perf_counter() - start
+    click.echo(f"answered {count} questions in {duration:.1f}s ({count / duration * 60:,.0f} questions/minute)", err=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv, find_dotenv
+import click
+from rich.console import Console
+from rich.table import Table
+from search import CommitSearch, COLUMNS, filters
+
+
+# This script benchmarks the similarity search filtered by author (as in
+# 3_similarity_search_with_time_and_author.py) for authors with many, some and
+# few commits.
+#
+# For each author we compare:
+#   - planner: a single query with the author filter, as the script used to
+#     run it. the planner decides whether to use the vector index, and when it
+#     does, other authors' commits are filtered out afterwards
+#   - exact:   the author's commits are found with the (author, date) index and
+#     all of them are compared with the question
+#   - ann:     the vector index is asked for nearest neighbors of any author,
+#     widening the search until k of the author's commits are found
+#   - auto:    what search.py does, picking exact or ann by the author's commit count
+#
+# No questions are sent to OpenAI: the queries are the embeddings of randomly
+# chosen commits. Recall is measured against the exact strategy, and "short"
+# counts the queries that returned fewer than k rows.
+
+
+def planner(con, params: dict) -> list[dict]:
+    return con.execute(f"""
+        select {COLUMNS}
+        from commit_history
+        {filters(params["since"] is not None, True)}
+        order by embedding <=> %(embedding)b
+        limit %(k)s
+        """, params).fetchall()
+
+
+def pick_authors(con, since: datetime | None) -> list[tuple[str, int]]:
+    # the most prolific author, one from the middle, and the least prolific with at least 10 commits
+    authors = con.execute(f"""
+        select author, count(*) as count
+        from commit_history
+        {filters(since is not None, False)}
+        group by author
+        order by count desc
+        """, {"since": since}).fetchall()
+    picks = [authors[0], authors[len(authors) // 2], authors[-1]]
+    for a in authors:
+        if a["count"] >= 10:
+            picks[-1] = a
+    return [(a["author"], a["count"]) for a in picks]
+
+
+@click.command()
+@click.option("--queries", default=50, help="number of queries per author")
+@click.option("-k", default=5, help="number of matches per query")
+@click.option("--since", default=None, help="only search commits since this date (YYYY-MM-DD)")
+def main(queries, k, since):
+    _ = load_dotenv(find_dotenv())
+    since = datetime.strptime(since, "%Y-%m-%d") if since else None
+    search = CommitSearch(os.environ["TIMESCALE_SERVICE_URL"], fallback_path=None)
+    table = Table(title=f"{queries} queries per author, k={k}")
+    for column in ["Author", "Commits", "Strategy", "p50 ms", "p99 ms", "Recall", "Short"]:
+        table.add_column(column, justify="left" if column in ("Author", "Strategy") else "right")
+    with search.pool.connection() as con:
+        embeddings = [r["embedding"] for r in con.execute(
+            "select embedding from commit_history order by random() limit %s", (queries,)).fetchall()]
+        for author, count in pick_authors(con, since):
+            params = [{"embedding": e, "k": k, "since": since, "author": author} for e in embeddings]
+            truth = [{m["commit"] for m in search.search_author(con, p, "exact")[0]} for p in params]
+            strategies = {
+                "planner": lambda p: (planner(con, p), "planner"),
+                "exact": lambda p: search.search_author(con, p, "exact"),
+                "ann": lambda p: search.search_author(con, p, "ann"),
+                "auto": lambda p: search.search_author(con, p, "auto"),
+            }
+            for name, fn in strategies.items():
+                latencies = []
+                found = expected = short = 0
+                used = set()
+                for i, p in enumerate(params):
+                    start = time.perf_counter()
+                    matches, strategy = fn(p)
+                    latencies.append(time.perf_counter() - start)
+                    used.add(strategy.split(" ")[0])
+                    found += len(truth[i] & {m["commit"] for m in matches})
+                    expected += len(truth[i])
+                    short += len(matches) < min(k, count)
+                latencies.sort()
+                table.add_row(
+                    author,
+                    f"{count:,}",
+                    name if name != "auto" else f"auto ({', '.join(sorted(used))})",
+                    f"{latencies[len(latencies) // 2] * 1000:.1f}",
+                    f"{latencies[int(len(latencies) * 0.99)] * 1000:.1f}",
+                    f"{found / max(expected, 1):.3f}",
+                    str(short))
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import csv
+import json
+import time
+import base64
+import random
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai
+import click
+from rich.console import Console
+from rich.table import Table
+from embedder import Embedder
+
+
+# This script benchmarks the embedder in embedder.py against a fake embeddings
+# server running locally, so no OpenAI credits are spent. The fake server mimics
+# the shape of the OpenAI embeddings endpoint, sleeps to simulate network and
+# model latency, and can be told to reject a fraction of requests with a 429 to
+# exercise the retry path.
+#
+# For every combination of batch size and concurrency we embed the same set of
+# records from commit_history.csv and report the records per second achieved.
+
+
+DIMENSIONS = 1536
+
+
+def make_handler(latency: float, per_input_latency: float, error_rate: float):
+    vector = struct.pack(f"<{DIMENSIONS}f", *(random.random() for _ in range(DIMENSIONS)))
+    vector_b64 = base64.b64encode(vector).decode()
+    vector_floats = list(struct.unpack(f"<{DIMENSIONS}f", vector))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+            inputs = body["input"]
+            time.sleep(latency + per_input_latency * len(inputs))
+            if random.random() < error_rate:
+                self._send(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}}, {"retry-after": "0.05"})
+                return
+            b64 = body.get("encoding_format") == "base64"
+            self._send(200, {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": vector_b64 if b64 else vector_floats}
+                    for i in range(len(inputs))
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+
+        def _send(self, status: int, payload: dict, headers: dict | None = None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def read_contents(path: str, n: int) -> list[str]:
+    contents = []
+    with open(path) as f:
+        r = csv.DictReader(f, fieldnames=["id", "author", "date", "commit", "summary", "details"])
+        for row in r:
+            contents.append(" ".join([row["author"], row["date"], row["commit"], row["summary"], row["details"]]))
+    # repeat the corpus if more records were requested than the file holds
+    return [contents[i % len(contents)] for i in range(n)]
+
+
+@click.command()
+@click.option("--records", default=2000, help="number of records to embed per run")
+@click.option("--batch-sizes", default="1,16,64,256", help="comma separated batch sizes to try")
+@click.option("--concurrency", default="1,4,16", help="comma separated concurrency levels to try")
+@click.option("--latency", default=0.1, help="simulated seconds per request")
+@click.option("--per-input-latency", default=0.0005, help="simulated seconds per input in a request")
+@click.option("--error-rate", default=0.02, help="fraction of requests rejected with a 429")
+def main(records, batch_sizes, concurrency, latency, per_input_latency, error_rate):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(latency, per_input_latency, error_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = openai.OpenAI(api_key="fake", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+    contents = read_contents("commit_history.csv", records)
+    table = Table(title=f"Embedding {records} records (latency {latency}s, {error_rate:.0%} 429s)")
+    table.add_column("Batch size", justify="right")
+    table.add_column("Concurrency", justify="right")
+    table.add_column("Requests", justify="right")
+    table.add_column("Retries", justify="right")
+    table.add_column("Seconds", justify="right")
+    table.add_column("Records/s", justify="right")
+    for batch_size in [int(b) for b in batch_sizes.split(",")]:
+        for workers in [int(c) for c in concurrency.split(",")]:
+            embedder = Embedder(client, batch_size=batch_size, concurrency=workers)
+            start = time.perf_counter()
+            embeddings = embedder.embed(contents)
+            duration = time.perf_counter() - start
+            assert len(embeddings) == len(contents)
+            table.add_row(
+                str(batch_size),
+                str(workers),
+                str(embedder.requests),
+                str(embedder.retries),
+                f"{duration:.2f}",
+                f"{len(contents) / duration:,.0f}")
+    server.shutdown()
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
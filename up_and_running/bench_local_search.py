@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import click
+from rich.console import Console
+from rich.table import Table
+from local_search import LocalSearch
+from search import CommitSearch, knn_query
+
+
+# This script benchmarks the in-process search in local_search.py against the
+# database, and checks that they agree.
+#
+# No questions are sent to OpenAI: the queries are the embeddings of randomly
+# chosen commits with a little noise added. For each query shape of the search
+# scripts (no filter, time filter, time and author filter) we run:
+#   - local exact: the brute force search over the whole matrix
+#   - local ivf:   the search using the IVF index, probing --nprobe clusters
+#   - db exact:    the SQL query with index scans disabled, so postgres computes
+#                  the exact <=> ordering
+#   - db index:    the SQL query as the search scripts run it, using the tsv index
+#
+# Recall is the fraction of the local exact top k that each path also returned.
+# The recall of db exact should be 1.0: that checks the local search against
+# the SQL ordering.
+
+
+def db_exact(search: CommitSearch, embedding, k, since, author) -> list[dict]:
+    params = {"embedding": np.asarray(embedding, dtype=np.float32), "k": k, "since": since, "author": author}
+    with search.pool.connection() as con:
+        with con.transaction():
+            con.execute("set local enable_indexscan = off")
+            return con.execute(knn_query(since is not None, author is not None), params).fetchall()
+
+
+@click.command()
+@click.option("--queries", default=100, help="number of queries per query shape")
+@click.option("-k", default=10, help="number of matches per query")
+@click.option("--nprobe", default=8, help="number of IVF clusters to search")
+@click.option("--since", default="2022-01-01", help="date for the time filtered queries (YYYY-MM-DD)")
+def main(queries, k, nprobe, since):
+    _ = load_dotenv(find_dotenv())
+    since = datetime.strptime(since, "%Y-%m-%d")
+    start = time.perf_counter()
+    local = LocalSearch()
+    click.echo(f"loaded {len(local):,} embeddings in {time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    local.build_ivf()
+    click.echo(f"built ivf index with {len(local.centroids)} lists in {time.perf_counter() - start:.1f}s")
+    search = CommitSearch(os.environ["TIMESCALE_SERVICE_URL"], fallback_path=None)
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(local), size=queries, replace=False)
+    embeddings = local.vectors[rows] + rng.normal(scale=0.01, size=(queries, local.vectors.shape[1])).astype(np.float32)
+    # authors of the queried commits, so the author filter matches something
+    authors = [local.records[r]["author"] for r in rows]
+
+    paths = {
+        "local exact": lambda e, since, author: local.search(e, k, since, author),
+        "local ivf": lambda e, since, author: local.search(e, k, since, author, nprobe=nprobe),
+        "db exact": lambda e, since, author: db_exact(search, e, k, since, author),
+        "db index": lambda e, since, author: search.search(e, k, since, author),
+    }
+    shapes = {
+        "plain": lambda i: (None, None),
+        "time": lambda i: (since, None),
+        "time + author": lambda i: (since, authors[i]),
+    }
+
+    table = Table(title=f"{queries} queries per shape, k={k}")
+    for column in ["Shape", "Path", "p50 ms", "p99 ms", "QPS", "Recall"]:
+        table.add_column(column, justify="left" if column in ("Shape", "Path") else "right")
+    for shape, filters in shapes.items():
+        truth = [
+            {m["commit"] for m in local.search(e, k, *filters(i))}
+            for i, e in enumerate(embeddings)
+        ]
+        for path, fn in paths.items():
+            latencies = []
+            found = 0
+            expected = 0
+            for i, e in enumerate(embeddings):
+                start = time.perf_counter()
+                matches = fn(e, *filters(i))
+                latencies.append(time.perf_counter() - start)
+                found += len(truth[i] & {m["commit"] for m in matches})
+                expected += len(truth[i])
+            latencies.sort()
+            table.add_row(
+                shape,
+                path,
+                f"{latencies[len(latencies) // 2] * 1000:.2f}",
+                f"{latencies[int(len(latencies) * 0.99)] * 1000:.2f}",
+                f"{len(latencies) / sum(latencies):,.0f}",
+                f"{found / max(expected, 1):.3f}")
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
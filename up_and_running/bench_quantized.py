@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import click
+from rich.console import Console
+from rich.table import Table
+from quantized import MODES, column
+from search import NONE, CommitSearch, knn_query, quantized_modes, quantized_query
+
+
+# This script compares the compact representations of the embeddings in
+# quantized.py with the full precision embeddings and their tsv index.
+#
+# Add the representations to compare first, with ./quantized.py <mode> or
+# 0_embed.py --quantize <mode>. Modes that haven't been added are skipped.
+#
+# No questions are sent to OpenAI: the queries are the embeddings of randomly
+# chosen commits with a little noise added. For each representation we report:
+#   - the average size of its values and the size of its index
+#   - for each oversampling factor, the recall of the top k after re-ranking and
+#     the latency, for the unfiltered and the time filtered queries
+#
+# Recall is measured against the exact <=> ordering, computed by the database
+# with index scans disabled.
+
+
+def db_exact(search: CommitSearch, embedding, k, since) -> set[str]:
+    params = {"embedding": embedding, "k": k, "since": since, "author": None}
+    with search.pool.connection() as con:
+        with con.transaction():
+            con.execute("set local enable_indexscan = off")
+            return {m["commit"] for m in con.execute(knn_query(since is not None, False), params).fetchall()}
+
+
+def sizes(search: CommitSearch, col: str, index: str) -> tuple[float, int]:
+    # the average stored size of the column's values, and the size of its index over every chunk
+    with search.pool.connection() as con:
+        row = con.execute(f"""
+            select
+              (select avg(pg_column_size({col})) from commit_history) as avg_bytes
+            , hypertable_index_size(%(index)s) as index_bytes
+            """, {"index": index}).fetchone()
+    return float(row["avg_bytes"]), int(row["index_bytes"] or 0)
+
+
+@click.command()
+@click.option("--queries", default=100, help="number of queries per query shape")
+@click.option("-k", default=10, help="number of matches per query")
+@click.option("--oversample", "oversamples", default=[2, 4, 10], multiple=True, help="candidates per match to re-rank (repeatable)")
+@click.option("--since", default="2022-01-01", help="date for the time filtered queries (YYYY-MM-DD)")
+def main(queries, k, oversamples, since):
+    _ = load_dotenv(find_dotenv())
+    since = datetime.strptime(since, "%Y-%m-%d")
+    search = CommitSearch(os.environ["TIMESCALE_SERVICE_URL"], fallback_path=None, quantization=NONE)
+    with search.pool.connection() as con:
+        modes = quantized_modes(con)
+    if not modes:
+        raise click.ClickException("no quantized columns found. add one with ./quantized.py <mode>")
+
+    with search.pool.connection() as con:
+        sample = con.execute("select embedding from commit_history order by random() limit %(n)s", {"n": queries}).fetchall()
+    rng = np.random.default_rng(0)
+    embeddings = [
+        (np.asarray(r["embedding"], dtype=np.float32) + rng.normal(scale=0.01, size=len(r["embedding"]))).astype(np.float32)
+        for r in sample
+    ]
+    shapes = {"plain": None, "time": since}
+    truth = {shape: [db_exact(search, e, k, s) for e in embeddings] for shape, s in shapes.items()}
+
+    size_table = Table(title="storage")
+    for name in ["Representation", "Avg bytes", "Index MB"]:
+        size_table.add_column(name, justify="left" if name == "Representation" else "right")
+    avg_bytes, index_bytes = sizes(search, "embedding", "commit_history_embedding_idx")
+    size_table.add_row("vector(1536) + tsv", f"{avg_bytes:,.0f}", f"{index_bytes / 2**20:,.1f}")
+    for mode in modes:
+        avg_bytes, index_bytes = sizes(search, column(mode), f"commit_history_{column(mode)}_idx")
+        size_table.add_row(f"{MODES[mode][0]} ({mode})", f"{avg_bytes:,.0f}", f"{index_bytes / 2**20:,.1f}")
+    Console().print(size_table)
+
+    table = Table(title=f"{len(embeddings)} queries per shape, k={k}")
+    for name in ["Shape", "Path", "Oversample", "p50 ms", "p99 ms", "QPS", "Recall"]:
+        table.add_column(name, justify="left" if name in ("Shape", "Path") else "right")
+
+    def run(query: str, params: dict, expected: list[set[str]]) -> tuple:
+        latencies = []
+        found = 0
+        with search.pool.connection() as con:
+            for e, commits in zip(embeddings, expected):
+                start = time.perf_counter()
+                matches = con.execute(query, {**params, "embedding": e}).fetchall()
+                latencies.append(time.perf_counter() - start)
+                found += len(commits & {m["commit"] for m in matches})
+        latencies.sort()
+        return (
+            f"{latencies[len(latencies) // 2] * 1000:.2f}",
+            f"{latencies[int(len(latencies) * 0.99)] * 1000:.2f}",
+            f"{len(latencies) / sum(latencies):,.0f}",
+            f"{found / max(sum(len(c) for c in expected), 1):.3f}")
+
+    for shape, s in shapes.items():
+        params = {"k": k, "since": s, "author": None}
+        table.add_row(shape, "tsv", "-", *run(knn_query(s is not None, False), params, truth[shape]))
+        for mode in modes:
+            for oversample in oversamples:
+                query = quantized_query(mode, s is not None)
+                table.add_row(shape, mode, str(oversample), *run(query, {**params, "candidates": k * oversample}, truth[shape]))
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
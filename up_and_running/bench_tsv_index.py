@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import itertools
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import psycopg
+import psycopg2
+import click
+from psycopg.rows import dict_row
+from pgvector.psycopg import register_vector
+from rich.console import Console
+from rich.table import Table
+from bulk_load import copy_records
+from search import filters
+
+
+# This script measures what the tsv vector index gives us: how many of the true
+# nearest neighbors it finds (recall@k) and how fast, for the three query shapes
+# used by the search scripts:
+#   - plain:         1_similarity_search.py
+#   - time:          2_similarity_search_with_time.py
+#   - time + author: 3_similarity_search_with_time_and_author.py
+#
+# It loads a synthetic corpus of configurable size into its own hypertable (the
+# same schema as commit_history), so it can run against a local postgres with the
+# vector, timescale_vector and timescaledb extensions. The embeddings are drawn
+# around a number of cluster centers, the dates are spread over several years and
+# the authors follow a zipf distribution, so some authors are far more common
+# than others.
+#
+# The ground truth is computed exactly in numpy. Then for every combination of
+# index build parameters the index is (re)built, and for every query time
+# parameter each query shape is run, recording recall@k, p50/p99 latency and
+# queries per second. All results are written to a json file so that runs can be
+# compared to catch regressions:
+#
+#   ./bench_tsv_index.py --rows 100000 --num-neighbors 32,50 --query-search-list-size 50,100,200 -o tsv_bench.json
+#
+# Use --skip-load to sweep more parameters over the corpus loaded by a previous run.
+
+
+def synthetic_corpus(rows: int, dims: int, clusters: int, authors: int, years: int, seed: int):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=rows)] + 0.5 * rng.standard_normal((rows, dims)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    end = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    seconds = rng.integers(0, years * 365 * 86400, size=rows)
+    dates = np.array([end - timedelta(seconds=int(s)) for s in seconds])
+    author_ids = np.minimum(rng.zipf(1.5, size=rows), authors) - 1
+    return vectors, dates, author_ids
+
+
+def records(vectors, dates, author_ids):
+    for i in range(len(vectors)):
+        author = f"author {author_ids[i]}"
+        yield {
+            "id": i,
+            "date": dates[i],
+            "metadata": json.dumps({"author": author, "commit": f"{i:040x}", "summary": "", "details": ""}),
+            "content": f"synthetic commit {i}",
+            "embedding": vectors[i],
+        }
+
+
+def load(service_url: str, table: str, vectors, dates, author_ids) -> None:
+    # the rows go in with the same binary COPY as 0_embed.py, which uses psycopg2
+    with psycopg2.connect(service_url) as con:
+        with con.cursor() as cur:
+            cur.execute(f"drop table if exists {table}")
+            cur.execute(f"""
+                create table {table}
+                ( id int
+                , "date" timestamptz
+                , metadata jsonb
+                , content text
+                , embedding vector({vectors.shape[1]})
+                , author text generated always as (metadata->>'author') stored
+                )
+                """)
+            cur.execute(f"select create_hypertable('{table}', by_range('date', interval '1 month'))")
+            cur.execute(f'create index on {table} (author, "date" desc)')
+        con.commit()
+        copy_records(con, records(vectors, dates, author_ids), table=table)
+        with con.cursor() as cur:
+            cur.execute(f"analyze {table}")
+
+
+def exact_knn(vectors, query, k, mask=None) -> set[int]:
+    scores = vectors @ query
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    k = min(k, int(np.isfinite(scores).sum()))
+    return set(int(i) for i in np.argpartition(-scores, k - 1)[:k]) if k > 0 else set()
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+@click.command()
+@click.option("--rows", default=100_000, help="number of rows in the synthetic corpus")
+@click.option("--dims", default=1536, help="embedding dimensions")
+@click.option("--queries", default=100, help="number of queries per query shape")
+@click.option("-k", default=10, help="number of matches per query")
+@click.option("--num-neighbors", default="50", help="index build: comma separated num_neighbors values")
+@click.option("--search-list-size", default="100", help="index build: comma separated search_list_size values")
+@click.option("--max-alpha", default="1.2", help="index build: comma separated max_alpha values")
+@click.option("--query-search-list-size", default="25,50,100,200", help="query time: comma separated tsv.query_search_list_size values")
+@click.option("--query-rescore", default="", help="query time: comma separated tsv.query_rescore values (default: the server's setting)")
+@click.option("--table", default="bench_commit_history", help="table to load the synthetic corpus into")
+@click.option("--skip-load", is_flag=True, help="reuse the table loaded by a previous run with the same seed")
+@click.option("--seed", default=0)
+@click.option("-o", "--output", default="tsv_bench.json", help="file to write the results to")
+def main(rows, dims, queries, k, num_neighbors, search_list_size, max_alpha, query_search_list_size, query_rescore, table, skip_load, seed, output):
+    _ = load_dotenv(find_dotenv())
+    service_url = os.environ["TIMESCALE_SERVICE_URL"]
+    vectors, dates, author_ids = synthetic_corpus(rows, dims, clusters=max(1, rows // 1000), authors=1000, years=5, seed=seed)
+    if not skip_load:
+        start = time.perf_counter()
+        load(service_url, table, vectors, dates, author_ids)
+        click.echo(f"loaded {rows:,} rows in {time.perf_counter() - start:.1f}s")
+
+    with psycopg.connect(service_url, row_factory=dict_row, prepare_threshold=0) as con:
+        register_vector(con)
+
+        # queries are corpus vectors with noise. the time filter keeps the most
+        # recent ~20% of rows, and the author filter uses the author of the row
+        # the query was made from, so it ranges from very common to rare authors
+        rng = np.random.default_rng(seed + 1)
+        sources = rng.choice(rows, size=queries, replace=False)
+        embeddings = vectors[sources] + 0.05 * rng.standard_normal((queries, dims)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        since = np.sort(dates)[int(rows * 0.8)]
+        recent = dates >= since
+        shapes = {
+            "plain": [({"since": None, "author": None}, None) for _ in sources],
+            "time": [({"since": since, "author": None}, recent) for _ in sources],
+            "time + author": [
+                ({"since": since, "author": f"author {author_ids[s]}"}, recent & (author_ids == author_ids[s]))
+                for s in sources
+            ],
+        }
+        truth = {
+            shape: [exact_knn(vectors, e, k, mask) for e, (_, mask) in zip(embeddings, params)]
+            for shape, params in shapes.items()
+        }
+
+        results = []
+        builds = itertools.product(parse_ints(num_neighbors), parse_ints(search_list_size), [float(a) for a in max_alpha.split(",")])
+        for nn, sls, alpha in builds:
+            build = {"num_neighbors": nn, "search_list_size": sls, "max_alpha": alpha}
+            con.execute(f"drop index if exists {table}_embedding_idx")
+            start = time.perf_counter()
+            con.execute(f"""
+                create index {table}_embedding_idx on {table}
+                using tsv (embedding) with (num_neighbors = {nn}, search_list_size = {sls}, max_alpha = {alpha})
+                """)
+            con.commit()
+            build_seconds = time.perf_counter() - start
+            index_bytes = con.execute("select hypertable_index_size(%s) as size", (f"{table}_embedding_idx",)).fetchone()["size"]
+            for qsls, rescore in itertools.product(parse_ints(query_search_list_size), parse_ints(query_rescore) or [None]):
+                con.execute(f"set tsv.query_search_list_size = {qsls}")
+                if rescore is not None:
+                    con.execute(f"set tsv.query_rescore = {rescore}")
+                for shape, params in shapes.items():
+                    sql = f"""
+                        select id from {table}
+                        {filters(params[0][0]["since"] is not None, params[0][0]["author"] is not None)}
+                        order by embedding <=> %(embedding)b
+                        limit %(k)s
+                        """
+                    latencies = []
+                    found = expected = 0
+                    for e, (p, _), t in zip(embeddings, params, truth[shape]):
+                        start = time.perf_counter()
+                        ids = {r["id"] for r in con.execute(sql, {**p, "embedding": e, "k": k}).fetchall()}
+                        latencies.append(time.perf_counter() - start)
+                        found += len(ids & t)
+                        expected += len(t)
+                    con.commit()
+                    latencies.sort()
+                    results.append({
+                        "build": build,
+                        "build_seconds": build_seconds,
+                        "index_bytes": index_bytes,
+                        "query": {"query_search_list_size": qsls, "query_rescore": rescore},
+                        "shape": shape,
+                        "recall": found / max(expected, 1),
+                        "p50_ms": latencies[len(latencies) // 2] * 1000,
+                        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+                        "qps": len(latencies) / sum(latencies),
+                    })
+
+    with open(output, "w") as f:
+        json.dump({
+            "config": {"rows": rows, "dims": dims, "queries": queries, "k": k, "seed": seed,
+                       "run_at": datetime.now(timezone.utc).isoformat()},
+            "results": results,
+        }, f, indent=2)
+
+    summary = Table(title=f"tsv index: {rows:,} rows, {queries} queries per shape, recall@{k}")
+    for column in ["Build", "Build s", "Query", "Shape", "Recall", "p50 ms", "p99 ms", "QPS"]:
+        summary.add_column(column, justify="left" if column in ("Build", "Shape") else "right")
+    for r in results:
+        b = r["build"]
+        summary.add_row(
+            f"nn={b['num_neighbors']} sls={b['search_list_size']} alpha={b['max_alpha']}",
+            f"{r['build_seconds']:.1f}",
+            " ".join(f"{name.removeprefix('query_')}={value}" for name, value in r["query"].items() if value is not None),
+            r["shape"],
+            f"{r['recall']:.3f}",
+            f"{r['p50_ms']:.2f}",
+            f"{r['p99_ms']:.2f}",
+            f"{r['qps']:,.0f}")
+    Console().print(summary)
+    click.echo(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
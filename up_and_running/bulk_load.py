@@ -0,0 +1,147 @@
+import io
+import json
+import time
+import struct
+import itertools
+from datetime import datetime, timezone, tzinfo
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from typing import Iterable, Iterator
+import numpy as np
+
+
+# This module loads records into the commit_history hypertable using
+# `COPY ... FROM STDIN` in postgres' binary format instead of one INSERT per row.
+#
+# A single COPY streams many rows to the server over one round trip and skips
+# parsing and planning a statement per row. Using the binary format means the
+# server doesn't have to parse 1536 floats out of text for every embedding
+# either: we send the exact bytes of the pgvector `vector` type.
+#
+# Records are pulled lazily from any iterator and encoded into a small buffer as
+# postgres reads them, so memory stays flat no matter how many records we load.
+# Every `batch_size` rows the COPY is finished and committed.
+#
+# The binary COPY format is documented here:
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+
+
+COLUMNS = ["id", "date", "metadata", "content", "embedding"]
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+POSTGRES_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_vector(embedding) -> bytes:
+    # pgvector's binary format: int16 dimensions, int16 unused, then big endian float32s
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    values = np.asarray(embedding, dtype=">f4")
+    return struct.pack("!hh", len(values), 0) + values.tobytes()
+
+
+def encode_timestamptz(value, tz: tzinfo) -> bytes:
+    # microseconds since 2000-01-01 UTC. naive timestamps are interpreted in the
+    # session's time zone, just like postgres does when it parses text
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz)
+    delta = value - POSTGRES_EPOCH
+    return struct.pack("!q", (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds)
+
+
+def encode_jsonb(value) -> bytes:
+    # jsonb's binary format is a version byte followed by the json text
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return b"\x01" + value.encode()
+
+
+def encode_row(record: dict, tz: tzinfo) -> bytes:
+    fields = [
+        struct.pack("!i", int(record["id"])),
+        encode_timestamptz(record["date"], tz),
+        encode_jsonb(record["metadata"]),
+        record["content"].encode(),
+        encode_vector(record["embedding"]),
+    ]
+    return struct.pack("!h", len(fields)) + b"".join(struct.pack("!i", len(f)) + f for f in fields)
+
+
+class CopyStream(io.RawIOBase):
+    # a read-only file object that encodes rows as postgres asks for more data
+    def __init__(self, records: Iterator[dict], tz: tzinfo):
+        self.records = records
+        self.tz = tz
+        self.buffer = bytearray(COPY_SIGNATURE)
+        self.done = False
+        self.rows = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            record = next(self.records, None)
+            if record is None:
+                self.buffer += COPY_TRAILER
+                self.done = True
+            else:
+                self.buffer += encode_row(record, self.tz)
+                self.rows += 1
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def session_timezone(cur) -> tzinfo:
+    cur.execute("show timezone")
+    try:
+        return ZoneInfo(cur.fetchone()[0])
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone.utc
+
+
+def copy_rows(cur, records: Iterator[dict], table="commit_history", tz: tzinfo = timezone.utc) -> int:
+    # run a single COPY of the records into the table, without committing
+    stream = CopyStream(records, tz)
+    cur.copy_expert(f"copy {table} ({', '.join(COLUMNS)}) from stdin with (format binary)", stream, size=1 << 16)
+    return stream.rows
+
+
+def copy_records(con, records: Iterable[dict], table="commit_history", batch_size=10_000, progress=None) -> int:
+    # stream the records into the table, committing every batch_size rows. returns the number of rows copied
+    records = iter(records)
+    total = 0
+    with con.cursor() as cur:
+        tz = session_timezone(cur)
+        while True:
+            first = next(records, None)
+            if first is None:
+                break
+            batch = itertools.chain([first], itertools.islice(records, batch_size - 1))
+            rows = copy_rows(cur, batch, table, tz)
+            con.commit()
+            total += rows
+            if progress is not None:
+                progress(rows)
+    return total
+
+
+class Throughput:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.rows = 0
+
+    def update(self, rows: int):
+        self.rows += rows
+
+    @property
+    def rate(self) -> float:
+        return self.rows / max(time.perf_counter() - self.start, 1e-9)
+
+    def __str__(self) -> str:
+        return f"{self.rows:,} rows in {time.perf_counter() - self.start:.1f}s ({self.rate:,.0f} rows/s)"
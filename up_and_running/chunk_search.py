@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import os
+import heapq
+import itertools
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv, find_dotenv
+import numpy as np
+import click
+from psycopg import sql
+from rich.console import Console
+from rich.table import Table
+from search import CommitSearch, COLUMNS
+
+
+# This module is a search mode for time filtered questions (as in
+# 2_similarity_search_with_time.py) that searches the hypertable one chunk at a
+# time, newest first.
+#
+# With a "date >= since" filter timescaledb already excludes the chunks older
+# than since, but the vector index of every chunk that is left still has to be
+# searched, which adds up for a recent window over years of history. Here each
+# chunk is queried directly, using its own vector index, and the results are
+# merged into a running top k held in a heap. Chunks that can't improve on the
+# top k are skipped, and once none of the older chunks can, the search stops.
+#
+# Whether a chunk can improve the results is decided from statistics kept in the
+# commit_history_chunk_stats table: the centroid of the chunk's embeddings and
+# the largest distance from the centroid to any of them (its radius). No
+# embedding in the chunk can be closer to the question than the angle between
+# the question and the centroid, minus the radius's angle.
+#
+# Optionally results can be ranked by a time decayed score, so that newer
+# commits are preferred:
+#
+#   score = similarity * 0.5 ** (age / half_life)
+#
+# Since older chunks can only score lower, the search usually stops after a few
+# chunks. Each chunk is still searched by distance, so with a decayed score the
+# top k is approximate, the same as it is with the vector index.
+#
+# The chunk statistics are computed by 0_embed.py when it loads the table, and
+# for the chunks it changes when it refreshes it, so a search never has to scan
+# the embeddings to compute them. A chunk without statistics, e.g. one created
+# by an insert since, can't be bounded and is always searched. To recompute the
+# statistics of every chunk, pass --refresh-stats. How often each chunk is
+# visited, and how many were pruned, is counted so the hypertable's
+# chunk_time_interval can be tuned:
+#
+#   ./chunk_search.py --half-life-days 180
+
+
+STATS_TABLE = "commit_history_chunk_stats"
+
+
+def create_stats_table(con) -> None:
+    con.execute(f"""
+        create table if not exists {STATS_TABLE}
+        ( chunk_schema text
+        , chunk_name text
+        , rows bigint
+        , centroid vector(1536)   -- null for an empty chunk
+        , radius float8           -- the largest cosine distance of a row from the centroid
+        , primary key (chunk_schema, chunk_name)
+        )
+        """)
+
+
+def update_chunk_stats(cur, since=None, until=None) -> None:
+    # (re)computes the statistics of the chunks overlapping [since, until], or of
+    # every chunk, in two scans of their rows: one for the centroids and one for
+    # the radii. works with a psycopg2 cursor or a psycopg connection
+    cur.execute(f"""
+        with chunks as
+        (
+            select format('%%I.%%I', chunk_schema, chunk_name)::regclass::oid as chunk, chunk_schema, chunk_name, range_start, range_end
+            from timescaledb_information.chunks
+            where hypertable_name = 'commit_history'
+            and (%(since)s::timestamptz is null or range_end > %(since)s::timestamptz)
+            and (%(until)s::timestamptz is null or range_start <= %(until)s::timestamptz)
+        )
+        , bounds as
+        (
+            -- whole chunks, so every row of the chosen chunks is counted
+            select min(range_start) as lo, max(range_end) as hi from chunks
+        )
+        , centroids as
+        (
+            select h.tableoid as chunk, count(*) as rows, avg(h.embedding) as centroid
+            from commit_history h, bounds
+            where h."date" >= bounds.lo and h."date" < bounds.hi
+            group by h.tableoid
+        )
+        , radii as
+        (
+            select c.chunk, max(h.embedding <=> c.centroid) as radius
+            from commit_history h
+            join centroids c on c.chunk = h.tableoid
+            , bounds
+            where h."date" >= bounds.lo and h."date" < bounds.hi
+            group by c.chunk
+        )
+        insert into {STATS_TABLE} (chunk_schema, chunk_name, rows, centroid, radius)
+        select ch.chunk_schema, ch.chunk_name, coalesce(c.rows, 0), c.centroid, r.radius
+        from chunks ch
+        left join centroids c on c.chunk = ch.chunk
+        left join radii r on r.chunk = ch.chunk
+        on conflict (chunk_schema, chunk_name) do update
+        set rows = excluded.rows, centroid = excluded.centroid, radius = excluded.radius
+        """, {"since": since, "until": until})
+
+
+def min_distance(query: np.ndarray, centroid: np.ndarray, radius: float) -> float:
+    # the smallest cosine distance from the (unit length) query to any embedding
+    # within radius of the centroid, by the triangle inequality on angles
+    centroid = centroid / max(np.linalg.norm(centroid), 1e-12)
+    to_centroid = np.arccos(np.clip(query @ centroid, -1.0, 1.0))
+    spread = np.arccos(np.clip(1.0 - radius, -1.0, 1.0))
+    return float(1.0 - np.cos(max(0.0, to_centroid - spread)))
+
+
+class ChunkSearch:
+    def __init__(self, search: CommitSearch):
+        self.search = search
+        self.searches = 0
+        self.visits: Counter[str] = Counter()
+        self.pruned = 0
+        self.stopped = 0
+        with search.pool.connection() as con:
+            create_stats_table(con)
+
+    def chunks(self, con, since: datetime) -> list[dict]:
+        # the chunks overlapping [since, ∞) newest first, with their statistics if known
+        return con.execute(f"""
+            select c.chunk_schema, c.chunk_name, c.range_start, c.range_end, s.rows, s.centroid, s.radius
+            from timescaledb_information.chunks c
+            left join {STATS_TABLE} s on (s.chunk_schema, s.chunk_name) = (c.chunk_schema, c.chunk_name)
+            where c.hypertable_name = 'commit_history'
+            and c.range_end > %(since)s::timestamptz
+            order by c.range_end desc
+            """, {"since": since}).fetchall()
+
+    def search_chunks(
+        self,
+        embedding,
+        k=5,
+        since: datetime | None = None,
+        half_life: timedelta | None = None,
+    ) -> list[dict]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        since = since or datetime.min.replace(tzinfo=timezone.utc)
+        now = datetime.now(timezone.utc)
+
+        def decay(date: datetime) -> float:
+            if half_life is None:
+                return 1.0
+            return 0.5 ** (max(now - date, timedelta(0)) / half_life)
+
+        def bound(chunk: dict) -> float:
+            # the best score any row of the chunk could have: the closest it could
+            # be, decayed by the age of the chunk's newest possible row
+            if chunk["rows"] is None:
+                return decay(chunk["range_end"])   # no statistics, it must be searched
+            if chunk["centroid"] is None:
+                return -np.inf                     # empty
+            return max(0.0, 1.0 - min_distance(query, chunk["centroid"], chunk["radius"])) * decay(chunk["range_end"])
+
+        self.searches += 1
+        with self.search.pool.connection() as con:
+            # the table is created if missing, e.g. if it was dropped while we were running
+            create_stats_table(con)
+            chunks = self.chunks(con, since)
+            bounds = [bound(c) for c in chunks]
+            # the best bound of each chunk and all the chunks older than it
+            remaining = np.maximum.accumulate(bounds[::-1])[::-1] if bounds else []
+            # a row never takes part in a comparison: equal scores and dates are
+            # ordered by the counter instead
+            heap: list[tuple[float, float, int, dict]] = []
+            tiebreak = itertools.count()
+            for i, chunk in enumerate(chunks):
+                if len(heap) == k and remaining[i] <= heap[0][0]:
+                    # no older chunk can improve the top k
+                    self.stopped += len(chunks) - i
+                    break
+                if bounds[i] == -np.inf or (len(heap) == k and bounds[i] <= heap[0][0]):
+                    self.pruned += 1
+                    continue
+                self.visits[chunk["chunk_name"]] += 1
+                rows = con.execute(sql.SQL("""
+                    select {columns}, embedding <=> %(embedding)b as distance
+                    from {chunk}
+                    where "date" >= %(since)s::timestamptz
+                    order by embedding <=> %(embedding)b
+                    limit %(k)s
+                    """).format(columns=sql.SQL(COLUMNS), chunk=sql.Identifier(chunk["chunk_schema"], chunk["chunk_name"])),
+                    {"embedding": query, "since": since, "k": k}).fetchall()
+                for row in rows:
+                    row["score"] = (1.0 - row["distance"]) * decay(row["date"])
+                    item = (row["score"], -row["date"].timestamp(), next(tiebreak), row)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item[:2] > heap[0][:2]:
+                        heapq.heapreplace(heap, item)
+        return [row for *_, row in sorted(heap, key=lambda item: item[:2], reverse=True)]
+
+    def __str__(self) -> str:
+        visited = sum(self.visits.values())
+        return (
+            f"chunk search: {self.searches} searches, {visited} chunk visits, "
+            f"{self.pruned} pruned, {self.stopped} skipped by early stop")
+
+
+def print_results(matches: list[dict]) -> None:
+    table = Table(title="Matches")
+    table.add_column("Date")
+    table.add_column("Author")
+    table.add_column("Summary")
+    table.add_column("Distance", justify="right")
+    table.add_column("Score", justify="right")
+    for match in matches:
+        table.add_row(
+            datetime.strftime(match["date"], "%Y-%m-%d"),
+            match["author"],
+            match["summary"],
+            f"{match['distance']:.4f}",
+            f"{match['score']:.4f}")
+    Console().print(table)
+
+
+@click.command()
+@click.option("-k", default=5, help="number of matches per question")
+@click.option("--half-life-days", type=float, default=None, help="rank by similarity decayed with this half life")
+@click.option("--refresh-stats", is_flag=True, help="recompute the statistics of every chunk first")
+def main(k, half_life_days, refresh_stats):
+    _ = load_dotenv(find_dotenv())
+    search = CommitSearch(os.environ["TIMESCALE_SERVICE_URL"], fallback_path=None)
+    chunk_search = ChunkSearch(search)
+    if refresh_stats:
+        with search.pool.connection() as con:
+            con.execute(f"truncate {STATS_TABLE}")
+            update_chunk_stats(con)
+    half_life = timedelta(days=half_life_days) if half_life_days else None
+    while True:
+        question = click.prompt("Enter your question", type=str)
+        since = click.prompt("Only find results more recent than (YYYY-MM-DD)", type=str, default="", show_default=False)
+        since = datetime.strptime(since, "%Y-%m-%d") if since else None
+        print_results(chunk_search.search_chunks(search.embed(question), k, since, half_life))
+        click.echo(chunk_search)
+        click.echo("\n")
+        if not click.confirm('Do you want to continue?'):
+            break
+    table = Table(title="Chunk visits")
+    table.add_column("Chunk")
+    table.add_column("Visits", justify="right")
+    for name, visits in chunk_search.visits.most_common():
+        table.add_row(name, str(visits))
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
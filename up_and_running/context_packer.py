@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+# the packing is shared with tsv_timemachine, in shared/ at the root of the repo
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from shared.token_budget import TokenBudget
+
+
+# This module packs the commits found by a similarity search into the context of
+# a RAG prompt (see 4_rag.py), without letting the prompt grow past a token budget.
+#
+# Commits are taken in the order the search returned them, most relevant first:
+#   - duplicates are skipped. The same change is often committed more than
+#     once, e.g. when it is backported, so commits whose summary and details are
+#     the same apart from case and whitespace count as duplicates
+#   - long commits are truncated to max_tokens
+#   - commits are added until the next one would go over the budget
+#
+# Tokens are counted with the chat model's tokenizer, which is loaded only once.
+
+
+CHAT_MODEL = "gpt-3.5-turbo"
+
+
+class ContextPacker(TokenBudget):
+    def __init__(self, budget=3000, max_tokens=350, model=CHAT_MODEL):
+        # each commit is joined to the others with "\n* ", which is about 2 tokens
+        super().__init__(budget, max_tokens, model, separator_tokens=2)
+
+    def format(self, match: dict) -> str:
+        # the same fields, in the same order, as the content 0_embed.py embedded
+        return " ".join([match["author"], str(match["date"]), match["commit"], match["summary"], match["details"]])
+
+    def pack(self, matches: list[dict]) -> list[str]:
+        items = [(f"{m['summary']} {m['details']}", self.format(m)) for m in matches]
+        return [text for _, text in self.pack_texts(items)]
+
+    def __str__(self) -> str:
+        return (
+            f"context: {self.packed} commits in {self.tokens:,} of {self.budget:,} tokens, "
+            f"{self.duplicates} duplicates, {self.over_budget} over budget")
@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+from pathlib import Path
+from typing import Iterable, Iterator
+import numpy as np
+
+
+# This module caches embedded records on disk so that 0_embed.py can reload the
+# database without asking OpenAI for the embeddings again.
+#
+# The cache is two files that share a name:
+#   - <name>.npy   a float32 matrix with one row per record, holding the embeddings
+#   - <name>.jsonl one json object per line with the id, date, metadata and content
+#
+# The .npy file is about a fifth of the size of the same embeddings written as
+# text, and it is opened memory-mapped. Reading it doesn't parse or copy
+# anything; each record's embedding is a view into the mapped file that can be
+# handed straight to the bulk loader.
+
+
+DIMENSIONS = 1536
+FIELDS = ["id", "date", "metadata", "content"]
+
+
+def cache_paths(path: str | Path) -> tuple[Path, Path]:
+    path = Path(path)
+    return path.with_suffix(".npy"), path.with_suffix(".jsonl")
+
+
+def cache_exists(path="commit_history_embedded") -> bool:
+    return all(p.exists() for p in cache_paths(path))
+
+
+class CacheWriter:
+    # the number of records isn't known up front, so we write the raw floats to a
+    # scratch file and put the .npy header in front of them once we are done.
+    # both files are written under temporary names and only replace the existing
+    # cache once every record was written, so a failed run leaves it intact
+    def __init__(self, path="commit_history_embedded"):
+        self.vectors_path, self.sidecar_path = cache_paths(path)
+        self.raw_path = self.vectors_path.with_suffix(".npy.raw.tmp")
+        self.vectors_tmp_path = self.vectors_path.with_suffix(".npy.tmp")
+        self.sidecar_tmp_path = self.sidecar_path.with_suffix(".jsonl.tmp")
+        self.raw = open(self.raw_path, "wb")
+        self.sidecar = open(self.sidecar_tmp_path, "w")
+        self.rows = 0
+
+    def write(self, record: dict) -> None:
+        self.raw.write(np.asarray(record["embedding"], dtype="<f4").tobytes())
+        self.sidecar.write(json.dumps({k: record[k] for k in FIELDS}) + "\n")
+        self.rows += 1
+
+    def close(self) -> int:
+        self.raw.close()
+        self.sidecar.close()
+        with open(self.vectors_tmp_path, "wb") as f, open(self.raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(f, {
+                "descr": "<f4",
+                "fortran_order": False,
+                "shape": (self.rows, DIMENSIONS),
+            })
+            shutil.copyfileobj(raw, f)
+        os.remove(self.raw_path)
+        os.replace(self.vectors_tmp_path, self.vectors_path)
+        os.replace(self.sidecar_tmp_path, self.sidecar_path)
+        return self.rows
+
+    def __enter__(self) -> "CacheWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # throw away the partial files. the previous cache, if any, is untouched
+        self.raw.close()
+        self.sidecar.close()
+        for p in (self.raw_path, self.vectors_tmp_path, self.sidecar_tmp_path):
+            p.unlink(missing_ok=True)
+
+
+def write_embedded_cache(records: Iterable[dict], path="commit_history_embedded") -> int:
+    with CacheWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.rows
+
+
+class EmbeddedCache:
+    def __init__(self, path="commit_history_embedded"):
+        self.vectors_path, self.sidecar_path = cache_paths(path)
+        # memory-map the embeddings. pages are only read from disk when touched
+        self.vectors = np.load(self.vectors_path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.sidecar_path) as f:
+            for i, line in enumerate(f):
+                record = json.loads(line)
+                record["embedding"] = self.vectors[i]
+                yield record
+
+
+def read_embedded_cache(path="commit_history_embedded") -> EmbeddedCache:
+    return EmbeddedCache(path)
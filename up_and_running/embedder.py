@@ -0,0 +1,144 @@
+import time
+import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Callable, Iterable, Iterator, TypeVar
+import openai
+import tiktoken
+
+
+# This module embeds many texts with the OpenAI embeddings API as fast as the API
+# allows. Rather than one request per text, texts are packed into batches that stay
+# under the per-request limits of the model, and several batches are kept in flight
+# at once using a bounded pool of worker threads.
+#
+# The limits we pack against:
+#   - at most MAX_BATCH_INPUTS texts per request
+#   - at most MAX_BATCH_TOKENS tokens summed across the texts in a request
+#   - at most MAX_INPUT_TOKENS tokens per text (longer texts are truncated)
+#
+# Requests that fail with a 429 (rate limited) or a 5xx are retried with
+# exponential backoff and jitter. Results are always returned in the same order
+# as the inputs, no matter which batch finishes first.
+
+
+MODEL = "text-embedding-3-small"
+MAX_INPUT_TOKENS = 8191
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 300_000
+
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = MODEL) -> tiktoken.Encoding:
+    # loading an encoding is expensive, so only ever do it once per model
+    return tiktoken.encoding_for_model(model)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def retry_after(e: Exception) -> float | None:
+    # honor the server's Retry-After header when it gives us one
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Embedder:
+    def __init__(
+        self,
+        client: openai.OpenAI | None = None,
+        model: str = MODEL,
+        batch_size: int = 512,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        concurrency: int = 8,
+        max_retries: int = 8,
+        max_backoff: float = 60.0,
+    ):
+        client = client or openai.OpenAI()
+        # we do our own retrying, so turn off the client's
+        self.client = client.with_options(max_retries=0)
+        self.model = model
+        self.batch_size = min(batch_size, MAX_BATCH_INPUTS)
+        self.max_batch_tokens = max_batch_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.encoding = get_encoding(model)
+        self.requests = 0
+        self.retries = 0
+
+    def _prepare(self, text: str) -> tuple[str, int]:
+        # newlines hurt embedding quality. texts over the input limit are truncated
+        text = text.replace("\n", " ")
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) > MAX_INPUT_TOKENS:
+            tokens = tokens[:MAX_INPUT_TOKENS]
+            text = self.encoding.decode(tokens)
+        return text, len(tokens)
+
+    def batches(self, items: Iterable[T], text: Callable[[T], str]) -> Iterator[list[tuple[T, str]]]:
+        # pack items into batches that respect both the input and token limits
+        batch: list[tuple[T, str]] = []
+        batch_tokens = 0
+        for item in items:
+            content, num_tokens = self._prepare(text(item))
+            if batch and (len(batch) >= self.batch_size or batch_tokens + num_tokens > self.max_batch_tokens):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append((item, content))
+            batch_tokens += num_tokens
+        if batch:
+            yield batch
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        attempt = 0
+        while True:
+            try:
+                self.requests += 1
+                response = self.client.embeddings.create(input=texts, model=self.model)
+                # the api tells us which input each embedding belongs to
+                data = sorted(response.data, key=lambda d: d.index)
+                return [d.embedding for d in data]
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(self.max_backoff, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                self.retries += 1
+                time.sleep(delay)
+
+    def embed_items(self, items: Iterable[T], text: Callable[[T], str] = lambda x: x) -> Iterator[tuple[T, list[float]]]:
+        # yields (item, embedding) pairs in input order. at most 2x concurrency
+        # batches are buffered, so this works on arbitrarily long streams
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+            for batch in self.batches(items, text):
+                future = executor.submit(self.embed_batch, [content for _, content in batch])
+                in_flight.append((batch, future))
+                if len(in_flight) >= 2 * self.concurrency:
+                    yield from self._drain(in_flight.popleft())
+            while in_flight:
+                yield from self._drain(in_flight.popleft())
+
+    @staticmethod
+    def _drain(pending) -> Iterator[tuple[T, list[float]]]:
+        batch, future = pending
+        for (item, _), embedding in zip(batch, future.result()):
+            yield item, embedding
+
+    def embed(self, texts: Iterable[str]) -> list[list[float]]:
+        return [embedding for _, embedding in self.embed_items(texts)]
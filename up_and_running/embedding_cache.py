@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable
+import numpy as np
+
+
+# This module caches the embeddings of search questions, so asking the same (or a
+# popular) question again skips the round trip to the OpenAI embeddings API.
+#
+# Entries are keyed by the embedding model and the question with its case and
+# whitespace normalized. Only the key is normalized: a question that isn't cached
+# is embedded as it was asked, since case can matter, e.g. in function names.
+# There are two tiers:
+#   - an in-memory LRU holding the most recently used max_entries embeddings
+#   - an optional SQLite file that survives restarts. embeddings found there are
+#     promoted into the in-memory tier
+#
+# The cache counts hits in each tier and misses, so its effectiveness is visible.
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=1024, path: str | None = None):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""
+                create table if not exists query_embedding
+                ( model text not null
+                , text text not null
+                , embedding blob not null
+                , primary key (model, text)
+                )
+                """)
+            self.db.commit()
+
+    def get(self, model: str, text: str) -> np.ndarray | None:
+        key = (model, normalize(text))
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            if self.db is not None:
+                row = self.db.execute(
+                    "select embedding from query_embedding where model = ? and text = ?", key).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, embedding) -> np.ndarray:
+        return self.put_many(model, [(text, embedding)])[0]
+
+    def put_many(self, model: str, items: list[tuple[str, list[float]]]) -> list[np.ndarray]:
+        # stores several embeddings with a single commit to the sqlite file
+        keys = [(model, normalize(text)) for text, _ in items]
+        embeddings = [np.asarray(embedding, dtype=np.float32) for _, embedding in items]
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                self._remember(key, embedding)
+            if self.db is not None:
+                self.db.executemany(
+                    "insert or replace into query_embedding (model, text, embedding) values (?, ?, ?)",
+                    [(*key, embedding.tobytes()) for key, embedding in zip(keys, embeddings)])
+                self.db.commit()
+        return embeddings
+
+    def _remember(self, key: tuple[str, str], embedding: np.ndarray) -> None:
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_or_embed(self, model: str, text: str, embed: Callable[[str], list[float]]) -> np.ndarray:
+        embedding = self.get(model, text)
+        if embedding is None:
+            embedding = self.put(model, text, embed(text))
+        return embedding
+
+    def __str__(self) -> str:
+        return f"embedding cache: {self.hits + self.disk_hits} hits ({self.disk_hits} from disk), {self.misses} misses"
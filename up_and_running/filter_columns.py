@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import os
+from dotenv import load_dotenv, find_dotenv
+import psycopg2
+import click
+
+
+# The search scripts filter on the commits' author and hash, which 0_embed.py
+# promotes from the metadata to typed, indexed columns generated from it. A
+# commit_history table loaded before those columns were added doesn't have them,
+# and the searches fail with an undefined column error. This adds them, and
+# their indexes, to such a table (0_embed.py --incremental does it too):
+#
+#   ./filter_columns.py
+
+
+def add_filter_columns(cur) -> None:
+    # the same columns and indexes that 0_embed.py creates when it loads the table
+    cur.execute("""
+        alter table commit_history
+        add column if not exists author text generated always as (metadata->>'author') stored
+        """)
+    cur.execute("""
+        alter table commit_history
+        add column if not exists "commit" text generated always as (metadata->>'commit') stored
+        """)
+    cur.execute('create index if not exists commit_history_author_date_idx on commit_history (author, "date" desc)')
+    cur.execute('create index if not exists commit_history_commit_idx on commit_history ("commit")')
+
+
+@click.command()
+def main():
+    _ = load_dotenv(find_dotenv())
+    with psycopg2.connect(os.environ["TIMESCALE_SERVICE_URL"]) as con:
+        with con.cursor() as cur:
+            print("adding the author and commit columns and their indexes...")
+            add_filter_columns(cur)
+            cur.execute("analyze commit_history")
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import hashlib
+import itertools
+from typing import Iterable, Iterator
+from bulk_load import copy_rows, session_timezone
+
+
+# This module lets 0_embed.py refresh the commit_history table incrementally,
+# so that a daily refresh costs API calls and database time proportional to the
+# number of commits that changed rather than to the size of the whole history.
+#
+# Alongside commit_history we keep a small table mapping each commit's id to a
+# sha256 hash of its content:
+#
+#       Table "public.commit_history_hashes"
+# ┌──────────────┬─────────┬───────────┬──────────┐
+# │    Column    │  Type   │ Collation │ Nullable │
+# ├──────────────┼─────────┼───────────┼──────────┤
+# │ id           │ integer │           │ not null │
+# │ content_hash │ bytea   │           │ not null │
+# └──────────────┴─────────┴───────────┴──────────┘
+#
+# Records read from the CSV are hashed and looked up in this table in batches.
+# Only the records that are new or whose content changed are sent to OpenAI to
+# be embedded. Those are copied into a temporary staging table and swapped into
+# commit_history in a single transaction, leaving the hypertable and its vector
+# index in place. Commits that disappear from the CSV are left in the table.
+
+
+def content_hash(content: str) -> bytes:
+    # must match sha256(convert_to(content, 'UTF8')) computed in the database
+    return hashlib.sha256(content.encode()).digest()
+
+
+def create_hash_table(cur) -> None:
+    cur.execute("drop table if exists commit_history_hashes")
+    cur.execute("""
+        create table commit_history_hashes
+        ( id int primary key
+        , content_hash bytea not null
+        )
+        """)
+    cur.execute("""
+        insert into commit_history_hashes (id, content_hash)
+        select id, sha256(convert_to(content, 'UTF8'))
+        from commit_history
+        """)
+
+
+def table_exists(con) -> bool:
+    with con.cursor() as cur:
+        cur.execute("select to_regclass('commit_history') is not null and to_regclass('commit_history_hashes') is not null")
+        return cur.fetchone()[0]
+
+
+def changed_records(con, records: Iterable[dict], batch_size=1000) -> Iterator[dict]:
+    # yield only the records whose content is new or differs from what is loaded
+    records = iter(records)
+    with con.cursor() as cur:
+        while batch := list(itertools.islice(records, batch_size)):
+            cur.execute(
+                "select id, content_hash from commit_history_hashes where id = any(%s)",
+                ([int(r["id"]) for r in batch],))
+            known = {id: bytes(h) for id, h in cur.fetchall()}
+            con.commit()
+            for record in batch:
+                if known.get(int(record["id"])) != content_hash(record["content"]):
+                    yield record
+
+
+def upsert_records(con, records: Iterable[dict], batch_size=1000, progress=None) -> int:
+    # replace the rows for the given records, one transaction per batch
+    records = iter(records)
+    total = 0
+    with con.cursor() as cur:
+        tz = session_timezone(cur)
+        while True:
+            first = next(records, None)
+            if first is None:
+                break
+            cur.execute("""
+                create temp table commit_history_staging
+                ( id int
+                , "date" timestamptz
+                , metadata jsonb
+                , content text
+                , embedding vector(1536)
+                ) on commit drop
+                """)
+            batch = itertools.chain([first], itertools.islice(records, batch_size - 1))
+            rows = copy_rows(cur, batch, "commit_history_staging", tz)
+            # delete by id rather than upserting on a unique key so that a commit
+            # whose date changed (e.g. after a rebase) moves to the right chunk
+            cur.execute("delete from commit_history h using commit_history_staging s where h.id = s.id")
+            cur.execute("""
+                insert into commit_history (id, "date", metadata, content, embedding)
+                select id, "date", metadata, content, embedding
+                from commit_history_staging
+                """)
+            cur.execute("""
+                insert into commit_history_hashes (id, content_hash)
+                select id, sha256(convert_to(content, 'UTF8'))
+                from commit_history_staging
+                on conflict (id) do update set content_hash = excluded.content_hash
+                """)
+            con.commit()
+            total += rows
+            if progress is not None:
+                progress(rows)
+    return total
@@ -0,0 +1,141 @@
+import json
+from datetime import datetime, timezone
+import numpy as np
+from embedded_cache import read_embedded_cache
+
+
+# This module searches the embeddings that 0_embed.py caches on disk (see
+# embedded_cache.py) entirely in process, without a database. It is meant for CI,
+# for laptops, and as a fallback when the database is unavailable.
+#
+# All the embeddings are loaded into one contiguous float32 matrix with each row
+# scaled to unit length, so the cosine similarity of a question to every commit
+# is a single matrix-vector product. The k best rows are picked with
+# np.argpartition, which doesn't need to sort the whole corpus. Distances are
+# reported as 1 - cosine similarity, the same as pgvector's <=> operator.
+#
+# The same filters as 2_similarity_search_with_time.py and
+# 3_similarity_search_with_time_and_author.py are supported without scanning:
+#   - the commit dates are kept sorted, so "date >= since" is a binary search
+#   - each author maps to the sorted list of rows they wrote
+#
+# For larger corpora an optional IVF index can be built: the rows are clustered
+# with k-means, and a search only scores the rows in the nprobe clusters whose
+# centroids are closest to the question.
+#
+# Dates are compared in UTC, as the database compares timestamptz values. The
+# commits were made in different time zones, and a naive date is taken to be UTC.
+
+
+def utc_datetime64(date: datetime) -> np.datetime64:
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(date, "us")
+
+
+class LocalSearch:
+    def __init__(self, path="commit_history_embedded"):
+        cache = read_embedded_cache(path)
+        vectors = np.array(cache.vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self.vectors = vectors
+        self.records: list[dict] = []
+        dates = []
+        authors: dict[str, list[int]] = {}
+        with open(cache.sidecar_path) as f:
+            for i, line in enumerate(f):
+                record = json.loads(line)
+                metadata = json.loads(record["metadata"])
+                date = datetime.fromisoformat(record["date"])
+                self.records.append({
+                    "id": int(record["id"]),
+                    "date": date,
+                    "author": metadata["author"],
+                    "commit": metadata["commit"],
+                    "summary": metadata["summary"],
+                    "details": metadata["details"],
+                    "content": record["content"],
+                })
+                dates.append(utc_datetime64(date))
+                authors.setdefault(metadata["author"], []).append(i)
+        dates = np.array(dates, dtype="datetime64[us]")
+        self.date_order = np.argsort(dates, kind="stable")
+        self.sorted_dates = dates[self.date_order]
+        self.author_rows = {a: np.array(rows, dtype=np.int64) for a, rows in authors.items()}
+        self.centroids: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def candidates(self, since: datetime | None = None, author: str | None = None) -> np.ndarray | None:
+        # the sorted row ids matching the filters, or None when there are no filters
+        rows = None
+        if since is not None:
+            start = np.searchsorted(self.sorted_dates, utc_datetime64(since), side="left")
+            rows = np.sort(self.date_order[start:])
+        if author is not None:
+            author_rows = self.author_rows.get(author, np.empty(0, dtype=np.int64))
+            rows = author_rows if rows is None else np.intersect1d(rows, author_rows, assume_unique=True)
+        return rows
+
+    def build_ivf(self, nlist: int | None = None, iterations=10, sample=100_000, seed=0) -> None:
+        # cluster the rows with k-means (spherical, since the rows are unit length)
+        rng = np.random.default_rng(seed)
+        nlist = nlist or max(1, int(4 * np.sqrt(len(self))))
+        train = self.vectors[rng.choice(len(self), size=min(sample, len(self)), replace=False)]
+        centroids = train[rng.choice(len(train), size=min(nlist, len(train)), replace=False)].copy()
+        for _ in range(iterations):
+            assignment = self._assign(train, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+            counts = np.bincount(assignment, minlength=len(centroids))
+            # clusters that lost all their rows keep their old centroid
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / np.linalg.norm(sums[nonempty], axis=1, keepdims=True)
+        assignment = self._assign(self.vectors, centroids)
+        self.centroids = centroids
+        self.list_rows = np.argsort(assignment, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))])
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, block=16384) -> np.ndarray:
+        # the nearest centroid of every row, a block of rows at a time to bound memory
+        return np.concatenate([
+            np.argmax(vectors[i:i + block] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), block)
+        ])
+
+    def _probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        # the sorted row ids in the nprobe clusters closest to the query
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists]))
+
+    def search(
+        self,
+        embedding,
+        k=5,
+        since: datetime | None = None,
+        author: str | None = None,
+        nprobe: int | None = None,
+    ) -> list[dict]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        rows = self.candidates(since, author)
+        if nprobe is not None and self.centroids is not None:
+            probed = self._probe(query, nprobe)
+            probed = probed if rows is None else np.intersect1d(probed, rows, assume_unique=True)
+            # only trust the index when it found enough rows. otherwise search exactly
+            if len(probed) >= k:
+                rows = probed
+        scores = self.vectors @ query if rows is None else self.vectors[rows] @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        matches = []
+        for i in top:
+            row = i if rows is None else rows[i]
+            matches.append({**self.records[row], "distance": float(1.0 - scores[i])})
+        return matches
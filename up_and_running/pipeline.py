@@ -0,0 +1,173 @@
+import time
+import threading
+from queue import Queue, Empty, Full
+from typing import Any, Callable, Iterable, Iterator
+
+
+# This module runs a chain of processing stages concurrently, each stage in its
+# own thread(s), connected by bounded queues:
+#
+#   source ──queue──▶ stage ──queue──▶ stage ──queue──▶ consumer
+#
+# Because every queue is bounded, a fast stage blocks once it is queue_size
+# items ahead of the stage after it. The amount of data in flight, and so the
+# memory used, is capped no matter how large the input is, while all the stages
+# still overlap with each other.
+#
+# Each stage counts how many records it has produced and how long it spent
+# working, and each queue can be sampled for its depth. A stage whose input
+# queue is always full and whose output queue is always empty is the
+# bottleneck.
+
+
+DONE = object()
+
+
+def count(item) -> int:
+    # items flowing through the pipeline are often batches of records
+    return len(item) if isinstance(item, list) else 1
+
+
+class StageStats:
+    def __init__(self, name: str, input: Queue | None):
+        self.name = name
+        self.input = input
+        self.records = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def update(self, item, busy: float) -> None:
+        with self.lock:
+            self.records += count(item)
+            self.busy += busy
+            if self.input is not None:
+                self.max_depth = max(self.max_depth, self.input.qsize())
+
+    @property
+    def rate(self) -> float:
+        return self.records / max(time.perf_counter() - self.start, 1e-9)
+
+    def __str__(self) -> str:
+        s = f"{self.name}: {self.records:,} ({self.rate:,.0f}/s, busy {self.busy:.1f}s)"
+        if self.input is not None:
+            s += f" queue {self.input.qsize()}/{self.input.maxsize} (max {self.max_depth})"
+        return s
+
+
+class Pipeline:
+    def __init__(self, source: Iterable, name="read", queue_size=8):
+        self.source = source
+        self.queue_size = queue_size
+        self.stages: list[tuple[Callable[[Any], Any], int]] = []
+        self.stats = [StageStats(name, None)]
+        self.queues: list[Queue] = []
+        self.stop = threading.Event()
+        self.error: BaseException | None = None
+
+    def stage(self, name: str, fn: Callable[[Any], Any], workers=1) -> "Pipeline":
+        # fn is applied to every item. with more than one worker, items may come out of order
+        queue = Queue(self.queue_size)
+        self.queues.append(queue)
+        self.stages.append((fn, workers))
+        self.stats.append(StageStats(name, queue))
+        return self
+
+    def sink(self, name: str) -> "Pipeline":
+        # name the consumer that iterates over the pipeline, so it is reported too
+        queue = Queue(self.queue_size)
+        self.queues.append(queue)
+        self.stats.append(StageStats(name, queue))
+        return self
+
+    def _put(self, queue: Queue, item) -> None:
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _get(self, queue: Queue):
+        while not self.stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return DONE
+
+    def _fail(self, e: BaseException) -> None:
+        if self.error is None:
+            self.error = e
+        self.stop.set()
+
+    def _run_source(self, output: Queue, consumers: int) -> None:
+        stats = self.stats[0]
+        try:
+            start = time.perf_counter()
+            for item in self.source:
+                stats.update(item, time.perf_counter() - start)
+                self._put(output, item)
+                start = time.perf_counter()
+            for _ in range(consumers):
+                self._put(output, DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def _run_stage(self, index: int, fn, input: Queue, output: Queue, consumers: int, finished: list, lock) -> None:
+        stats = self.stats[index + 1]
+        try:
+            while (item := self._get(input)) is not DONE:
+                start = time.perf_counter()
+                result = fn(item)
+                stats.update(result, time.perf_counter() - start)
+                self._put(output, result)
+        except BaseException as e:
+            self._fail(e)
+            return
+        # the last worker of a stage to finish tells the next stage we are done
+        with lock:
+            finished[0] -= 1
+            if finished[0] == 0:
+                for _ in range(consumers):
+                    self._put(output, DONE)
+
+    def __iter__(self) -> Iterator:
+        if len(self.stats) == len(self.stages) + 1:
+            self.sink("sink")
+        workers = [w for _, w in self.stages] + [1]
+        threads = [threading.Thread(target=self._run_source, args=(self.queues[0], workers[0]), daemon=True)]
+        for i, (fn, n) in enumerate(self.stages):
+            finished, lock = [n], threading.Lock()
+            for _ in range(n):
+                threads.append(threading.Thread(
+                    target=self._run_stage,
+                    args=(i, fn, self.queues[i], self.queues[i + 1], workers[i + 1], finished, lock),
+                    daemon=True))
+        for t in threads:
+            t.start()
+        stats = self.stats[-1]
+        try:
+            while (item := self._get(self.queues[-1])) is not DONE:
+                start = time.perf_counter()
+                yield item
+                stats.update(item, time.perf_counter() - start)
+        finally:
+            self.stop.set()
+            for t in threads:
+                t.join()
+        if self.error is not None:
+            raise self.error
+
+    def monitor(self, report: Callable[[str], None], interval=5.0) -> threading.Thread:
+        # call report with a summary of every stage every interval seconds
+        def run():
+            while not self.stop.wait(interval):
+                report(self.report())
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def report(self) -> str:
+        return " | ".join(str(s) for s in self.stats)
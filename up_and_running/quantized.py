@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import os
+from dotenv import load_dotenv, find_dotenv
+import psycopg2
+import click
+
+
+# This module adds an opt-in compact representation of the embeddings to
+# commit_history, for when the full vector(1536) values (6 KB per row) and their
+# index no longer fit in memory. There are three representations:
+#
+#   - halfvec:    the embedding with 16 bit floats, half the size
+#   - matryoshka: the first 256 dimensions. the text-embedding-3 models are trained
+#                 so that a prefix of the embedding is an embedding on its own.
+#                 a sixth of the size
+#   - binary:     one bit per dimension, whether it is positive, compared by
+#                 hamming distance. a thirty-second of the size
+#
+# The representation is stored in a generated column, so rows loaded or upserted
+# later get it too, with an hnsw index on it. A search first asks that index for
+# the nearest `oversample` times k candidates, then re-ranks them by their cosine
+# distance using the full precision embeddings, which only need to be read for
+# those candidates.
+#
+# These types need pgvector 0.7 or later. To add a representation to the loaded
+# table (or pass --quantize to 0_embed.py):
+#
+#   ./quantized.py halfvec
+#
+# The search scripts use the first one added, or the one given with their
+# --quantize option (see search.py). See bench_quantized.py for the size, recall and latency of each.
+
+
+MATRYOSHKA_DIMENSIONS = 256
+
+# mode: (column type, expression computing it from the embedding, hnsw operator class, distance operator)
+MODES = {
+    "halfvec": ("halfvec(1536)", "{}::halfvec(1536)", "halfvec_cosine_ops", "<=>"),
+    "matryoshka": (f"vector({MATRYOSHKA_DIMENSIONS})", f"subvector({{}}, 1, {MATRYOSHKA_DIMENSIONS})::vector({MATRYOSHKA_DIMENSIONS})", "vector_cosine_ops", "<=>"),
+    "binary": ("bit(1536)", "binary_quantize({})::bit(1536)", "bit_hamming_ops", "<~>"),
+}
+
+
+def column(mode: str) -> str:
+    return f"embedding_{mode}"
+
+
+def add_quantized_column(cur, mode: str) -> None:
+    # add the generated column and its index. cosine distance doesn't depend on
+    # the length of the vectors, so the matryoshka prefix needn't be normalized
+    type_, expression, opclass, _ = MODES[mode]
+    cur.execute(f"""
+        alter table commit_history
+        add column if not exists {column(mode)} {type_}
+        generated always as ({expression.format("embedding")}) stored
+        """)
+    cur.execute(f"create index if not exists commit_history_{column(mode)}_idx on commit_history using hnsw ({column(mode)} {opclass})")
+
+
+@click.command()
+@click.argument("mode", type=click.Choice(list(MODES)))
+def main(mode: str):
+    _ = load_dotenv(find_dotenv())
+    with psycopg2.connect(os.environ["TIMESCALE_SERVICE_URL"]) as con:
+        with con.cursor() as cur:
+            print(f"adding {column(mode)} and its index...")
+            cur.execute("create extension if not exists vector")
+            add_quantized_column(cur, mode)
+            cur.execute("analyze commit_history")
+    print("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import atexit
+from datetime import datetime
+import numpy as np
+import openai
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+from pgvector.psycopg import register_vector
+from embedding_cache import EmbeddingCache
+from embedded_cache import cache_exists
+from local_search import LocalSearch
+from quantized import MODES, column
+from text_search import CONFIG
+
+
+# This module holds the similarity search shared by the search scripts.
+#
+# Opening a new connection for every question means paying for a TCP and TLS
+# handshake plus authentication before the query even starts, which dominates
+# the latency when the database is hosted. Instead we keep a small pool of open
+# connections that is reused for every search.
+#
+# On each connection the kNN queries are prepared on the server the first time
+# they run, so later searches skip parsing and planning. The query embedding is
+# sent as a parameter in pgvector's binary format rather than as 1536 numbers
+# spelled out in text that the server has to parse.
+#
+# Question embeddings are cached in memory and in query_embeddings.sqlite (see
+# embedding_cache.py), so repeated questions don't call OpenAI at all.
+#
+# Searches filtered by author pick a strategy based on how many commits the
+# author has. For an author with few commits, their commits are found with the
+# (author, date) index and searched exactly. For an author with many commits,
+# the vector index is asked for the nearest neighbors of any author and these
+# are filtered, widening the search until k of the author's commits are found.
+# Either way we get k results whenever the author has k commits.
+#
+# The unfiltered and time filtered searches can use a compact copy of the
+# embeddings (see quantized.py): the nearest candidates are found with its index
+# and re-ranked with the full precision embeddings. By default a search uses the
+# first of the MODES that has been added to commit_history, if any. The scripts'
+# --quantize option picks one, or none.
+#
+# Hybrid searches also match the words of the question against the commits'
+# text (see text_search.py), and fuse the two rankings in the same query with
+# reciprocal rank fusion: each commit scores 1 / (RRF_K + rank) for each list it
+# is in. A commit that names the function the question asks about ranks high
+# even when its embedding isn't among the nearest.
+#
+# If the database can't be reached, searches fall back to searching the
+# embeddings cached by 0_embed.py in process (see local_search.py).
+
+
+MODEL = "text-embedding-3-small"
+QUERY_CACHE_PATH = "query_embeddings.sqlite"
+
+COLUMNS = """
+      "date"
+    , author
+    , "commit"
+    , metadata->>'summary' as summary
+    , metadata->>'details' as details
+    , content
+"""
+
+# authors with at most this many matching commits are searched exactly
+EXACT_AUTHOR_THRESHOLD = 2000
+# how many nearest neighbors the index is first asked for, per result wanted, and
+# the most it is ever asked for before giving up and searching exactly
+ANN_OVERSAMPLE = 10
+ANN_MAX_CANDIDATES = 20_000
+# quantization settings that aren't one of the MODES: use the first mode that has
+# been added, or the full precision embeddings only
+AUTO = "auto"
+NONE = "none"
+QUANTIZATION_CHOICES = [AUTO, NONE, *MODES]
+# how many candidates each ranking contributes to a hybrid search, per result
+# wanted, and the usual reciprocal rank fusion constant
+HYBRID_OVERSAMPLE = 4
+RRF_K = 60
+
+
+def filters(since: bool, author: bool) -> str:
+    where = []
+    if since:
+        where.append('"date" >= %(since)s::timestamptz')   # time based filtering
+    if author:
+        where.append("author = %(author)s")                # metadata filtering
+    return ("where " + " and ".join(where)) if where else ""
+
+
+def knn_query(since: bool, author: bool) -> str:
+    # one query shape per combination of filters, so each can be prepared once
+    if author:
+        return exact_author_query(since)
+    return f"""
+        select {COLUMNS}
+        from commit_history
+        {filters(since, False)}
+        order by embedding <=> %(embedding)b   -- order by semantic similarity
+        limit %(k)s                            -- only return the k most similar
+        """
+
+
+def exact_author_query(since: bool) -> str:
+    # find the author's commits using the (author, date) index first, then compute
+    # the distance to each of them. the materialized cte stops the planner from
+    # using the vector index, which would filter out the other authors' commits
+    # only after finding the nearest neighbors and could return fewer than k rows
+    return f"""
+        with candidates as materialized
+        (
+            select {COLUMNS}, embedding
+            from commit_history
+            {filters(since, True)}
+        )
+        select "date", author, "commit", summary, details, content
+        from candidates
+        order by embedding <=> %(embedding)b
+        limit %(k)s
+        """
+
+
+def ann_author_query(since: bool) -> str:
+    # ask the vector index for the nearest candidates regardless of author, then
+    # keep the author's commits among them
+    return f"""
+        select "date", author, "commit", summary, details, content
+        from
+        (
+            select {COLUMNS}, embedding <=> %(embedding)b as distance
+            from commit_history
+            {filters(since, False)}
+            order by embedding <=> %(embedding)b
+            limit %(candidates)s
+        ) c
+        where author = %(author)s
+        order by distance
+        limit %(k)s
+        """
+
+
+def quantized_query(mode: str, since: bool) -> str:
+    # find the candidates with the compact representation's index, then re-rank
+    # them exactly. the materialized cte keeps the two steps apart
+    _, expression, _, operator = MODES[mode]
+    return f"""
+        with candidates as materialized
+        (
+            select {COLUMNS}, embedding
+            from commit_history
+            {filters(since, False)}
+            order by {column(mode)} {operator} {expression.format("%(embedding)b")}
+            limit %(candidates)s
+        )
+        select "date", author, "commit", summary, details, content
+        from candidates
+        order by embedding <=> %(embedding)b
+        limit %(k)s
+        """
+
+
+def hybrid_query(since: bool, author: bool) -> str:
+    # the question's lexemes are or'ed together: a question rarely contains every
+    # word of the commit it is about. they are quoted so that they aren't parsed
+    # again, and a question with no lexemes matches no text at all.
+    #
+    # with an author filter, the semantic candidates are found among the author's
+    # commits with the (author, date) index, as in exact_author_query, rather
+    # than filtered out of the nearest neighbors of any author
+    where = filters(since, author)
+    match = "content_tsv @@ question.query"
+    authored = ""
+    if author:
+        authored = f"""
+        , authored as materialized
+        (
+            select id, {COLUMNS}, embedding
+            from commit_history
+            {where}
+        )"""
+    return f"""
+        with question as
+        (
+            select string_agg('''' || replace(replace(lexeme, '\\', '\\\\'), '''', '''''') || '''', ' | ')::tsquery as query
+            from unnest(tsvector_to_array(to_tsvector('{CONFIG}', %(question)s))) as lexeme
+        ){authored}
+        , semantic as materialized
+        (
+            select *, row_number() over (order by distance) as rank
+            from
+            (
+                select id, "date", author, "commit", summary, details, content, embedding <=> %(embedding)b as distance
+                from {"authored" if author else "commit_history"}
+                {"" if author else where}
+                order by embedding <=> %(embedding)b
+                limit %(candidates)s
+            ) s
+        )
+        , keyword as materialized
+        (
+            select *, row_number() over (order by score desc) as rank
+            from
+            (
+                select id, {COLUMNS}, ts_rank_cd(content_tsv, question.query) as score
+                from commit_history, question
+                {f"{where} and {match}" if where else f"where {match}"}
+                order by score desc
+                limit %(candidates)s
+            ) k
+        )
+        select "date", author, "commit", summary, details, content
+        from
+        (
+            select id, "date", author, "commit", summary, details, content, rank from semantic
+            union all
+            select id, "date", author, "commit", summary, details, content, rank from keyword
+        ) ranked
+        group by id, "date", author, "commit", summary, details, content
+        order by sum(1.0 / (%(rrf_k)s + rank)) desc
+        limit %(k)s
+        """
+
+
+def quantized_modes(con) -> list[str]:
+    # the compact representations that have been added to commit_history, in the
+    # order of MODES
+    columns = {r["column_name"] for r in con.execute("""
+        select column_name
+        from information_schema.columns
+        where table_name = 'commit_history'
+        """).fetchall()}
+    return [mode for mode in MODES if column(mode) in columns]
+
+
+def resolve_quantization(con, quantization: str | None) -> str | None:
+    # the mode to search with, for a quantization setting
+    if quantization == AUTO:
+        return next(iter(quantized_modes(con)), None)
+    return None if quantization == NONE else quantization
+
+
+def author_count_query(since: bool) -> str:
+    # counts the author's commits, but stops counting past the threshold
+    return f"""
+        select count(*) as count
+        from
+        (
+            select 1
+            from commit_history
+            {filters(since, True)}
+            limit %(limit)s
+        ) c
+        """
+
+
+class CommitSearch:
+    def __init__(
+        self,
+        service_url: str,
+        client: openai.OpenAI | None = None,
+        cache: EmbeddingCache | None = None,
+        min_size=1,
+        max_size=4,
+        timeout=5.0,
+        fallback_path: str | None = "commit_history_embedded",
+        quantization: str | None = AUTO,
+        quantized_oversample=ANN_OVERSAMPLE,
+    ):
+        self.client = client or openai.OpenAI()
+        # a mode, AUTO or NONE (see QUANTIZATION_CHOICES). AUTO is looked up on
+        # the first search
+        self.quantization = quantization
+        self.quantized_oversample = quantized_oversample
+        self.timeout = timeout
+        self.fallback_path = fallback_path
+        self._local: LocalSearch | None = None
+        # questions that were asked before don't need to be embedded again
+        self.cache = cache if cache is not None else EmbeddingCache(path=QUERY_CACHE_PATH)
+        # connections are opened in the background, so the pool is usually ready
+        # by the time the user has typed their first question
+        self.pool = ConnectionPool(
+            service_url,
+            min_size=min_size,
+            max_size=max_size,
+            kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+            configure=register_vector,
+        )
+        atexit.register(self.pool.close)
+
+    def embed(self, question: str) -> np.ndarray:
+        # turn the question into an embedding/vector using the openai client, unless it is cached
+        return self.cache.get_or_embed(MODEL, question, self._embed)
+
+    def _embed(self, question: str) -> list[float]:
+        return self.client.embeddings.create(input=[question], model=MODEL).data[0].embedding
+
+    def search(self, embedding: np.ndarray, k=5, since: datetime | None = None, author: str | None = None) -> list[dict]:
+        params = {"embedding": np.asarray(embedding, dtype=np.float32), "k": k, "since": since, "author": author}
+        try:
+            with self.pool.connection(timeout=self.timeout) as con:
+                if author is not None:
+                    return self.search_author(con, params)[0]
+                if self.quantization == AUTO:
+                    # look for a compact representation once, on the first search
+                    self.quantization = resolve_quantization(con, AUTO) or NONE
+                mode = resolve_quantization(con, self.quantization)
+                if mode is not None:
+                    params["candidates"] = k * self.quantized_oversample
+                    return con.execute(quantized_query(mode, since is not None), params).fetchall()
+                return con.execute(knn_query(since is not None, False), params).fetchall()
+        except (psycopg.OperationalError, PoolTimeout):
+            # the database is unavailable. search the embeddings cached on disk instead
+            local = self.local()
+            if local is None:
+                raise
+            return local.search(embedding, k, since, author)
+
+    def hybrid_search(self, question: str, embedding: np.ndarray, k=5, since: datetime | None = None, author: str | None = None) -> list[dict]:
+        # fuse the semantic and the full-text rankings in one round trip
+        params = {
+            "question": question, "embedding": np.asarray(embedding, dtype=np.float32), "k": k,
+            "since": since, "author": author, "candidates": k * HYBRID_OVERSAMPLE, "rrf_k": RRF_K,
+        }
+        try:
+            with self.pool.connection(timeout=self.timeout) as con:
+                return con.execute(hybrid_query(since is not None, author is not None), params).fetchall()
+        except (psycopg.OperationalError, PoolTimeout):
+            # the local fallback has no text to search, so it is semantic only
+            local = self.local()
+            if local is None:
+                raise
+            return local.search(embedding, k, since, author)
+
+    def search_author(self, con, params: dict, strategy="auto") -> tuple[list[dict], str]:
+        # pick how to search based on how many commits the author has. returns the
+        # matches and the strategy that produced them
+        since = params["since"] is not None
+        if strategy == "auto":
+            count = con.execute(author_count_query(since), {**params, "limit": EXACT_AUTHOR_THRESHOLD + 1}).fetchone()["count"]
+            strategy = "exact" if count <= EXACT_AUTHOR_THRESHOLD else "ann"
+        if strategy == "ann":
+            # widen the candidate set until it holds k of the author's commits
+            candidates = params["k"] * ANN_OVERSAMPLE
+            while candidates <= ANN_MAX_CANDIDATES:
+                matches = con.execute(ann_author_query(since), {**params, "candidates": candidates}).fetchall()
+                if len(matches) >= params["k"]:
+                    return matches, f"ann ({candidates} candidates)"
+                candidates *= 4
+        return con.execute(exact_author_query(since), params).fetchall(), "exact"
+
+    def local(self) -> LocalSearch | None:
+        # the in-process fallback is only loaded the first time it is needed
+        if self._local is None and self.fallback_path is not None and cache_exists(self.fallback_path):
+            self._local = LocalSearch(self.fallback_path)
+        return self._local
@@ -0,0 +1,136 @@
+import struct
+from datetime import datetime, timedelta, timezone
+from bulk_load import (
+    COPY_SIGNATURE,
+    COPY_TRAILER,
+    CopyStream,
+    copy_records,
+    encode_jsonb,
+    encode_row,
+    encode_timestamptz,
+    encode_vector,
+)
+
+
+# The encoders are checked against byte layouts written out by hand from the
+# binary COPY format and pgvector's binary format, since there is no database to
+# read them back.
+
+
+def record(i: int) -> dict:
+    return {
+        "id": i,
+        "date": "2023-01-01T00:00:00+00:00",
+        "metadata": {"commit": f"{i:040x}"},
+        "content": f"commit {i}",
+        "embedding": [float(i), -1.0],
+    }
+
+
+def test_encode_vector():
+    # int16 dimensions, int16 unused, then big endian float32s
+    expected = b"\x00\x02" b"\x00\x00" b"\x3f\x80\x00\x00" b"\xc0\x00\x00\x00"
+    assert encode_vector([1.0, -2.0]) == expected
+    # embeddings read from the csv are json text
+    assert encode_vector("[1, -2]") == expected
+
+
+def test_encode_timestamptz():
+    utc = timezone.utc
+    assert encode_timestamptz(datetime(2000, 1, 1, tzinfo=utc), utc) == b"\x00" * 8
+    assert encode_timestamptz("2000-01-01T00:00:01.000002+00:00", utc) == struct.pack("!q", 1_000_002)
+    # before the postgres epoch
+    assert encode_timestamptz("1999-12-31T23:59:59+00:00", utc) == struct.pack("!q", -1_000_000)
+    # naive timestamps are in the session's time zone
+    plus_one = timezone(timedelta(hours=1))
+    assert encode_timestamptz("2000-01-01T01:00:00", plus_one) == b"\x00" * 8
+
+
+def test_encode_jsonb():
+    assert encode_jsonb({"a": 1}) == b'\x01{"a": 1}'
+    assert encode_jsonb('{"a": 1}') == b'\x01{"a": 1}'
+
+
+def test_encode_row():
+    row = encode_row({
+        "id": 7,
+        "date": "2000-01-01T00:00:00+00:00",
+        "metadata": "{}",
+        "content": "hi",
+        "embedding": [1.0],
+    }, timezone.utc)
+    assert row == (
+        b"\x00\x05"                                          # 5 fields
+        + b"\x00\x00\x00\x04" + b"\x00\x00\x00\x07"          # id
+        + b"\x00\x00\x00\x08" + b"\x00" * 8                  # date
+        + b"\x00\x00\x00\x03" + b"\x01{}"                    # metadata
+        + b"\x00\x00\x00\x02" + b"hi"                        # content
+        + b"\x00\x00\x00\x08" + b"\x00\x01\x00\x00\x3f\x80\x00\x00"   # embedding
+    )
+
+
+def test_copy_stream_reads_in_any_size():
+    records = [record(i) for i in range(5)]
+    expected = COPY_SIGNATURE + b"".join(encode_row(r, timezone.utc) for r in records) + COPY_TRAILER
+    for size in [1, 7, 64, 1 << 16, -1]:
+        stream = CopyStream(iter(records), timezone.utc)
+        chunks = []
+        while chunk := stream.read(size):
+            assert size < 0 or len(chunk) <= size
+            chunks.append(chunk)
+        assert b"".join(chunks) == expected
+        assert stream.rows == len(records)
+
+
+class FakeCursor:
+    def __init__(self):
+        self.copies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        assert sql == "show timezone"
+
+    def fetchone(self):
+        return ("UTC",)
+
+    def copy_expert(self, sql, stream, size):
+        data = b""
+        while chunk := stream.read(size):
+            data += chunk
+        self.copies.append(data)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cur = FakeCursor()
+        self.commits = 0
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_copy_records_commits_every_batch():
+    con = FakeConnection()
+    batches = []
+    assert copy_records(con, (record(i) for i in range(25)), batch_size=10, progress=batches.append) == 25
+    assert batches == [10, 10, 5]
+    assert con.commits == 3
+    # every copy is a complete stream of its own
+    for copy, rows in zip(con.cur.copies, batches):
+        assert copy.startswith(COPY_SIGNATURE) and copy.endswith(COPY_TRAILER)
+        body = copy[len(COPY_SIGNATURE):-len(COPY_TRAILER)]
+        assert body.count(b"\x00\x05\x00\x00\x00\x04") == rows
+
+
+def test_copy_records_empty():
+    con = FakeConnection()
+    assert copy_records(con, []) == 0
+    assert con.commits == 0
@@ -0,0 +1,68 @@
+import pytest
+import tiktoken
+from context_packer import ContextPacker, TokenBudget
+from shared import token_budget
+
+
+# Tokens are counted with an encoding that has one token per byte, so the
+# budgets below can be worked out by hand.
+
+
+def byte_encoding() -> tiktoken.Encoding:
+    return tiktoken.Encoding(
+        "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(token_budget, "get_encoding", lambda model: byte_encoding())
+
+
+def budget(budget: int, max_tokens=100, separator_tokens=0) -> TokenBudget:
+    return TokenBudget(budget, max_tokens, "bytes", separator_tokens)
+
+
+def test_packs_in_order():
+    b = budget(10)
+    assert b.pack_texts([("a", "aaa"), ("b", "bbb"), ("c", "ccc")]) == [(0, "aaa"), (1, "bbb"), (2, "ccc")]
+    assert (b.packed, b.tokens, b.duplicates, b.over_budget) == (3, 9, 0, 0)
+
+
+def test_stops_at_the_budget():
+    # the short text after the one that doesn't fit is left out too
+    b = budget(10)
+    assert b.pack_texts([("a", "aaaaaa"), ("b", "bbbbbb"), ("c", "c")]) == [(0, "aaaaaa")]
+    assert (b.packed, b.tokens, b.over_budget) == (1, 6, 2)
+
+
+def test_separators_count():
+    b = budget(10, separator_tokens=2)
+    assert b.pack_texts([("a", "aaa"), ("b", "bbb"), ("c", "c")]) == [(0, "aaa"), (1, "bbb")]
+    assert b.tokens == 10
+
+
+def test_skips_duplicates():
+    b = budget(100)
+    items = [("Fix the  bug", "first"), ("fix the bug", "second"), ("other", "third")]
+    assert b.pack_texts(items) == [(0, "first"), (2, "third")]
+    assert b.duplicates == 1
+
+
+def test_truncates_long_texts():
+    b = budget(100, max_tokens=4)
+    assert b.pack_texts([("a", "abcdefgh")]) == [(0, "abcd ...")]
+    assert b.tokens == 5
+
+
+def test_state_is_reset():
+    b = budget(5)
+    b.pack_texts([("a", "aaaa"), ("a", "aaaa"), ("b", "bbbb")])
+    b.pack_texts([("c", "c")])
+    assert (b.packed, b.tokens, b.duplicates, b.over_budget) == (1, 1, 0, 0)
+
+
+def test_context_packer_formats_matches():
+    match = {"author": "Ann", "date": "2023-01-01", "commit": "abc", "summary": "Fix", "details": "the bug"}
+    packer = ContextPacker(budget=100, max_tokens=100)
+    assert packer.pack([match, {**match, "commit": "def", "summary": "fix "}]) == ["Ann 2023-01-01 abc Fix the bug"]
+    assert str(packer) == "context: 1 commits in 32 of 100 tokens, 1 duplicates, 0 over budget"
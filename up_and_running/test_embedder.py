@@ -0,0 +1,98 @@
+import random
+from types import SimpleNamespace
+import httpx
+import openai
+import pytest
+import tiktoken
+import embedder
+from embedder import Embedder
+
+
+# The OpenAI client is replaced with a fake that answers out of order and fails
+# on demand, and the tokenizer with one that counts bytes, so nothing is
+# downloaded or sent.
+
+
+def byte_encoding() -> tiktoken.Encoding:
+    return tiktoken.Encoding(
+        "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+
+
+def api_error(cls, status: int, headers=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+    return cls("error", response=response, body=None)
+
+
+class FakeEmbeddings:
+    def __init__(self, failures=()):
+        # exceptions raised by the first requests, one per request
+        self.failures = list(failures)
+        self.requests = []
+        self.rng = random.Random(0)
+
+    def create(self, input, model):
+        self.requests.append(list(input))
+        if self.failures:
+            raise self.failures.pop(0)
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        self.rng.shuffle(data)
+        return SimpleNamespace(data=data)
+
+
+class FakeClient:
+    def __init__(self, failures=()):
+        self.embeddings = FakeEmbeddings(failures)
+
+    def with_options(self, **options):
+        return self
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(embedder, "get_encoding", lambda model: byte_encoding())
+    monkeypatch.setattr(embedder.time, "sleep", lambda seconds: None)
+
+
+def test_results_are_in_input_order():
+    texts = ["x" * n for n in range(1, 200)]
+    e = Embedder(FakeClient(), batch_size=7, concurrency=4)
+    assert e.embed(texts) == [[float(len(t))] for t in texts]
+    assert e.requests == 29
+
+
+def test_batches_respect_the_limits():
+    e = Embedder(FakeClient(), batch_size=3, max_batch_tokens=10)
+    batches = list(e.batches(["aaaa", "bbbb", "cc", "d", "e", "ffffffffff", "g"], lambda t: t))
+    assert [[text for _, text in batch] for batch in batches] == [["aaaa", "bbbb", "cc"], ["d", "e"], ["ffffffffff"], ["g"]]
+
+
+def test_newlines_are_replaced():
+    e = Embedder(FakeClient())
+    assert e._prepare("a\nb") == ("a b", 3)
+
+
+def test_rate_limits_are_retried():
+    client = FakeClient([
+        api_error(openai.RateLimitError, 429, {"retry-after": "0"}),
+        api_error(openai.InternalServerError, 500),
+    ])
+    e = Embedder(client)
+    assert e.embed(["a", "bb"]) == [[1.0], [2.0]]
+    assert e.retries == 2
+    assert client.embeddings.requests == [["a", "bb"]] * 3
+
+
+def test_gives_up_after_max_retries():
+    client = FakeClient([api_error(openai.RateLimitError, 429)] * 3)
+    e = Embedder(client, max_retries=2)
+    with pytest.raises(openai.RateLimitError):
+        e.embed(["a"])
+    assert e.retries == 2
+
+
+def test_other_errors_are_not_retried():
+    client = FakeClient([api_error(openai.BadRequestError, 400)])
+    e = Embedder(client)
+    with pytest.raises(openai.BadRequestError):
+        e.embed(["a"])
+    assert e.retries == 0
@@ -0,0 +1,102 @@
+import json
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pytest
+from embedded_cache import DIMENSIONS, write_embedded_cache
+from local_search import LocalSearch
+
+
+# The local search is checked against a brute force ranking of the same random
+# embeddings, with and without the filters and the IVF index.
+
+
+AUTHORS = ["ann", "bob", "cy"]
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, DIMENSIONS)).astype(np.float32)
+    # the dates are shuffled, so the rows aren't in date order
+    days = rng.permutation(len(vectors))
+    records = [{
+        "id": i,
+        "date": (START + timedelta(days=int(days[i]))).isoformat(),
+        "metadata": json.dumps({"author": AUTHORS[i % 3], "commit": f"{i:040x}", "summary": f"s{i}", "details": f"d{i}"}),
+        "content": f"commit {i}",
+        "embedding": vectors[i],
+    } for i in range(len(vectors))]
+    path = tmp_path_factory.mktemp("cache") / "commit_history_embedded"
+    write_embedded_cache(records, path)
+    return LocalSearch(path), vectors, records
+
+
+def brute_force(vectors, records, query, k, since=None, author=None) -> list[int]:
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = unit @ (query / np.linalg.norm(query))
+    rows = [
+        i for i, r in enumerate(records)
+        if (since is None or datetime.fromisoformat(r["date"]) >= since)
+        and (author is None or json.loads(r["metadata"])["author"] == author)
+    ]
+    return sorted(rows, key=lambda i: -scores[i])[:k]
+
+
+@pytest.mark.parametrize("since, author", [
+    (None, None),
+    (START + timedelta(days=250), None),
+    (None, "bob"),
+    (START + timedelta(days=400), "cy"),
+])
+def test_exact_search(corpus, since, author):
+    search, vectors, records = corpus
+    rng = np.random.default_rng(1)
+    for _ in range(5):
+        query = rng.normal(size=DIMENSIONS).astype(np.float32)
+        matches = search.search(query, k=10, since=since, author=author)
+        assert [m["id"] for m in matches] == brute_force(vectors, records, query, 10, since, author)
+        distances = [m["distance"] for m in matches]
+        assert distances == sorted(distances)
+
+
+def test_unknown_author(corpus):
+    search, _, _ = corpus
+    assert search.search(np.ones(DIMENSIONS), k=5, author="nobody") == []
+
+
+def test_more_than_there_are(corpus):
+    search, _, _ = corpus
+    assert len(search.search(np.ones(DIMENSIONS), k=1000, since=START + timedelta(days=490))) == 10
+
+
+def test_dates_in_different_time_zones(tmp_path):
+    # 10:00-05 is 15:00 UTC and 12:00-06 is 18:00 UTC. without their offsets both
+    # would be before the 16:00 UTC cut-off
+    dates = ["2023-01-01 10:00:00-05", "2023-01-01 12:00:00-06", "2023-01-01 16:00:00+00"]
+    records = [{
+        "id": i,
+        "date": datetime.fromisoformat(date).isoformat(),
+        "metadata": json.dumps({"author": "ann", "commit": f"{i:040x}", "summary": "", "details": ""}),
+        "content": "",
+        "embedding": np.ones(DIMENSIONS, dtype=np.float32),
+    } for i, date in enumerate(dates)]
+    write_embedded_cache(records, tmp_path / "commit_history_embedded")
+    search = LocalSearch(tmp_path / "commit_history_embedded")
+    since = datetime(2023, 1, 1, 16, tzinfo=timezone.utc)
+    assert {m["id"] for m in search.search(np.ones(DIMENSIONS), k=5, since=since)} == {1, 2}
+    # the same cut-off in another time zone, and naive, which is taken as UTC
+    assert {m["id"] for m in search.search(np.ones(DIMENSIONS), k=5, since=since.astimezone(timezone(timedelta(hours=-5))))} == {1, 2}
+    assert {m["id"] for m in search.search(np.ones(DIMENSIONS), k=5, since=datetime(2023, 1, 1, 15, 30))} == {1, 2}
+    assert {m["id"] for m in search.search(np.ones(DIMENSIONS), k=5, since=datetime(2023, 1, 1, 15))} == {0, 1, 2}
+
+
+def test_ivf_probing_every_list_is_exact(corpus):
+    search, vectors, records = corpus
+    search.build_ivf(nlist=8)
+    try:
+        query = np.random.default_rng(2).normal(size=DIMENSIONS).astype(np.float32)
+        matches = search.search(query, k=10, author="ann", nprobe=8)
+        assert [m["id"] for m in matches] == brute_force(vectors, records, query, 10, author="ann")
+    finally:
+        search.centroids = None
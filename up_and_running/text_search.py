@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import os
+from dotenv import load_dotenv, find_dotenv
+import psycopg2
+import click
+
+
+# This module adds full-text search to commit_history, for the hybrid search in
+# search.py. Questions that name a commit hash, a function such as
+# invalidation_threshold_htid_found or a setting such as
+# timescaledb.max_background_workers match the commits with those exact words
+# poorly by semantic similarity alone.
+#
+# The content is parsed into a tsvector in a generated column, so rows loaded or
+# upserted later get it too, with a GIN index on it next to the tsv index.
+# 0_embed.py creates both when it loads the table. To add them to a table loaded
+# before that:
+#
+#   ./text_search.py
+
+
+# the text search configuration used for both the commits and the questions
+CONFIG = "english"
+
+
+def add_text_search_column(cur) -> None:
+    cur.execute(f"""
+        alter table commit_history
+        add column if not exists content_tsv tsvector
+        generated always as (to_tsvector('{CONFIG}', coalesce(content, ''))) stored
+        """)
+    create_text_search_index(cur)
+
+
+def create_text_search_index(cur) -> None:
+    cur.execute("create index if not exists commit_history_content_tsv_idx on commit_history using gin (content_tsv)")
+
+
+@click.command()
+def main():
+    _ = load_dotenv(find_dotenv())
+    with psycopg2.connect(os.environ["TIMESCALE_SERVICE_URL"]) as con:
+        with con.cursor() as cur:
+            print("adding content_tsv and its index...")
+            add_text_search_column(cur)
+            cur.execute("analyze commit_history")
+    print("done")
+
+
+if __name__ == "__main__":
+    main()